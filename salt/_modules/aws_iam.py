@@ -1,164 +1,914 @@
 # -*- coding: utf-8 -*-
 '''
 Support for the Amazon Identity and Access Management Service.
+
+Every function takes an optional `role`, the ARN of an IAM role to act as, to manage the account
+the role belongs to. The role is assumed with sts assume-role using the minion's own AWS
+credentials, and its temporary credentials are reused until shortly before they expire.
 '''
+import base64
+import calendar
+import csv
+import hashlib
 import json
+import os
+import pipes
+import random
+import threading
+import time
+import urllib
+from StringIO import StringIO
 import salt.utils
+from salt.exceptions import CommandExecutionError
 import logging
 log = logging.getLogger(__name__)
 
+# Default number of items to request per page from paginated IAM listings.
+PAGE_SIZE = 100
+
+# Number of times to retry a throttled request, and the base delay in seconds between retries.
+THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 1.0
+
+# Seconds to reuse a parsed credential report, and to wait between polls while one generates.
+CREDENTIAL_REPORT_TTL = 900
+CREDENTIAL_REPORT_POLL = 2
+# Seconds since AWS generated a report within which it is trusted to show every access key.
+CREDENTIAL_REPORT_MAX_AGE = 3600
+_credential_report_cache = {}
+_credential_report_inflight = {}
+_credential_report_lock = threading.Lock()
+
+# What IAM won't delete a user with, by the action that removes it, in the order detach_user
+# removes them.
+USER_ATTACHMENTS = ('remove_user_from_group', 'delete_access_key', 'delete_signing_certificate',
+                    'deactivate_mfa_device', 'delete_user_policy', 'detach_user_policy',
+                    'delete_login_profile')
+
+# Seconds an assumed-role session lasts, and how long before it expires it is replaced.
+ROLE_SESSION_DURATION = 3600
+ROLE_REFRESH = 300
+ROLE_SESSION_NAME = 'salt-org'
+
+# Temporary credentials by role ARN, kept across module reloads.
+try:
+  _role_sessions
+except NameError:
+  _role_sessions = {}
+  _role_locks = {}
+  _role_lock = threading.Lock()
+
+# Where the awscli binary was found, by PATH. Kept across module reloads in a long-running
+# minion, and in the minion cachedir across salt-call runs, so loading doesn't rescan PATH.
+AWS_PROBE_CACHE = 'aws_iam_probe.json'
+try:
+  _aws_probe
+except NameError:
+  _aws_probe = {}
+
+
+def _probe_cache_file():
+  opts = globals().get('__opts__') or {}
+  if not opts.get('cachedir'):
+    return None
+  return os.path.join(opts['cachedir'], AWS_PROBE_CACHE)
+
+
+def _find_aws():
+  '''
+  Find the awscli binary on PATH, reusing an earlier probe while the binary it found is still
+  executable. Only successful probes are cached, so installing awscli is picked up next load.
+  '''
+  path = os.environ.get('PATH', '')
+  cache_file = _probe_cache_file()
+  if path not in _aws_probe and cache_file and os.path.isfile(cache_file):
+    try:
+      with open(cache_file) as f:
+        _aws_probe.update(json.load(f))
+    except (IOError, ValueError):
+      pass
+  binary = _aws_probe.get(path)
+  if binary and os.access(binary, os.X_OK):
+    return binary
+  binary = salt.utils.which('aws')
+  if not binary:
+    _aws_probe.pop(path, None)
+    return None
+  _aws_probe[path] = binary
+  if cache_file:
+    # write then rename, so a minion loading the module meanwhile never reads half a file
+    tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    try:
+      with open(tmp_file, 'w') as f:
+        json.dump(_aws_probe, f)
+      os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+      log.debug('Could not write {0}: {1}'.format(cache_file, e))
+  return binary
+
 
 def __virtual__():
-  if salt.utils.which('aws'):
+  if _find_aws():
     # awscli is installed, load the module
     return True
   return False
 
 
-def _run_aws(cmd, **kwargs):
-  '''
-  Runs the given command against AWS.
+def _role_env(role):
+  '''
+  Get the environment that makes the aws CLI act as a role, assuming the role if there is no
+  session for it yet or its session is about to expire. Raises CommandExecutionError if the role
+  can't be assumed.
+  '''
+  with _role_lock:
+    lock = _role_locks.setdefault(role, threading.Lock())
+  # one assume-role per role at a time, while other roles are assumed concurrently
+  with lock:
+    session = _role_sessions.get(role)
+    if session is None or time.time() >= session['expires'] - ROLE_REFRESH:
+      __salt__['salt_org.count_call']('sts')
+      out = __salt__['cmd.run_all'](
+          'aws sts assume-role --role-arn {0} --role-session-name {1} --duration-seconds {2} '
+          '--output json'.format(pipes.quote(role), ROLE_SESSION_NAME, ROLE_SESSION_DURATION))
+      if out['retcode'] != 0:
+        raise CommandExecutionError('Error assuming role {0}: {1}'.format(
+            role, out['stderr'] or out['stdout']))
+      credentials = json.loads(out['stdout'])['Credentials']
+      session = {'env': {'AWS_ACCESS_KEY_ID': credentials['AccessKeyId'],
+                         'AWS_SECRET_ACCESS_KEY': credentials['SecretAccessKey'],
+                         'AWS_SESSION_TOKEN': credentials['SessionToken']},
+                 'expires': calendar.timegm(time.strptime(credentials['Expiration'][:19],
+                                                          '%Y-%m-%dT%H:%M:%S'))}
+      _role_sessions[role] = session
+      log.debug('Assumed role {0} until {1}'.format(role, credentials['Expiration']))
+    return session['env']
+
+
+def _run_aws(cmd, retries=None, role=None, not_found=None, **kwargs):
+  '''
+  Runs the given command against AWS, backing off and retrying when IAM throttles the request.
+  Reads (get-* and list-* commands) are shared with other processes on the host for a short
+  time (see salt_org.cached); other commands clear those of the same role's account.
   cmd
       Command to run
+  retries
+      Number of times to retry a throttled request. Defaults to THROTTLE_RETRIES.
+  role
+      ARN of a role to run the command as. The minion's own credentials are used by default.
+  not_found
+      What to return instead of None when the entity doesn't exist (NoSuchEntity)
   kwargs
       Key-value arguments to pass to the command
   '''
   _formatted_args = [
-      '--{0} "{1}"'.format(k, v) for k, v in kwargs.iteritems()]
+      '--{0} {1}'.format(k, pipes.quote(str(v))) for k, v in kwargs.iteritems()]
 
+  operation = cmd.split()[1]
   cmd = 'aws {cmd} {args} --output json'.format(
       cmd=cmd,
       args=' '.join(_formatted_args))
-  rtn = __salt__['cmd.run'](cmd)
+  if retries is None:
+    retries = THROTTLE_RETRIES
+
+  def run():
+    if role is None:
+      run_all = __salt__['cmd.run_all']
+    else:
+      try:
+        env = _role_env(role)
+      except CommandExecutionError as exc:
+        log.error(exc)
+        return None
+      run_all = lambda cmd: __salt__['cmd.run_all'](cmd, env=env)
+    attempt = 0
+    while True:
+      __salt__['salt_org.count_call']('iam')
+      out = run_all(cmd)
+      if out['retcode'] == 0:
+        break
+      if 'Throttling' not in out['stderr'] or attempt >= retries:
+        if not_found is not None and 'NoSuchEntity' in out['stderr']:
+          return not_found
+        log.error(out['stderr'] or out['stdout'])
+        return None
+      delay = THROTTLE_BACKOFF * 2 ** attempt + random.uniform(0, THROTTLE_BACKOFF)
+      log.info('IAM throttled {0}, retrying in {1:.1f}s'.format(cmd, delay))
+      time.sleep(delay)
+      attempt += 1
+    if not out['stdout'].strip():
+      # commands like add-user-to-group print nothing when they succeed
+      return {}
+    try:
+      rtn = json.loads(out['stdout'])
+    except ValueError:
+      log.error(out['stdout'])
+      return None
+    return rtn
+
+  if operation.startswith(('get-', 'list-')):
+    # the credentials in use decide which account the command reads
+    key = json.dumps([cmd, role] + [os.environ.get(name) for name in
+                                    ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE', 'AWS_ACCESS_KEY_ID')])
+    return __salt__['salt_org.cached'](_cache_namespace(role), key, run,
+                                       lambda rtn: rtn is not None)
+  rtn = run()
+  if operation != 'generate-credential-report':
+    __salt__['salt_org.cache_clear'](_cache_namespace(role))
+  return rtn
+
+
+def _cache_namespace(role):
+  '''
+  Get the salt_org cache namespace for reads of an account, so a write to one account leaves the
+  cached reads of the others alone.
+  '''
+  return 'iam/' + (role or 'default')
+
+
+def _paginate(cmd, page_size=None, role=None, **kwargs):
+  '''
+  Yields each page of a paginated IAM listing, fetching the next page only when asked for it.
+  Follows the CLI's NextToken, and raises CommandExecutionError if a page can't be fetched.
+  cmd
+      Command to run
+  page_size
+      Number of items to request per page
+  role
+      ARN of a role to run the command as
+  kwargs
+      Key-value arguments to pass to the command
+  '''
+  page_args = {'max-items': page_size or PAGE_SIZE}
+  while True:
+    args = dict(kwargs)
+    args.update(page_args)
+    page = _run_aws(cmd, role=role, **args)
+    if page is None:
+      raise CommandExecutionError('Error running aws {0}'.format(cmd))
+    yield page
+    if page.get('NextToken'):
+      page_args = {'max-items': page_size or PAGE_SIZE, 'starting-token': page['NextToken']}
+    else:
+      return
+
+# ACCOUNT SNAPSHOT
+
+
+def _fetch_authorization_details(page_size=None, role=None):
+  '''
+  Fetch every user and group in the account, page by page.
+  '''
+  users = []
+  groups = []
   try:
-    rtn = json.loads(rtn)
-  except:
-    log.error(rtn)
+    for page in _paginate('iam get-account-authorization-details --filter User Group',
+                          page_size, role):
+      users.extend(page.get('UserDetailList', []))
+      groups.extend(page.get('GroupDetailList', []))
+  except CommandExecutionError as exc:
+    log.error(exc)
     return None
-  return rtn
+  return users, groups
+
+
+def _snapshot_key(role):
+  return 'aws_iam.snapshot' if role is None else 'aws_iam.snapshot:' + role
+
+
+def snapshot(refresh=False, page_size=None, role=None):
+  '''
+  Get an indexed view of all users, groups and group memberships in the account.
+
+  The view is built from get-account-authorization-details and cached for the rest of the run,
+  so states can read current IAM state without a call per user or group. Pass refresh=True to
+  rebuild it. Returns None if the account could not be read. Each role's account has its own
+  view.
+  '''
+  if not refresh and _snapshot_key(role) in __context__:
+    return __context__[_snapshot_key(role)]
+  details = _fetch_authorization_details(page_size, role)
+  if details is None:
+    return None
+  users, groups = details
+  snap = {'users': {}, 'groups': {}, 'members': {}}
+  for group in groups:
+    snap['groups'][group['GroupName']] = group
+    snap['members'][group['GroupName']] = []
+  for user in users:
+    snap['users'][user['UserName']] = user
+    for group_name in user.get('GroupList', []):
+      snap['members'].setdefault(group_name, []).append(user['UserName'])
+  __context__[_snapshot_key(role)] = snap
+  return snap
+
+
+def _snapshot_update(kind, name, value=None, role=None):
+  '''
+  Keep a cached snapshot in step with a write made during this run.
+  kind
+      One of 'user', 'group' or 'member'
+  name
+      User name, group name, or (user, group) tuple for 'member'
+  value
+      The new object, or None if it was deleted
+  role
+      The role whose account was written to
+  '''
+  snap = __context__.get(_snapshot_key(role))
+  if snap is None:
+    return
+  if kind == 'member':
+    user, group = name
+    members = snap['members'].setdefault(group, [])
+    if value and user not in members:
+      members.append(user)
+    elif not value and user in members:
+      members.remove(user)
+    return
+  index = snap[kind + 's']
+  if value is None:
+    index.pop(name, None)
+    if kind == 'group':
+      snap['members'].pop(name, None)
+    else:
+      for members in snap['members'].itervalues():
+        if name in members:
+          members.remove(name)
+  else:
+    index[name] = value
+    if kind == 'group':
+      snap['members'].setdefault(name, [])
+
+
+def _snapshot_update_policy(group, policy_name, document=None, role=None):
+  '''
+  Keep the inline policies of a group in a cached snapshot in step with a write made during this
+  run. A document of None means the policy was deleted.
+  '''
+  snap = __context__.get(_snapshot_key(role))
+  if snap is None or group not in snap['groups']:
+    return
+  policies = [p for p in snap['groups'][group].get('GroupPolicyList', [])
+              if p['PolicyName'] != policy_name]
+  if document is not None:
+    policies.append({'PolicyName': policy_name, 'PolicyDocument': document})
+  snap['groups'][group]['GroupPolicyList'] = policies
 
 # USERS
 
 
-def list_users():
+def iter_users(page_size=None, role=None):
+  '''
+  Yield users one at a time, fetching a page of page_size users at a time.
+  '''
+  for page in _paginate('iam list-users', page_size, role):
+    for user in page['Users']:
+      yield user
+
+
+def list_users(page_size=None, role=None):
   '''
   List users.
   '''
-  out = _run_aws('iam list-users')
-  return out['Users']
+  return [user for user in iter_users(page_size, role)]
 
 
-def create_user(name):
+def create_user(name, role=None):
   '''
   Create a user.
   '''
-  return _run_aws('iam create-user', **{'user-name': name})['User']
+  user = _run_aws('iam create-user', role=role, **{'user-name': name})
+  if user is None:
+    return user
+  _snapshot_update('user', name, user['User'], role)
+  return user['User']
 
 
-def get_user(name):
+def get_user(name, role=None):
   '''
   Get a user.
   '''
-  user = _run_aws('iam get-user', **{'user-name': name})
+  user = _run_aws('iam get-user', role=role, **{'user-name': name})
   if not user:
     return user
   return user['User']
 
 
-def delete_user(name):
+def delete_user(name, role=None):
   '''
   Delete a user.
   '''
-  return _run_aws('iam delete-user', **{'user-name': name})
+  out = _run_aws('iam delete-user', role=role, **{'user-name': name})
+  if out is not None:
+    _snapshot_update('user', name, role=role)
+  return out
 
 
-def update_user(name, **kwargs):
+def update_user(name, role=None, **kwargs):
   '''
   Update a user.
   '''
-  return _run_aws('iam update-user', **{'user-name': name}.update(kwargs))
+  args = {'user-name': name}
+  args.update(kwargs)
+  return _run_aws('iam update-user', role=role, **args)
 
 # GROUPS
 
 
-def list_groups():
+def iter_groups(page_size=None, role=None):
+  '''
+  Yield groups one at a time, fetching a page of page_size groups at a time.
+  '''
+  for page in _paginate('iam list-groups', page_size, role):
+    for group in page['Groups']:
+      yield group
+
+
+def list_groups(page_size=None, role=None):
   '''
   List groups.
   '''
-  return _run_aws('iam list-groups')['Groups']
+  return [group for group in iter_groups(page_size, role)]
 
 
-def create_group(name):
+def create_group(name, role=None):
   '''
   Create a group.
   '''
-  group = _run_aws('iam create-group', **{'group-name': name})
+  group = _run_aws('iam create-group', role=role, **{'group-name': name})
   if group is None:
     return group
+  _snapshot_update('group', name, group['Group'], role)
   return group['Group']
 
 
-def get_group(name):
+def iter_group_members(name, page_size=None, role=None):
   '''
-  Get users in a group.
+  Yield the users in a group one at a time, fetching a page of page_size users at a time.
   '''
-  return _run_aws('iam get-group', **{'group-name': name})
+  for page in _paginate('iam get-group', page_size, role, **{'group-name': name}):
+    for user in page['Users']:
+      yield user
 
 
-def delete_group(name):
+def get_group(name, page_size=None, role=None):
+  '''
+  Get users in a group. Follows truncated results, so Users always holds every member.
+  '''
+  group = None
+  try:
+    for page in _paginate('iam get-group', page_size, role, **{'group-name': name}):
+      if group is None:
+        group = {'Group': page['Group'], 'Users': []}
+      group['Users'].extend(page['Users'])
+  except CommandExecutionError as exc:
+    log.error(exc)
+    return None
+  return group
+
+
+def delete_group(name, role=None):
   '''
   Delete a group.
   '''
-  return _run_aws('iam delete-group', **{'group-name': name})
+  out = _run_aws('iam delete-group', role=role, **{'group-name': name})
+  if out is not None:
+    _snapshot_update('group', name, role=role)
+  return out
 
 
-def update_group(name, new_name):
+def update_group(name, new_name, role=None):
   '''
   Delete a group.
   '''
-  return _run_aws('iam update-group', **{'group-name': name, 'new-group-name': new_name})
+  return _run_aws('iam update-group', role=role,
+                  **{'group-name': name, 'new-group-name': new_name})
 
 # GROUP MEMBERSHIP
 
 
-def add_user_to_group(user, group):
+def add_user_to_group(user, group, retries=None, role=None):
   '''
-  Add a user to a group.
+  Add a user to a group. Returns True/False.
   '''
-  return _run_aws('iam add-user-to-group', **{'user-name': user, 'group-name': group})
+  out = _run_aws('iam add-user-to-group', retries=retries, role=role,
+                 **{'user-name': user, 'group-name': group})
+  if out is None:
+    return False
+  _snapshot_update('member', (user, group), True, role)
+  return True
 
 
-def remove_user_from_group(user, group):
+def remove_user_from_group(user, group, retries=None, role=None):
+  '''
+  Remove a user from a group. Returns True/False.
   '''
-  Remove a user from a group.
+  out = _run_aws('iam remove-user-from-group', retries=retries, role=role,
+                 **{'user-name': user, 'group-name': group})
+  if out is None:
+    return False
+  _snapshot_update('member', (user, group), False, role)
+  return True
+
+# GROUP POLICIES
+
+
+def canonicalize_policy(document):
   '''
-  return _run_aws('iam remove-user-from-group', **{'user-name': user, 'group-name': group})
+  Get a canonical JSON string for a policy document, so equivalent documents compare equal.
+  Accepts a dict, a JSON string or a URL-encoded JSON string. Statements are always a list,
+  single-valued Action/Resource/Principal-style fields are lists, lists are sorted and keys are
+  ordered.
+  '''
+  if isinstance(document, basestring):
+    document = document.strip()
+    if not document.startswith('{'):
+      document = urllib.unquote(document)
+    document = json.loads(document)
+
+  def normalize(value):
+    if isinstance(value, dict):
+      return dict((k, normalize(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+      return sorted((normalize(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+  document = dict(document)
+  statements = document.get('Statement', [])
+  if isinstance(statements, dict):
+    statements = [statements]
+  canonical_statements = []
+  for statement in statements:
+    statement = dict(statement)
+    for field in ('Action', 'NotAction', 'Resource', 'NotResource'):
+      if isinstance(statement.get(field), basestring):
+        statement[field] = [statement[field]]
+    for field in ('Principal', 'NotPrincipal'):
+      if isinstance(statement.get(field), dict):
+        statement[field] = dict((k, [v] if isinstance(v, basestring) else v)
+                                for k, v in statement[field].iteritems())
+    canonical_statements.append(statement)
+  document['Statement'] = canonical_statements
+  return json.dumps(normalize(document), sort_keys=True, separators=(',', ':'))
+
+
+def policy_hash(document):
+  '''
+  Get a hash of the canonical form of a policy document.
+  '''
+  return hashlib.sha256(canonicalize_policy(document)).hexdigest()
+
+
+def list_group_policies(group, page_size=None, role=None):
+  '''
+  List the names of the inline policies of a group.
+  '''
+  try:
+    return [name for page in _paginate('iam list-group-policies', page_size, role,
+                                       **{'group-name': group})
+            for name in page['PolicyNames']]
+  except CommandExecutionError as exc:
+    log.error(exc)
+    return None
+
+
+def get_group_policy(group, policy_name, role=None):
+  '''
+  Get the document of an inline policy of a group.
+  '''
+  policy = _run_aws('iam get-group-policy', role=role,
+                    **{'group-name': group, 'policy-name': policy_name})
+  if policy is None:
+    return policy
+  return json.loads(canonicalize_policy(policy['PolicyDocument']))
+
+
+def put_group_policy(group, policy_name, document, role=None):
+  '''
+  Create or replace an inline policy of a group. Returns True/False.
+  '''
+  document = canonicalize_policy(document)
+  out = _run_aws('iam put-group-policy', role=role,
+                 **{'group-name': group, 'policy-name': policy_name, 'policy-document': document})
+  if out is None:
+    return False
+  _snapshot_update_policy(group, policy_name, json.loads(document), role)
+  return True
+
+
+def delete_group_policy(group, policy_name, role=None):
+  '''
+  Delete an inline policy of a group. Returns True/False.
+  '''
+  out = _run_aws('iam delete-group-policy', role=role,
+                 **{'group-name': group, 'policy-name': policy_name})
+  if out is None:
+    return False
+  _snapshot_update_policy(group, policy_name, role=role)
+  return True
 
 # ACCESS KEYS
 
 
-def list_access_keys(user):
+def list_access_keys(user, role=None):
   '''
   List keys for a user.
   '''
-  keys = _run_aws('iam list-access-keys', **{'user-name': user})
+  keys = _run_aws('iam list-access-keys', role=role, **{'user-name': user})
   if keys is None:
     return keys
   return keys['AccessKeyMetadata']
 
 
-def create_access_key(user):
+def create_access_key(user, role=None):
   '''
   Create an access key for a user.
   '''
-  key = _run_aws('iam create-access-key', **{'user-name': user})
+  key = _run_aws('iam create-access-key', role=role, **{'user-name': user})
   if key is None:
     return key
+  _credential_report_update(user, 1, role)
   return key['AccessKey']
 
 
-def delete_access_key(user, key_id):
+def delete_access_key(user, key_id, role=None):
   '''
   Delete an access key for a user.
   '''
-  return _run_aws('iam delete-access-key', **{'user-name': user, 'access-key-id': key_id})
+  out = _run_aws('iam delete-access-key', role=role,
+                 **{'user-name': user, 'access-key-id': key_id})
+  if out is not None:
+    _credential_report_update(user, -1, role)
+  return out
+
+# USER TEARDOWN
+
+
+def list_signing_certificates(user, role=None):
+  '''
+  List the signing certificates of a user.
+  '''
+  out = _run_aws('iam list-signing-certificates', role=role, **{'user-name': user})
+  if out is None:
+    return out
+  return out['Certificates']
+
+
+def delete_signing_certificate(user, certificate_id, role=None):
+  '''
+  Delete a signing certificate of a user. Returns True/False.
+  '''
+  return _run_aws('iam delete-signing-certificate', role=role,
+                  **{'user-name': user, 'certificate-id': certificate_id}) is not None
+
+
+def list_mfa_devices(user, role=None):
+  '''
+  List the MFA devices of a user.
+  '''
+  out = _run_aws('iam list-mfa-devices', role=role, **{'user-name': user})
+  if out is None:
+    return out
+  return out['MFADevices']
+
+
+def deactivate_mfa_device(user, serial_number, role=None):
+  '''
+  Deactivate an MFA device of a user and detach it from the user. Returns True/False.
+  '''
+  return _run_aws('iam deactivate-mfa-device', role=role,
+                  **{'user-name': user, 'serial-number': serial_number}) is not None
+
+
+def _snapshot_update_user(user, field, key, name, role):
+  '''
+  Drop a deleted inline or managed policy from a user in a cached snapshot.
+  '''
+  snap = __context__.get(_snapshot_key(role))
+  if snap is None or user not in snap['users']:
+    return
+  entry = snap['users'][user]
+  entry[field] = [p for p in entry.get(field, []) if p[key] != name]
+
+
+def delete_user_policy(user, policy_name, role=None):
+  '''
+  Delete an inline policy of a user. Returns True/False.
+  '''
+  out = _run_aws('iam delete-user-policy', role=role,
+                 **{'user-name': user, 'policy-name': policy_name})
+  if out is None:
+    return False
+  _snapshot_update_user(user, 'UserPolicyList', 'PolicyName', policy_name, role)
+  return True
+
+
+def detach_user_policy(user, policy_arn, role=None):
+  '''
+  Detach a managed policy from a user. Returns True/False.
+  '''
+  out = _run_aws('iam detach-user-policy', role=role,
+                 **{'user-name': user, 'policy-arn': policy_arn})
+  if out is None:
+    return False
+  _snapshot_update_user(user, 'AttachedManagedPolicies', 'PolicyArn', policy_arn, role)
+  return True
+
+
+def get_login_profile(user, role=None):
+  '''
+  Get the console login profile of a user. Returns False if the user has none, or None on error.
+  '''
+  out = _run_aws('iam get-login-profile', role=role, not_found=False, **{'user-name': user})
+  if not out:
+    return out
+  return out['LoginProfile']
+
+
+def delete_login_profile(user, role=None):
+  '''
+  Delete the console login profile of a user. Returns True/False.
+  '''
+  return _run_aws('iam delete-login-profile', role=role, **{'user-name': user}) is not None
+
+
+def _user_attachments(user, action, role):
+  '''
+  List what one of the USER_ATTACHMENTS actions would remove from a user: group names, access key
+  ids, certificate ids, MFA serial numbers, policy names or ARNs, or the user name for its login
+  profile. Groups and policies come from the snapshot. Raises CommandExecutionError on error.
+  '''
+  snap = snapshot(role=role)
+  if snap is None:
+    raise CommandExecutionError('Error reading IAM account state')
+  if user not in snap['users']:
+    return []
+  entry = snap['users'][user]
+  if action == 'remove_user_from_group':
+    return sorted(group for group, members in snap['members'].iteritems() if user in members)
+  if action == 'delete_user_policy':
+    return sorted(p['PolicyName'] for p in entry.get('UserPolicyList', []))
+  if action == 'detach_user_policy':
+    return sorted(p['PolicyArn'] for p in entry.get('AttachedManagedPolicies', []))
+  if action == 'delete_login_profile':
+    profile = get_login_profile(user, role)
+    items = None if profile is None else [user] if profile else []
+  else:
+    func, key = {'delete_access_key': (list_access_keys, 'AccessKeyId'),
+                 'delete_signing_certificate': (list_signing_certificates, 'CertificateId'),
+                 'deactivate_mfa_device': (list_mfa_devices, 'SerialNumber')}[action]
+    listed = func(user, role)
+    items = None if listed is None else sorted(obj[key] for obj in listed)
+  if items is None:
+    raise CommandExecutionError('Error listing {0} targets of {1}'.format(action, user))
+  return items
+
+
+def _remove_user_attachment(user, action, target, role):
+  '''
+  Run one of the USER_ATTACHMENTS actions on one target. Returns True/False.
+  '''
+  if action == 'remove_user_from_group':
+    return remove_user_from_group(user, target, role=role)
+  if action == 'delete_access_key':
+    return delete_access_key(user, target, role) is not None
+  if action == 'delete_login_profile':
+    return delete_login_profile(user, role)
+  return {'delete_signing_certificate': delete_signing_certificate,
+          'deactivate_mfa_device': deactivate_mfa_device,
+          'delete_user_policy': delete_user_policy,
+          'detach_user_policy': detach_user_policy}[action](user, target, role)
+
+
+def detach_user(user, concurrency=1, dry_run=False, role=None):
+  '''
+  Remove everything IAM won't delete a user with: its group memberships, access keys, signing
+  certificates, MFA devices, inline and managed policies, and console login profile.
+
+  Each kind is reconciled with nothing through salt_org.reconcile, in USER_ATTACHMENTS order,
+  with a journal per user and kind, so removals that fail are retried by the next call without
+  listing again. Returns a list of (action, reconcile result), and a list of errors for kinds
+  that couldn't be listed; kinds after one that couldn't be listed aren't tried.
+  '''
+  results = []
+  for action in USER_ATTACHMENTS:
+    journal = 'aws_iam/{0}/{1}/{2}'.format(role or 'default', user, action)
+    remove = lambda target, action=action: _remove_user_attachment(user, action, target, role)
+    result = None
+    if not dry_run:
+      result = __salt__['salt_org.resume'](journal, [], None, remove, strict=True,
+                                           concurrency=concurrency)
+    if result is None:
+      try:
+        current = _user_attachments(user, action, role)
+      except CommandExecutionError as exc:
+        return results, [str(exc)]
+      result = __salt__['salt_org.reconcile'](current, [], None, remove, strict=True,
+                                              concurrency=concurrency, dry_run=dry_run,
+                                              journal=None if dry_run else journal)
+    results.append((action, result))
+  return results, []
+
+# CREDENTIAL REPORT
+
+
+def generate_credential_report(role=None):
+  '''
+  Start generating a credential report. Returns the report State: STARTED, INPROGRESS or
+  COMPLETE.
+  '''
+  out = _run_aws('iam generate-credential-report', role=role)
+  if out is None:
+    return None
+  return out['State']
+
+
+def _parse_credential_report(content):
+  '''
+  Index the rows of a base64-encoded credential report CSV by user name, adding an
+  access_key_count field.
+  '''
+  report = {}
+  for row in csv.DictReader(StringIO(base64.b64decode(content))):
+    row['access_key_count'] = len([n for n in ('1', '2')
+                                   if row.get('access_key_{0}_last_rotated'.format(n)) not in
+                                   (None, '', 'N/A')])
+    report[row['user']] = row
+  return report
+
+
+def _fetch_credential_report(timeout, role):
+  '''
+  Generate a credential report, polling for up to timeout seconds, and fetch it. Returns the
+  parsed report and the time AWS generated it, or None.
+  '''
+  deadline = time.time() + timeout
+  while generate_credential_report(role) != 'COMPLETE':
+    if time.time() >= deadline:
+      log.error('Timed out waiting for the IAM credential report')
+      return None
+    time.sleep(CREDENTIAL_REPORT_POLL)
+  out = _run_aws('iam get-credential-report', role=role)
+  if out is None:
+    return None
+  generated = time.time()
+  if out.get('GeneratedTime'):
+    generated = calendar.timegm(time.strptime(out['GeneratedTime'][:19], '%Y-%m-%dT%H:%M:%S'))
+  return _parse_credential_report(out['Content']), generated
+
+
+def credential_report(ttl=CREDENTIAL_REPORT_TTL, timeout=60, refresh=False, role=None):
+  '''
+  Get the account credential report, indexed by user name. Each row has key status, age and
+  last-used data for every user, so access keys can be audited without a call per user.
+
+  The parsed report is cached for ttl seconds; pass refresh=True to fetch a new one. Generation
+  is polled for up to timeout seconds, and threads asking for the same role's report meanwhile
+  wait for that one instead of polling too. Returns None if the report could not be fetched.
+  '''
+  while True:
+    with _credential_report_lock:
+      cached = _credential_report_cache.get(role)
+      if not refresh and cached is not None and time.time() - cached['fetched'] < ttl:
+        return cached['report']
+      inflight = _credential_report_inflight.get(role)
+      if inflight is None:
+        done = _credential_report_inflight[role] = threading.Event()
+        break
+    inflight.wait()
+    # the report just fetched is as new as a refresh would get
+    refresh = False
+  try:
+    fetched = _fetch_credential_report(timeout, role)
+    if fetched is None:
+      return None
+    report, generated = fetched
+    with _credential_report_lock:
+      _credential_report_cache[role] = {'report': report, 'fetched': time.time(),
+                                        'generated': generated}
+    return report
+  finally:
+    with _credential_report_lock:
+      del _credential_report_inflight[role]
+    done.set()
+
+
+def credential_report_fresh(max_age=CREDENTIAL_REPORT_MAX_AGE, role=None):
+  '''
+  Find if the cached credential report was generated by AWS within max_age seconds, so that a
+  user it shows without access keys can be trusted to have none. AWS hands back its last report
+  for up to four hours, so a report fetched just now can still be stale.
+  '''
+  with _credential_report_lock:
+    cached = _credential_report_cache.get(role)
+  return cached is not None and time.time() - cached['generated'] < max_age
+
+
+def _credential_report_update(user, delta, role=None):
+  '''
+  Keep a cached credential report in step with access keys created or deleted in this process.
+  '''
+  with _credential_report_lock:
+    report = _credential_report_cache.get(role, {}).get('report')
+    if report is not None and user in report:
+      report[user]['access_key_count'] = max(0, report[user]['access_key_count'] + delta)
@@ -2,13 +2,103 @@
 Module to manage repo hooks
 
 See http://developer.github.com/v3/repos/hooks
+
+GitHub masks secret config fields such as auth_token in the hooks it returns, so they can't be
+compared with the desired config. Instead, a fingerprint of each config applied by add or edit is
+kept in the minion cachedir, and the gh_hooks state compares against that.
 '''
 
 import logging
 log = logging.getLogger(__name__)
-import requests
 import json
 import ast
+import hashlib
+import os
+import threading
+
+# Value GitHub returns in place of a secret config field.
+MASK = '********'
+
+# File in the minion cachedir holding the fingerprints of applied hook configs.
+FINGERPRINT_FILE = 'gh_hooks_fingerprints.json'
+_fingerprints = None
+_fingerprints_lock = threading.Lock()
+
+
+def _fingerprint_file():
+  opts = globals().get('__opts__') or {}
+  if not opts.get('cachedir'):
+    return None
+  return os.path.join(opts['cachedir'], FINGERPRINT_FILE)
+
+
+def _load_fingerprints():
+  '''
+  Get the {repo/hook id: fingerprint} dict, reading it from the cachedir on first use. Call with
+  _fingerprints_lock held.
+  '''
+  global _fingerprints
+  if _fingerprints is None:
+    _fingerprints = {}
+    path = _fingerprint_file()
+    if path and os.path.isfile(path):
+      try:
+        with open(path) as f:
+          _fingerprints = json.load(f)
+      except (IOError, ValueError) as e:
+        log.warning('Ignoring unreadable {0}: {1}'.format(path, e))
+  return _fingerprints
+
+
+def _save_fingerprints():
+  '''
+  Write the fingerprints back to the cachedir, readable only by the minion since they are
+  derived from secrets. Call with _fingerprints_lock held.
+  '''
+  path = _fingerprint_file()
+  if not path:
+    return
+  try:
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(_fingerprints, f)
+    os.rename(path + '.tmp', path)
+  except (IOError, OSError) as e:
+    log.warning('Could not write {0}: {1}'.format(path, e))
+
+
+def fingerprint(config):
+  '''
+  Get a hash of a hook config, independent of key order.
+  '''
+  return hashlib.sha256(json.dumps(config, sort_keys=True)).hexdigest()
+
+
+def masked_fields(config):
+  '''
+  Get the names of the fields GitHub masked in a hook config it returned.
+  '''
+  return set(key for key, value in config.iteritems() if value == MASK)
+
+
+def applied_fingerprint(repo, hook_id):
+  '''
+  Get the fingerprint of the config last applied to a hook by add or edit, or None if unknown.
+  '''
+  with _fingerprints_lock:
+    return _load_fingerprints().get('{0}/{1}'.format(repo, hook_id))
+
+
+def _record_applied(repo, hook_id, config):
+  with _fingerprints_lock:
+    fingerprints = _load_fingerprints()
+    key = '{0}/{1}'.format(repo, hook_id)
+    if config is None:
+      if fingerprints.pop(key, None) is None:
+        return
+    else:
+      fingerprints[key] = fingerprint(config)
+    _save_fingerprints()
 
 
 def list(token, repo):
@@ -26,8 +116,8 @@ def list(token, repo):
   results = []
   while page == 0 or len(page_results):
     page += 1
-    r = requests.get('https://api.github.com/repos/{}/hooks'.format(repo), auth=(token, ''),
-                     params={'page': page})
+    r = __salt__['gh_api.request']('GET', token, '/repos/{}/hooks'.format(repo),
+                                   params={'page': page})
     if not r.ok:
       log.error('Error making github api request: {} {}'.format(r, r.content))
       return False
@@ -46,8 +136,7 @@ def get(token, repo, hook_id):
 
       sudo salt-call --local gh_hooks.get <token> <owner>/<repo> <hook_id>
   '''
-  r = requests.get('https://api.github.com/repos/{}/hooks/{}'.format(repo, hook_id),
-                   auth=(token, ''))
+  r = __salt__['gh_api.request']('GET', token, '/repos/{}/hooks/{}'.format(repo, hook_id))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
@@ -64,11 +153,11 @@ def remove(token, repo, hook_id):
 
       sudo salt-call --local gh_hooks.remove <token> <repo> <hook_id>
   '''
-  r = requests.delete('https://api.github.com/repos/{}/hooks/{}'.format(repo, hook_id),
-                      auth=(token, ''))
+  r = __salt__['gh_api.request']('DELETE', token, '/repos/{}/hooks/{}'.format(repo, hook_id))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
+  _record_applied(repo, hook_id, None)
   return True
 
 
@@ -88,14 +177,15 @@ def add(token, repo, name, config, events, active=True):
   log.info(type(events))
   payload = {"name": name, "config": config, "events": events, "active": active}
   log.info(json.dumps(payload))
-  r = requests.post('https://api.github.com/repos/{}/hooks'.format(repo),
-                    auth=(token, ''),
-                    data=json.dumps(payload),
-                    headers=headers)
+  r = __salt__['gh_api.request']('POST', token, '/repos/{}/hooks'.format(repo),
+                                 data=json.dumps(payload),
+                                 headers=headers)
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
-  return json.loads(r.content)
+  hook = json.loads(r.content)
+  _record_applied(repo, hook['id'], config)
+  return hook
 
 
 def edit(token, repo, hook_id, patch):
@@ -110,11 +200,12 @@ def edit(token, repo, hook_id, patch):
   '''
   headers = {'Content-type': 'application/json'}
   log.info(json.dumps(patch))
-  r = requests.patch('https://api.github.com/repos/{}/hooks/{}'.format(repo, hook_id),
-                     auth=(token, ''),
-                     data=json.dumps(patch),
-                     headers=headers)
+  r = __salt__['gh_api.request']('PATCH', token, '/repos/{}/hooks/{}'.format(repo, hook_id),
+                                 data=json.dumps(patch),
+                                 headers=headers)
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
+  if 'config' in patch:
+    _record_applied(repo, hook_id, patch['config'])
   return json.loads(r.content)
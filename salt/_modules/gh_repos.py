@@ -6,7 +6,6 @@ See http://developer.github.com/v3/repos/
 
 import logging
 log = logging.getLogger(__name__)
-import requests
 import json
 
 
@@ -25,8 +24,8 @@ def list_org(token, org, type=all):
   results = []
   while page == 0 or len(page_results):
     page += 1
-    r = requests.get('https://api.github.com/orgs/{}/repos'.format(org), auth=(token, ''),
-                     params={'page': page, 'type': type})
+    r = __salt__['gh_api.request']('GET', token, '/orgs/{}/repos'.format(org),
+                                   params={'page': page, 'type': type})
     if not r.ok:
       log.error('Error making github api request: {} {}'.format(r, r.content))
       return False
@@ -2,12 +2,91 @@
 Module to manage teams in a Github org.
 
 See http://developer.github.com/v3/orgs/teams/.
+
+The gh_team state records what it last converged each team to in the minion cachedir: the id
+of the team, a fingerprint of the desired spec, the ETag of the team and the ETags of the pages
+of its members and repos listings. While none has changed, conditional requests are enough to
+tell the team is still converged.
 '''
 
 import logging
 log = logging.getLogger(__name__)
-import requests
 import json
+import hashlib
+import os
+import threading
+import time
+from salt.exceptions import CommandExecutionError
+
+# Largest page GitHub returns for a listing.
+PAGE_SIZE = 100
+
+# File in the minion cachedir holding what each team was last converged to.
+CONVERGED_FILE = 'gh_team_converged.json'
+_converged = None
+_converged_lock = threading.Lock()
+
+
+def _converged_file():
+  opts = globals().get('__opts__') or {}
+  if not opts.get('cachedir'):
+    return None
+  return os.path.join(opts['cachedir'], CONVERGED_FILE)
+
+
+def _load_converged():
+  '''
+  Get the {org/team name: record} dict, reading it from the cachedir on first use. Call with
+  _converged_lock held.
+  '''
+  global _converged
+  if _converged is None:
+    _converged = {}
+    path = _converged_file()
+    if path and os.path.isfile(path):
+      try:
+        with open(path) as f:
+          _converged = json.load(f)
+      except (IOError, ValueError) as e:
+        log.warning('Ignoring unreadable {0}: {1}'.format(path, e))
+  return _converged
+
+
+def _save_converged():
+  '''
+  Write the records back to the cachedir. Call with _converged_lock held.
+  '''
+  path = _converged_file()
+  if not path:
+    return
+  try:
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(_converged, f)
+    os.rename(path + '.tmp', path)
+  except (IOError, OSError) as e:
+    log.warning('Could not write {0}: {1}'.format(path, e))
+
+
+def _list_pages(token, url, etags=None):
+  '''
+  Get every page of a GitHub listing, stopping at the first page that isn't full. Returns None
+  on error. If etags is a list, the ETag of each page is appended to it.
+  '''
+  page = 0
+  results = []
+  while True:
+    page += 1
+    r = __salt__['gh_api.request']('GET', token, url, params={'page': page, 'per_page': PAGE_SIZE})
+    if not r.ok:
+      log.error('Error making github api request: {} {}'.format(r, r.content))
+      return None
+    if etags is not None:
+      etags.append(r.headers.get('ETag'))
+    page_results = json.loads(r.content)
+    results = results + page_results
+    if len(page_results) < PAGE_SIZE:
+      return results
 
 
 def list(token, org):
@@ -20,11 +99,10 @@ def list(token, org):
 
       sudo salt-call --local gh_team.list <token> <org>
   '''
-  r = requests.get('https://api.github.com/orgs/{}/teams'.format(org), auth=(token, ''))
-  if not r.ok:
-    log.error('Error making github api request: {}'.format(r))
+  teams = _list_pages(token, '/orgs/{}/teams'.format(org))
+  if teams is None:
     return False
-  return json.loads(r.content)
+  return teams
 
 
 def add(token, org, name, permission, repos=[]):
@@ -39,10 +117,9 @@ def add(token, org, name, permission, repos=[]):
   '''
   headers = {'Content-type': 'application/json'}
   payload = {"name": name, "permission": permission, "repo_names": repos}
-  r = requests.post('https://api.github.com/orgs/{}/teams'.format(org),
-                    auth=(token, ''),
-                    data=json.dumps(payload),
-                    headers=headers)
+  r = __salt__['gh_api.request']('POST', token, '/orgs/{}/teams'.format(org),
+                                 data=json.dumps(payload),
+                                 headers=headers)
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
@@ -59,13 +136,116 @@ def get(token, team_id):
 
       sudo salt-call --local gh_team.get <token> <team id>
   '''
-  r = requests.get('https://api.github.com/teams/{}'.format(team_id), auth=(token, ''))
+  r = __salt__['gh_api.request']('GET', token, '/teams/{}'.format(team_id))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
   return json.loads(r.content)
 
 
+def get_if_modified(token, team_id, etag=None):
+  '''
+  Get information about a team unless its ETag is still etag, which GitHub answers without
+  counting against the rate limit. Returns {'modified': False} if unchanged,
+  {'modified': True, 'team': team, 'etag': new etag} if not, or None on error.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local gh_team.get_if_modified <token> <team id> <etag>
+  '''
+  headers = {'If-None-Match': etag} if etag else None
+  r = __salt__['gh_api.request']('GET', token, '/teams/{}'.format(team_id), headers=headers)
+  if r.status_code == 304:
+    return {'modified': False}
+  if not r.ok:
+    log.error('Error making github api request: {} {}'.format(r, r.content))
+    return None
+  return {'modified': True, 'team': json.loads(r.content), 'etag': r.headers.get('ETag')}
+
+
+def listing_etags(token, team_id, listing):
+  '''
+  Get the ETag of each page of a team's members or repos listing, so listing_modified can later
+  tell whether it changed. Returns None on error.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local gh_team.listing_etags <token> <team id> members
+  '''
+  etags = []
+  if _list_pages(token, '/teams/{}/{}'.format(team_id, listing), etags) is None:
+    return None
+  return etags
+
+
+def listing_modified(token, team_id, listing, etags):
+  '''
+  Find if a team's members or repos listing changed since listing_etags returned etags, with a
+  conditional request per page, which GitHub answers without counting against the rate limit
+  while the page is unchanged. Stops at the first changed page. Returns True/False, or None on
+  error.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local gh_team.listing_modified <token> <team id> members '[<etag>, ...]'
+  '''
+  if not etags or None in etags:
+    return True
+  for page, etag in enumerate(etags, 1):
+    r = __salt__['gh_api.request']('GET', token, '/teams/{}/{}'.format(team_id, listing),
+                                   params={'page': page, 'per_page': PAGE_SIZE},
+                                   headers={'If-None-Match': etag})
+    if r.status_code == 304:
+      continue
+    if not r.ok:
+      log.error('Error making github api request: {} {}'.format(r, r.content))
+      return None
+    return True
+  return False
+
+
+def fingerprint(spec):
+  '''
+  Get a hash of a desired team spec, independent of key and list order.
+  '''
+  spec = dict((k, sorted(v) if isinstance(v, (tuple, type([]))) else v)
+              for k, v in spec.iteritems())
+  return hashlib.sha256(json.dumps(spec, sort_keys=True)).hexdigest()
+
+
+def converged(org, name):
+  '''
+  Get what a team was last converged to by the gh_team state, or None if unknown: a dict of
+  the team id, the fingerprint of its spec, its ETag, the page ETags of its members and repos
+  listings by listing, and the time it was recorded.
+  '''
+  with _converged_lock:
+    return _load_converged().get('{0}/{1}'.format(org, name))
+
+
+def record_converged(org, name, team_id=None, spec=None, etag=None, listings=None):
+  '''
+  Record that a team has converged to the spec with the given fingerprint and now has the given
+  ETag and listings page ETags, or forget what it last converged to if team_id is None.
+  '''
+  with _converged_lock:
+    records = _load_converged()
+    key = '{0}/{1}'.format(org, name)
+    if team_id is None:
+      if records.pop(key, None) is None:
+        return
+    else:
+      records[key] = {'id': team_id, 'spec': spec, 'etag': etag, 'listings': listings or {},
+                      'at': time.time()}
+    _save_converged()
+
+
 def remove(token, team_id):
   '''
   Remove a team from a Github organization
@@ -76,7 +256,7 @@ def remove(token, team_id):
 
       sudo salt-call --local gh_team.remove <token> <team id>
   '''
-  r = requests.delete('https://api.github.com/teams/{}'.format(team_id), auth=(token, ''))
+  r = __salt__['gh_api.request']('DELETE', token, '/teams/{}'.format(team_id))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
@@ -95,10 +275,9 @@ def edit(token, team_id, name, permission):
   '''
   headers = {'Content-type': 'application/json'}
   payload = {"name": name, "permission": permission}
-  r = requests.patch('https://api.github.com/teams/{}'.format(team_id),
-                     auth=(token, ''),
-                     data=json.dumps(payload),
-                     headers=headers)
+  r = __salt__['gh_api.request']('PATCH', token, '/teams/{}'.format(team_id),
+                                 data=json.dumps(payload),
+                                 headers=headers)
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
@@ -115,17 +294,14 @@ def list_members(token, team_id):
 
       sudo salt-call --local gh_team.list_members <token> <team id>
   '''
-  r = requests.get('https://api.github.com/teams/{}/members'.format(team_id),
-                   auth=(token, ''))
-  if not r.ok:
-    log.error('Error making github api request: {} {}'.format(r, r.content))
-    return None
-  return json.loads(r.content)
+  return _list_pages(token, '/teams/{}/members'.format(team_id))
 
 
 def get_membership(token, team_id, username):
   '''
-  Get a user's membership with a team.
+  Get a user's membership with a team, or None if they aren't a member. Raises
+  CommandExecutionError if GitHub can't tell, so a failed check isn't mistaken for no
+  membership.
 
   CLI Example:
 
@@ -133,11 +309,13 @@ def get_membership(token, team_id, username):
 
       sudo salt-call --local gh_team.get_membership <token> <team id> <username>
   '''
-  r = requests.get('https://api.github.com/teams/{}/memberships/{}'.format(team_id, username),
-                   auth=(token, ''))
-  if not r.ok:
-    log.error('Error making github api request: {} {}'.format(r, r.content))
+  r = __salt__['gh_api.request']('GET', token, '/teams/{}/memberships/{}'.format(team_id, username))
+  if r.status_code == 404:
+    # not a member
     return None
+  if not r.ok:
+    raise CommandExecutionError('Error getting membership of {0} in team {1}: {2} {3}'.format(
+        username, team_id, r.status_code, r.content))
   return json.loads(r.content)
 
 
@@ -151,8 +329,7 @@ def add_membership(token, team_id, username):
 
       sudo salt-call --local gh_team.add_membership <token> <team id> <username>
   '''
-  r = requests.put('https://api.github.com/teams/{}/memberships/{}'.format(team_id, username),
-                   auth=(token, ''))
+  r = __salt__['gh_api.request']('PUT', token, '/teams/{}/memberships/{}'.format(team_id, username))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return None
@@ -169,8 +346,8 @@ def remove_membership(token, team_id, username):
 
       sudo salt-call --local gh_team.remove_membership <token> <team id> <username>
   '''
-  r = requests.delete('https://api.github.com/teams/{}/memberships/{}'.format(team_id, username),
-                      auth=(token, ''))
+  r = __salt__['gh_api.request']('DELETE', token,
+                                 '/teams/{}/memberships/{}'.format(team_id, username))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
@@ -187,17 +364,13 @@ def list_repos(token, team_id):
 
       sudo salt-call --local gh_team.list_repos <token> <team id>
   '''
-  r = requests.get('https://api.github.com/teams/{}/repos'.format(team_id),
-                   auth=(token, ''))
-  if not r.ok:
-    log.error('Error making github api request: {} {}'.format(r, r.content))
-    return None
-  return json.loads(r.content)
+  return _list_pages(token, '/teams/{}/repos'.format(team_id))
 
 
 def get_repo(token, team_id, repo):
   '''
-  Find if a repo belongs to a team. Returns True/False.
+  Find if a repo belongs to a team. Returns True/False. Raises CommandExecutionError if GitHub
+  can't tell, so a failed check isn't mistaken for the repo not belonging to the team.
 
   CLI Example:
 
@@ -205,9 +378,13 @@ def get_repo(token, team_id, repo):
 
       sudo salt-call --local gh_team.get_repo <token> <team id> <Org/repo>
   '''
-  r = requests.get('https://api.github.com/teams/{}/repos/{}'.format(team_id, repo),
-                   auth=(token, ''))
-  return r.status_code == 204
+  r = __salt__['gh_api.request']('GET', token, '/teams/{}/repos/{}'.format(team_id, repo))
+  if r.status_code == 204:
+    return True
+  if r.status_code == 404:
+    return False
+  raise CommandExecutionError('Error checking repo {0} of team {1}: {2} {3}'.format(
+      repo, team_id, r.status_code, r.content))
 
 
 def add_repo(token, team_id, repo):
@@ -220,8 +397,7 @@ def add_repo(token, team_id, repo):
 
       sudo salt-call --local gh_team.add_repo <token> <team id> <Org/repo>
   '''
-  r = requests.put('https://api.github.com/teams/{}/repos/{}'.format(team_id, repo),
-                   auth=(token, ''))
+  r = __salt__['gh_api.request']('PUT', token, '/teams/{}/repos/{}'.format(team_id, repo))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
@@ -238,8 +414,7 @@ def remove_repo(token, team_id, repo):
 
       sudo salt-call --local gh_team.remove_repo <token> <team id> <Org/repo>
   '''
-  r = requests.delete('https://api.github.com/teams/{}/repos/{}'.format(team_id, repo),
-                      auth=(token, ''))
+  r = __salt__['gh_api.request']('DELETE', token, '/teams/{}/repos/{}'.format(team_id, repo))
   if not r.ok:
     log.error('Error making github api request: {} {}'.format(r, r.content))
     return False
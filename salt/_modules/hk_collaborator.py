@@ -6,9 +6,146 @@ See https://devcenter.heroku.com/articles/platform-api-reference#collaborator
 
 import logging
 log = logging.getLogger(__name__)
-import requests
 import json
+import threading
+import time
 import urllib
+from salt.exceptions import CommandExecutionError
+
+API_URL = 'https://api.heroku.com'
+
+# Largest page Heroku will return for a ranged list request.
+PAGE_SIZE = 1000
+
+# Heroku gives each token a budget of RATE_LIMIT requests that refills at RATE_LIMIT_REFILL
+# requests per second. A 429 response is retried up to RATE_LIMIT_RETRIES times.
+RATE_LIMIT = 4500
+RATE_LIMIT_REFILL = RATE_LIMIT / 3600.0
+RATE_LIMIT_RETRIES = 10
+
+# Seconds to wait for Heroku to respond before giving up on a request.
+REQUEST_TIMEOUT = 30
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limits = {}
+
+
+class _RateLimit(object):
+
+  '''
+  Client-side estimate of a token's remaining request budget, shared by every thread using the
+  token. Each request reserves one unit of budget before it is sent; when the budget is spent,
+  callers are queued and wait for it to refill. The estimate is corrected from the
+  RateLimit-Remaining header of every response.
+  '''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.remaining = None
+    self.updated = time.time()
+
+  def acquire(self):
+    with self.lock:
+      if self.remaining is None:
+        # budget unknown until the first response
+        return
+      now = time.time()
+      available = min(RATE_LIMIT, self.remaining + (now - self.updated) * RATE_LIMIT_REFILL)
+      wait = max(0, (1 - available) / RATE_LIMIT_REFILL)
+      self.remaining = available + wait * RATE_LIMIT_REFILL - 1
+      self.updated = now + wait
+    if wait > 0:
+      log.info('Heroku rate limit reached, waiting {0:.1f}s'.format(wait))
+      time.sleep(wait)
+
+  def update(self, remaining):
+    if remaining is None:
+      return
+    with self.lock:
+      self.remaining = float(remaining)
+      self.updated = time.time()
+
+
+def _get_rate_limit(token):
+  '''
+  Get the rate limit tracker for a token.
+  '''
+  with _session_lock:
+    return _rate_limits.setdefault(token, _RateLimit())
+
+
+def _get_session():
+  '''
+  Get the keep-alive session shared by every Heroku request, creating it on first use.
+  requests is imported here rather than at load time to keep module loading fast.
+  '''
+  global _session
+  with _session_lock:
+    if _session is None:
+      import requests
+      _session = requests.Session()
+      _session.headers.update({'Accept': 'application/vnd.heroku+json; version=3',
+                               'Content-type': 'application/json'})
+    return _session
+
+
+def _request(method, token, path, headers=None, **kwargs):
+  '''
+  Make a request against the Heroku API using the shared session, pacing requests to stay
+  within the token's rate limit and retrying those rejected with 429 Too Many Requests.
+  Requests go through the heroku circuit breaker (see salt_org.guard). Reads are shared with
+  other processes on the host for a short time (see salt_org.cached); writes clear them.
+  '''
+  request_headers = {'Authorization': 'Bearer ' + token}
+  request_headers.update(headers or {})
+  kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+  url = '{}/{}'.format(API_URL, urllib.pathname2url(path))
+
+  def fetch():
+    rate_limit = _get_rate_limit(token)
+    attempt = 0
+    while True:
+      rate_limit.acquire()
+      r = __salt__['salt_org.guard'](
+          'heroku', lambda: _get_session().request(method, url, headers=request_headers, **kwargs),
+          lambda r: r.status_code >= 500)
+      if r.status_code == 429:
+        rate_limit.update(0)
+      else:
+        rate_limit.update(r.headers.get('RateLimit-Remaining'))
+      if r.status_code != 429 or attempt >= RATE_LIMIT_RETRIES:
+        return r
+      attempt += 1
+
+  if method != 'GET':
+    r = fetch()
+    __salt__['salt_org.cache_clear']('heroku')
+    return r
+  key = json.dumps([method, url, request_headers, kwargs.get('params')], sort_keys=True)
+  return __salt__['salt_org.cached_response']('heroku', key, fetch)
+
+
+def _paginate(token, path, page_size=PAGE_SIZE):
+  '''
+  Yield every item of a Heroku list, requesting pages of page_size items and following the
+  Next-Range header of each 206 Partial Content response.
+  '''
+  next_range = 'id ..; max={}'.format(page_size)
+  while next_range:
+    r = _request('GET', token, path, headers={'Range': next_range})
+    if not r.ok:
+      raise CommandExecutionError('Error making Heroku API request: {} {}'.format(r, r.content))
+    for item in json.loads(r.content):
+      yield item
+    next_range = r.headers.get('Next-Range') if r.status_code == 206 else None
+
+
+def iter_list(token, app, page_size=PAGE_SIZE):
+  '''
+  Yield the collaborators for a Heroku app one at a time, a page at a time.
+  '''
+  return _paginate(token, 'apps/{}/collaborators'.format(app), page_size)
 
 
 def list(token, app):
@@ -22,13 +159,21 @@ def list(token, app):
 
       sudo salt-call --local hk_collaborators.list <token> <app>
   '''
-  r = requests.get('https://api.heroku.com/{}'.format(urllib.pathname2url(
-      'apps/{}/collaborators'.format(app))),
-      headers={'Authorization': 'Bearer ' + token,
-               'Accept': 'application/vnd.heroku+json; version=3'})
-  if not r.ok:
-    raise CommandExecutionError('Error making Heroku API request: {}'.format(r))
-  return json.loads(r.content)
+  return [collaborator for collaborator in iter_list(token, app)]
+
+
+def list_apps(token):
+  '''
+  List all Heroku apps the token has access to.
+  See https://devcenter.heroku.com/articles/platform-api-reference#app-list.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local hk_collaborator.list_apps <token>
+  '''
+  return [app for app in _paginate(token, 'apps')]
 
 
 def create(token, app, email):
@@ -42,14 +187,8 @@ def create(token, app, email):
 
       sudo salt-call --local hk_collaborators.add <token> <app> <email>
   '''
-  headers = {'Content-type': 'application/json',
-             'Authorization': 'Bearer ' + token,
-             'Accept': 'application/vnd.heroku+json; version=3'}
   payload = {"user": email}
-  r = requests.post('https://api.heroku.com/{}'.format(urllib.pathname2url(
-      'apps/{}/collaborators'.format(app))),
-      data=json.dumps(payload),
-      headers=headers)
+  r = _request('POST', token, 'apps/{}/collaborators'.format(app), data=json.dumps(payload))
   if not r.ok:
     raise CommandExecutionError('Error making Heroku API request: {} {}'.format(r, r.content))
   return json.loads(r.content)
@@ -65,10 +204,7 @@ def delete(token, app, email):
 
       sudo salt-call --local hk_collaborators.remove <token> <app> <email>
   '''
-  r = requests.delete('https://api.heroku.com/{}'.format(urllib.pathname2url(
-      'apps/{}/collaborators/{}'.format(app, email))),
-      headers={'Authorization': 'Bearer ' + token,
-               'Accept': 'application/vnd.heroku+json; version=3'})
+  r = _request('DELETE', token, 'apps/{}/collaborators/{}'.format(app, email))
   if not r.ok:
     raise CommandExecutionError('Error making Heroku API request: {} {}'.format(r, r.content))
   return json.loads(r.content)
@@ -0,0 +1,1038 @@
+'''
+Helpers shared by the salt-org states.
+
+reconcile brings a remote set (team members, repos, collaborators, group members) in line with
+a desired set, so every state diffs and applies changes the same way.
+
+guard runs provider requests through a circuit breaker shared by every module that talks to that
+provider. Once too many recent requests have failed the circuit opens, and further requests fail
+immediately instead of each waiting on the outage. After a cooldown one probe request is let
+through; if it succeeds the circuit closes again. The breaker can be tuned in the minion config
+or pillar:
+
+.. code-block:: yaml
+
+    salt_org:
+      circuit:
+        error_rate: 0.5     # fraction of recent requests that must fail to open the circuit
+        window: 20          # number of recent requests considered
+        min_calls: 10       # requests needed in the window before the circuit can open
+        cooldown: 30        # seconds to wait before probing an open circuit
+        heroku:             # per-provider overrides
+          cooldown: 60
+
+cached shares read results between the salt-call runs and minions on a host, so jobs that
+overlap don't each fetch the same data. Results are kept in files under the minion cachedir for
+a short time. An advisory lock on each key means only one process fetches it at a time, and the
+others wait for its result. A write through a provider's module clears that provider's cache.
+Identical reads made at the same time by parallel states in one process are coalesced into a
+single request, whether or not the cache is on.
+
+.. code-block:: yaml
+
+    salt_org:
+      cache:
+        ttl: 30             # seconds to reuse a read; 0 turns the cache off
+
+in_shard splits an org between several minions, so each reconciles a disjoint share of the
+teams, repos, apps, groups and users in parallel. Every name falls in one shard, chosen by a hash
+of the name, and the states, absent ones included, skip any name outside the minion's own
+shard. Give each minion its index, from 0 to count - 1, in its config or pillar; the org_shards
+runner merges the results of all the minions into one report.
+
+.. code-block:: yaml
+
+    salt_org:
+      shard:
+        index: 0
+        count: 4
+
+profile_state runs one salt-org state under cProfile, including the threads it starts through
+map_concurrent, and reports where the time went and how many requests it made to each provider.
+
+A reconcile given a journal key writes the changes it plans to a journal under the minion
+cachedir before making them, and marks each off as it succeeds. If some fail, resume with the same
+key replays just the outstanding changes on the next run, without listing and diffing again.
+'''
+
+import logging
+log = logging.getLogger(__name__)
+import base64
+import collections
+import copy
+import errno
+import fcntl
+import gc
+import hashlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from salt.exceptions import CommandExecutionError
+
+CIRCUIT_DEFAULTS = {'error_rate': 0.5, 'window': 20, 'min_calls': 10, 'cooldown': 30}
+
+CACHE_TTL = 30
+# Directory under the minion cachedir holding cached reads, one subdirectory per provider.
+CACHE_DIR = 'salt_org'
+# File in each provider's cache directory naming its current generation. cache_clear changes it,
+# so a read fetched before a clear is never served after it, even if it is written afterwards.
+CACHE_GENERATION = 'generation'
+# Directory under CACHE_DIR holding the journals of reconciles that haven't completed.
+JOURNAL_DIR = 'journal'
+# Seconds after which an unfinished journal is discarded rather than resumed, and number of
+# times it is resumed before that, so the remote set is listed and diffed again even while some
+# operation keeps failing.
+JOURNAL_MAX_AGE = 3600
+JOURNAL_MAX_REPLAYS = 2
+
+# Circuit breakers by provider, fetches in flight by key, requests made by provider, and the
+# profiles of the threads of a profile_state run, kept across module reloads so every module
+# shares them.
+try:
+  _circuits
+except NameError:
+  _circuits = {}
+  _circuits_lock = threading.Lock()
+  _inflight = {}
+  _inflight_lock = threading.Lock()
+  _outbound = collections.Counter()
+  _outbound_lock = threading.Lock()
+  _profiles = None
+  _profiles_lock = threading.Lock()
+
+
+class _Circuit(object):
+
+  '''
+  Circuit breaker for one provider. Closed, it lets requests through and remembers whether the
+  last few failed. Open, it rejects them until the cooldown has passed, then goes half-open and
+  lets a single probe through to decide whether to close or open again.
+  '''
+
+  def __init__(self, provider, settings):
+    self.provider = provider
+    self.settings = settings
+    self.lock = threading.Lock()
+    self.results = collections.deque(maxlen=settings['window'])
+    self.state = 'closed'
+    self.opened = None
+    self.probing = False
+
+  def failures(self):
+    return len([ok for ok in self.results if not ok])
+
+  def describe(self):
+    if self.state == 'closed':
+      return '{0} circuit closed'.format(self.provider)
+    retry = max(0, self.opened + self.settings['cooldown'] - time.time())
+    return ('{0} circuit open after {1} of the last {2} requests failed; not calling {0} until '
+            'a probe request succeeds (next probe in {3:.0f}s)').format(
+                self.provider, self.failures(), len(self.results), retry)
+
+  def before(self):
+    with self.lock:
+      if self.state == 'open' and time.time() >= self.opened + self.settings['cooldown']:
+        self.state = 'half-open'
+      if self.state == 'closed':
+        return False
+      if self.state == 'half-open' and not self.probing:
+        self.probing = True
+        return True
+      raise CommandExecutionError(self.describe())
+
+  def after(self, ok, probe):
+    with self.lock:
+      self.results.append(ok)
+      if probe:
+        self.probing = False
+        if ok:
+          log.warning('{0} circuit closed after a successful probe'.format(self.provider))
+          self.state = 'closed'
+          self.results.clear()
+        else:
+          self._open()
+      elif self.state == 'closed' and len(self.results) >= self.settings['min_calls'] and \
+              self.failures() >= self.settings['error_rate'] * len(self.results):
+        self._open()
+
+  def _open(self):
+    self.state = 'open'
+    self.opened = time.time()
+    log.error(self.describe())
+
+
+def _config(key, default):
+  config = globals().get('__salt__', {}).get('config.get')
+  return config('salt_org:' + key, default) if config else default
+
+
+def _circuit_settings(provider):
+  settings = dict(CIRCUIT_DEFAULTS)
+  configured = _config('circuit', {})
+  settings.update((k, v) for k, v in configured.items() if k in CIRCUIT_DEFAULTS)
+  settings.update(configured.get(provider, {}))
+  return settings
+
+
+def _get_circuit(provider):
+  with _circuits_lock:
+    if provider not in _circuits:
+      _circuits[provider] = _Circuit(provider, _circuit_settings(provider))
+    return _circuits[provider]
+
+
+def guard(provider, func, is_failure=None):
+  '''
+  Call func() through the provider's circuit breaker and return its result. Raises
+  CommandExecutionError without calling func while the circuit is open.
+
+  provider
+      Name of the provider, e.g. github or heroku.
+
+  func
+      Callable making one request. Raising an exception counts as a failure.
+
+  is_failure
+      Callable taking func's result and returning True if it counts as a failure, such as a 5xx
+      response.
+  '''
+  circuit = _get_circuit(provider)
+  probe = circuit.before()
+  count_call(provider)
+  try:
+    result = func()
+  except Exception:
+    circuit.after(False, probe)
+    raise
+  circuit.after(not (is_failure and is_failure(result)), probe)
+  return result
+
+
+def circuit_status(provider):
+  '''
+  Get a provider's circuit breaker state and a readable description of it.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local salt_org.circuit_status github
+  '''
+  circuit = _get_circuit(provider)
+  with circuit.lock:
+    return {'state': circuit.state,
+            'failures': circuit.failures(),
+            'calls': len(circuit.results),
+            'comment': circuit.describe()}
+
+
+def circuit_open(provider):
+  '''
+  Get the description of a provider's circuit if it is open and not due a probe, or None, so a
+  state can fail at once instead of waiting on a request.
+  '''
+  circuit = _get_circuit(provider)
+  with circuit.lock:
+    if circuit.state == 'open' and time.time() < circuit.opened + circuit.settings['cooldown']:
+      return circuit.describe()
+  return None
+
+
+def run_state(ret, provider, func):
+  '''
+  Run the body of a state, func(), which fills in and returns the state return ret. If the
+  provider's circuit is open, ret fails at once instead of waiting on requests that would fail
+  too. A CommandExecutionError raised by func, such as the circuit opening part way through,
+  fails ret rather than escaping the state, keeping the changes already recorded.
+  '''
+  circuit = circuit_open(provider)
+  if circuit is not None:
+    ret['result'] = False
+    ret['comment'] = circuit
+    return ret
+  try:
+    return func()
+  except CommandExecutionError as exc:
+    ret['result'] = False
+    ret['comment'] = '; '.join([c for c in [ret['comment']] if c] + [str(exc)])
+    return ret
+
+
+def _diff(current, desired, strict):
+  '''
+  Walk an iterable of current items once and return the sorted (to_add, to_remove) lists, so
+  paged listings can be diffed as they stream in.
+  '''
+  desired = set(desired)
+  seen = set()
+  to_remove = set()
+  for item in current:
+    if item in desired:
+      seen.add(item)
+    elif strict:
+      to_remove.add(item)
+  return sorted(desired - seen), sorted(to_remove)
+
+
+def _call(func, item):
+  '''
+  Call func(item), returning None on success or an error message on failure. A falsy return
+  value counts as a failure, as do exceptions.
+  '''
+  try:
+    if func(item):
+      return None
+    return 'call failed'
+  except Exception as exc:
+    return str(exc) or exc.__class__.__name__
+
+
+def map_concurrent(func, items, concurrency=1):
+  '''
+  Call func on each item, on at most concurrency threads, and return the results in order. If
+  any call raises, the first exception is raised once every thread has finished.
+  '''
+  items = [item for item in items]
+  if concurrency <= 1 or len(items) <= 1:
+    return [func(item) for item in items]
+  # plain threads rather than a ThreadPool, whose close/join waits up to 0.1s for its
+  # housekeeping thread on every call
+  results = [None] * len(items)
+  errors = []
+  work = iter(enumerate(items))
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      with lock:
+        try:
+          index, item = next(work)
+        except StopIteration:
+          return
+      try:
+        results[index] = func(item)
+      except Exception:
+        errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=_profiled(worker))
+             for _ in range(min(concurrency, len(items)))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if len(errors):
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return results
+
+
+def reconcile(current, desired, add, remove, strict=False, concurrency=1, batch_size=None,
+              continue_on_error=True, dry_run=False, journal=None):
+  '''
+  Bring a remote set in line with a desired set.
+
+  current
+      Iterable of the items currently present. It is consumed once, so it may be a generator
+      that pages through a listing.
+
+  desired
+      Iterable of the items that should be present.
+
+  add, remove
+      Callables taking one item. A truthy return value means success; a falsy one or an
+      exception means failure.
+
+  strict
+      Remove current items that aren't desired. False by default.
+
+  concurrency
+      Number of add/remove calls to run at once. 1 by default.
+
+  batch_size
+      Apply changes in batches of this many items, one batch after another. All at once by
+      default.
+
+  continue_on_error
+      Keep applying later batches after a failure. True by default; when False, no new batches
+      are started once one has failed.
+
+  dry_run
+      Compute the changes without calling add or remove.
+
+  journal
+      Key of a journal to write the planned changes to before applying them, marking each off
+      as it succeeds. If some fail, a later resume with the same key runs only those still
+      outstanding. The journal is removed once every change has been made. Not kept on dry
+      runs or without a minion cachedir.
+
+  Returns a dict with the items that were added and removed, the items that failed with their
+  error messages, an errors list of readable messages, and timing stats.
+  '''
+  # the desired set is diffed and then hashed for the journal, so it must not be a generator
+  desired = list(desired)
+  started = time.time()
+  to_add, to_remove = _diff(current, desired, strict)
+  diffed = time.time()
+  operations = [('add', item) for item in to_add] + [('remove', item) for item in to_remove]
+  if dry_run:
+    result = {'add': to_add, 'remove': to_remove, 'failed': {'add': {}, 'remove': {}},
+              'errors': []}
+    applied = 0
+    operations = []
+  else:
+    writer = None
+    if journal is not None:
+      writer = _Journal.plan(journal, _journal_spec(desired, strict), operations)
+    result, applied = _apply(operations, {'add': add, 'remove': remove}, concurrency,
+                             batch_size, continue_on_error, writer)
+  result['stats'] = {'to_add': len(to_add),
+                     'to_remove': len(to_remove),
+                     'added': len(result['add']),
+                     'removed': len(result['remove']),
+                     'failed': len(result['errors']),
+                     'skipped': len(operations) - applied,
+                     'diff_seconds': diffed - started,
+                     'apply_seconds': time.time() - diffed}
+  log.debug('reconcile stats: {0}'.format(result['stats']))
+  return result
+
+
+def _apply(operations, funcs, concurrency, batch_size, continue_on_error, journal):
+  '''
+  Run (action, item) operations in batches, marking each off in the journal, if any, once it
+  succeeds. Returns the reconcile result without stats, and the number of operations run.
+  '''
+  result = {'add': [], 'remove': [], 'failed': {'add': {}, 'remove': {}}, 'errors': []}
+
+  def run(operation):
+    error = _call(funcs[operation[0]], operation[1])
+    if error is None and journal is not None:
+      journal.done(operation)
+    return error
+
+  batch_size = batch_size or len(operations) or 1
+  applied = 0
+  for start in range(0, len(operations), batch_size):
+    batch = operations[start:start + batch_size]
+    errors = map_concurrent(run, batch, concurrency)
+    applied += len(batch)
+    for (action, item), error in zip(batch, errors):
+      if error is None:
+        result[action].append(item)
+      else:
+        result['failed'][action][item] = error
+        result['errors'].append('Error running {0} for {1}: {2}'.format(action, item, error))
+    if len(result['errors']) and not continue_on_error:
+      break
+  if journal is not None:
+    # keep the journal only while some operations are outstanding
+    journal.close(complete=not result['errors'] and applied == len(operations))
+  return result, applied
+
+
+def _journal_path(key):
+  opts = globals().get('__opts__') or {}
+  if not opts.get('cachedir'):
+    return None
+  return os.path.join(opts['cachedir'], CACHE_DIR, JOURNAL_DIR,
+                      hashlib.sha256(key).hexdigest() + '.jsonl')
+
+
+def _journal_spec(desired, strict):
+  '''
+  Get a hash of what a journal was planned for, so it's only resumed for the same desired set.
+  '''
+  return hashlib.sha256(json.dumps([sorted(set(desired)), bool(strict)])).hexdigest()
+
+
+class _Journal(object):
+
+  '''
+  Append-only log of the operations a reconcile planned, then of each one that completed. The
+  first line holds the plan; every later line marks one operation done or one replay started.
+  '''
+
+  def __init__(self, path, f):
+    self.path = path
+    self.file = f
+    self.lock = threading.Lock()
+
+  @classmethod
+  def plan(cls, key, spec, operations):
+    '''
+    Start a journal for key holding the planned operations, replacing any earlier one. Returns
+    None if it can't be written, in which case the operations are simply run unjournaled.
+    '''
+    path = _journal_path(key)
+    if path is None:
+      return None
+    if not operations:
+      _remove_journal(path)
+      return None
+    try:
+      try:
+        os.makedirs(os.path.dirname(path), 0700)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+      journal = cls(path, os.fdopen(fd, 'w'))
+      journal._write({'key': key, 'spec': spec, 'at': time.time(), 'operations': operations})
+      os.fsync(journal.file.fileno())
+    except (IOError, OSError) as e:
+      log.warning('Could not write journal {0}: {1}'.format(path, e))
+      return None
+    return journal
+
+  @classmethod
+  def open(cls, key):
+    '''
+    Read the journal for key. Returns the journal open for appending, its plan, the operations
+    marked done and the number of earlier replays, or None if there is no readable journal.
+    '''
+    path = _journal_path(key)
+    if path is None or not os.path.isfile(path):
+      return None
+    done = set()
+    replays = 0
+    try:
+      with open(path) as f:
+        plan = json.loads(f.readline())
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # a line cut short by a crash; that operation is simply run again
+            continue
+          if 'replay' in record:
+            replays += 1
+          else:
+            done.add(tuple(record['done']))
+      journal = cls(path, open(path, 'a'))
+    except (IOError, ValueError, KeyError) as e:
+      log.warning('Ignoring unreadable journal {0}: {1}'.format(path, e))
+      _remove_journal(path)
+      return None
+    return journal, plan, done, replays
+
+  def _write(self, record):
+    with self.lock:
+      self.file.write(json.dumps(record) + '\n')
+      self.file.flush()
+
+  def done(self, operation):
+    self._append({'done': operation})
+
+  def replay(self):
+    self._append({'replay': time.time()})
+
+  def _append(self, record):
+    try:
+      self._write(record)
+    except (IOError, OSError) as e:
+      log.warning('Could not write journal {0}: {1}'.format(self.path, e))
+
+  def close(self, complete):
+    self.file.close()
+    if complete:
+      _remove_journal(self.path)
+
+
+def _remove_journal(path):
+  try:
+    os.remove(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      log.warning('Could not remove journal {0}: {1}'.format(path, e))
+
+
+def resume(journal, desired, add, remove, strict=False, concurrency=1, dry_run=False):
+  '''
+  Finish the operations that an earlier reconcile with the same journal planned but didn't
+  complete, without listing the current items and diffing again.
+
+  journal
+      Key of the journal, as passed to reconcile.
+
+  desired, strict
+      As passed to reconcile. A journal planned for a different desired set or strict setting
+      is discarded.
+
+  add, remove, concurrency, dry_run
+      As for reconcile. The outstanding operations are replayed concurrency at a time; a dry
+      run reports them without running them.
+
+  Returns a reconcile result, or None if there is nothing to resume: no journal, or one that is
+  for a different desired set, older than JOURNAL_MAX_AGE or already replayed
+  JOURNAL_MAX_REPLAYS times. The caller should then reconcile as usual, which lists the remote
+  set again and so catches changes made since the journal was planned.
+  '''
+  opened = _Journal.open(journal)
+  if opened is None:
+    return None
+  writer, plan, done, replays = opened
+  if plan.get('spec') != _journal_spec(desired, strict) or \
+     time.time() - plan.get('at', 0) >= JOURNAL_MAX_AGE or replays >= JOURNAL_MAX_REPLAYS:
+    log.debug('Discarding journal {0} after {1} replays'.format(journal, replays))
+    writer.close(complete=True)
+    return None
+  started = time.time()
+  planned = [tuple(operation) for operation in plan['operations']]
+  operations = [operation for operation in planned if operation not in done]
+  log.info('Resuming {0}: {1} of {2} operations outstanding'.format(
+      journal, len(operations), len(planned)))
+  if dry_run:
+    writer.close(complete=False)
+    result = {'add': [item for action, item in operations if action == 'add'],
+              'remove': [item for action, item in operations if action == 'remove'],
+              'failed': {'add': {}, 'remove': {}}, 'errors': []}
+    applied = len(operations)
+  else:
+    writer.replay()
+    result, applied = _apply(operations, {'add': add, 'remove': remove}, concurrency, None,
+                             True, writer)
+  result['stats'] = {'to_add': len([1 for action, item in operations if action == 'add']),
+                     'to_remove': len([1 for action, item in operations if action == 'remove']),
+                     'added': len(result['add']),
+                     'removed': len(result['remove']),
+                     'failed': len(result['errors']),
+                     'skipped': len(operations) - applied,
+                     'resumed': len(planned) - len(operations),
+                     'diff_seconds': 0,
+                     'apply_seconds': time.time() - started}
+  log.debug('resume stats: {0}'.format(result['stats']))
+  return result
+
+
+def update_ret(ret, result, add_key, remove_key):
+  '''
+  Record the outcome of reconcile in a state return: successful items under add_key and
+  remove_key in changes, and any failures under changes['failed'] and in the comment.
+  '''
+  if len(result['add']):
+    ret['changes'][add_key] = result['add']
+  if len(result['remove']):
+    ret['changes'][remove_key] = result['remove']
+  for action, key in (('add', add_key), ('remove', remove_key)):
+    if len(result['failed'][action]):
+      ret['changes'].setdefault('failed', {})[key] = result['failed'][action]
+  if len(result['errors']):
+    ret['result'] = False
+    ret['comment'] = '; '.join([c for c in [ret['comment']] if c] + result['errors'])
+  return ret
+
+
+def fan_out(ret, keys, func, concurrency=1):
+  '''
+  Run a state function once for each key, such as each AWS account, concurrently, and merge
+  their returns into one state return: the changes of each under its key in changes, and the
+  comments of those that failed, prefixed with their key, in the comment.
+
+  func
+      Callable taking a key and returning a state return.
+  '''
+  errors = []
+  for key, sub in zip(keys, map_concurrent(func, keys, concurrency)):
+    if len(sub['changes']):
+      ret['changes'][key] = sub['changes']
+    if not sub['result']:
+      errors.append('{0}: {1}'.format(key, sub['comment']))
+  if len(errors):
+    ret['result'] = False
+    ret['comment'] = '; '.join(errors)
+  return ret
+
+
+def shard(name, count):
+  '''
+  Get the shard, from 0 to count - 1, that a name falls in. The same on every host and Python
+  version, unlike hash().
+  '''
+  return int(hashlib.md5(name.encode('utf-8')).hexdigest(), 16) % count
+
+
+def _shard_settings(index, count):
+  configured = _config('shard', {})
+  index = configured.get('index', 0) if index is None else index
+  count = configured.get('count', 1) if count is None else count
+  if not 0 <= index < count:
+    raise CommandExecutionError('Shard index {0} is not between 0 and {1}'.format(index, count - 1))
+  return index, count
+
+
+def in_shard(name, index=None, count=None):
+  '''
+  Check whether a name is in this minion's shard. Everything is when sharding isn't configured.
+
+  name
+      The team, repo, app, group or user name.
+
+  index
+      This minion's shard. Read from salt_org:shard:index in the config or pillar by default.
+
+  count
+      The number of shards. Read from salt_org:shard:count in the config or pillar by default.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local salt_org.in_shard Engineers
+  '''
+  index, count = _shard_settings(index, count)
+  return count == 1 or shard(name, count) == index
+
+
+def _not_in_shard(name):
+  '''
+  Get a comment saying which shard a name belongs to if that isn't this minion's shard, or None,
+  so a state can skip it.
+  '''
+  index, count = _shard_settings(None, None)
+  if count == 1 or shard(name, count) == index:
+    return None
+  return '{0} belongs to shard {1} of {2}, not this minion\'s shard {3}'.format(
+      name, shard(name, count), count, index)
+
+
+def skip_shard(ret):
+  '''
+  If the name of a state belongs to another minion's shard, say so in the comment of its state
+  return ret and return True, so the state can return at once and leave it to that minion.
+  '''
+  comment = _not_in_shard(ret['name'])
+  if comment is None:
+    return False
+  ret['comment'] = comment
+  return True
+
+
+def _cache_dir(namespace):
+  opts = globals().get('__opts__') or {}
+  if not opts.get('cachedir') or _config('cache:ttl', CACHE_TTL) <= 0:
+    return None
+  return os.path.join(opts['cachedir'], CACHE_DIR, namespace)
+
+
+def _cache_generation(directory):
+  try:
+    with open(os.path.join(directory, CACHE_GENERATION)) as f:
+      return f.read()
+  except IOError:
+    return ''
+
+
+def _cache_read(path, ttl, generation):
+  try:
+    with open(path) as f:
+      entry = json.load(f)
+  except (IOError, ValueError):
+    return None
+  if time.time() - entry['fetched'] >= ttl or entry.get('generation', '') != generation:
+    return None
+  return entry
+
+
+def _write_file(path, data):
+  tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+  fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+  with os.fdopen(fd, 'w') as f:
+    f.write(data)
+  os.rename(tmp, path)
+
+
+def _cache_write(path, value, generation):
+  _write_file(path, json.dumps({'fetched': time.time(), 'generation': generation, 'value': value}))
+
+
+class _Call(object):
+
+  '''
+  A fetch in flight, which other threads wanting the same key wait on.
+  '''
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+def _coalesce(key, fetch):
+  '''
+  Call fetch() unless another thread is already fetching the same key, in which case wait for it
+  and take its result, or its exception. Returns (result, True if this thread fetched it).
+  '''
+  with _inflight_lock:
+    call = _inflight.get(key)
+    leader = call is None
+    if leader:
+      call = _inflight[key] = _Call()
+  if not leader:
+    call.done.wait()
+    if call.error is not None:
+      raise call.error[0], call.error[1], call.error[2]
+    return call.result, False
+  try:
+    call.result = fetch()
+  except Exception:
+    call.error = sys.exc_info()
+    raise
+  finally:
+    with _inflight_lock:
+      del _inflight[key]
+    call.done.set()
+  return call.result, True
+
+
+def _cached(namespace, key, fetch, cacheable):
+  directory = _cache_dir(namespace)
+  if directory is None:
+    return fetch()
+  ttl = _config('cache:ttl', CACHE_TTL)
+  path = os.path.join(directory, hashlib.sha256(key).hexdigest() + '.json')
+  generation = _cache_generation(directory)
+  entry = _cache_read(path, ttl, generation)
+  if entry is not None:
+    return entry['value']
+  try:
+    os.makedirs(directory, 0700)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  with open(path[:-len('.json')] + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      # another process may have fetched it while we waited for the lock
+      entry = _cache_read(path, ttl, generation)
+      if entry is not None:
+        return entry['value']
+      value = fetch()
+      # skip the write if the cache was cleared during the fetch; the entry is written with the
+      # generation it was fetched in, so a clear that races the write still hides it
+      if (cacheable is None or cacheable(value)) and _cache_generation(directory) == generation:
+        _cache_write(path, value, generation)
+      return value
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def cached(namespace, key, fetch, cacheable=None):
+  '''
+  Get the result of fetch() for a key, sharing it with every process on the host for the cache
+  TTL. While one process or thread fetches a key, others asking for it wait and reuse its
+  result; within a process they share the one call even when nothing is cached. Results must be
+  JSON-serializable, and each thread gets its own copy. Without a minion cachedir, only
+  concurrent calls are shared.
+
+  namespace
+      The provider the read goes to, e.g. github. cache_clear clears a whole namespace.
+
+  key
+      String identifying the read, including anything that changes its result such as the
+      credentials used.
+
+  fetch
+      Callable making the read.
+
+  cacheable
+      Callable taking fetch's result and returning False if it shouldn't be cached, such as an
+      error response.
+  '''
+  value, fetched = _coalesce(namespace + ':' + key,
+                             lambda: _cached(namespace, key, fetch, cacheable))
+  return value if fetched else copy.deepcopy(value)
+
+
+def cached_response(namespace, key, fetch):
+  '''
+  Like cached, for a fetch returning a requests Response. Only successful responses are shared
+  between processes; concurrent identical requests within a process get the same Response.
+  '''
+  if _cache_dir(namespace) is None:
+    return _coalesce(namespace + ':' + key, fetch)[0]
+  import requests
+
+  def fetch_dict():
+    r = fetch()
+    return {'status_code': r.status_code,
+            'headers': dict(r.headers),
+            'url': r.url,
+            'content': base64.b64encode(r.content)}
+
+  entry = cached(namespace, key, fetch_dict, lambda entry: entry['status_code'] < 400)
+  r = requests.Response()
+  r.status_code = entry['status_code']
+  r.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+  r.url = entry['url']
+  r._content = base64.b64decode(entry['content'])
+  return r
+
+
+def cache_clear(namespace):
+  '''
+  Forget every cached read for a provider, e.g. after writing to it, including reads still being
+  fetched.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local salt_org.cache_clear github
+  '''
+  directory = _cache_dir(namespace)
+  if directory is None:
+    return True
+  try:
+    os.makedirs(directory, 0700)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  _write_file(os.path.join(directory, CACHE_GENERATION), os.urandom(8).encode('hex'))
+  for name in os.listdir(directory):
+    # a process still holding a removed lock at worst fetches alongside one using its new lock
+    if name.endswith('.json') or name.endswith('.lock'):
+      try:
+        os.remove(os.path.join(directory, name))
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+  return True
+
+
+def count_call(provider):
+  '''
+  Count a request made to a provider, such as an API request or an aws CLI run, for
+  profile_state. Reads answered from the cache aren't requests.
+  '''
+  with _outbound_lock:
+    _outbound[provider] += 1
+
+
+def _profiled(target):
+  '''
+  Wrap a thread target so the thread is profiled too while profile_state is running, since
+  cProfile only follows the thread that enabled it.
+  '''
+  profiles = _profiles
+  if profiles is None:
+    return target
+  import cProfile
+
+  def run():
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+      target()
+    finally:
+      profile.disable()
+      with _profiles_lock:
+        profiles.append(profile)
+  return run
+
+
+def _object_counts():
+  gc.collect()
+  return collections.Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def profile_state(state, name, profile_top=25, profile_memory=False, profile_sort='cumulative',
+                  **kwargs):
+  '''
+  Run a state, such as gh_team.present, under a deterministic profiler and report where its
+  time went. Its options are prefixed with profile_ so that they can't shadow an argument of the
+  state. Returns the state's return and:
+
+  seconds
+      Wall time of the run.
+
+  functions
+      The top functions by cumulative time (or by profile_sort), with their call counts and own and
+      cumulative seconds, across every thread the state started through map_concurrent.
+
+  outbound_calls
+      Requests made to each provider during the run. Reads answered from the cache don't count.
+
+  memory
+      With profile_memory=True, the growth of the process's peak RSS, and the types of objects that
+      grew the most in number. Python 2 can't trace allocations themselves, so these stand in
+      for allocation hot spots.
+
+  state
+      The state function to run.
+
+  name
+      The name argument of the state.
+
+  profile_top
+      Number of functions to report. 25 by default.
+
+  profile_memory
+      Also report memory growth. Slower, since every object is counted before and after.
+      False by default.
+
+  profile_sort
+      pstats key to order functions by: cumulative, time or calls. cumulative by default.
+
+  kwargs
+      The other arguments of the state.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-call --local salt_org.profile_state gh_team.present Engineers \\
+          token=xxxxx org=Clever members='[rgarcia]'
+  '''
+  global _profiles
+  import cProfile
+  import pstats
+  kwargs = dict((k, v) for k, v in kwargs.iteritems() if not k.startswith('__'))
+  with _profiles_lock:
+    if _profiles is not None:
+      raise CommandExecutionError('Another state is being profiled')
+    _profiles = []
+  try:
+    if profile_memory:
+      objects_before = _object_counts()
+      rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with _outbound_lock:
+      outbound_before = collections.Counter(_outbound)
+    profile = cProfile.Profile()
+    started = time.time()
+    profile.enable()
+    try:
+      ret = __salt__['state.single'](state, name, **kwargs)
+    finally:
+      profile.disable()
+    seconds = time.time() - started
+    with _outbound_lock:
+      outbound = dict((provider, count) for provider, count in
+                      (_outbound - outbound_before).iteritems())
+    stats = pstats.Stats(profile)
+    with _profiles_lock:
+      for thread_profile in _profiles:
+        stats.add(thread_profile)
+  finally:
+    with _profiles_lock:
+      _profiles = None
+
+  stats.sort_stats(profile_sort)
+  functions = []
+  for func in stats.fcn_list[:profile_top]:
+    primitive_calls, calls, own, cumulative, callers = stats.stats[func]
+    functions.append({'function': '{0}:{1}({2})'.format(*func),
+                      'calls': calls,
+                      'own_seconds': round(own, 6),
+                      'cumulative_seconds': round(cumulative, 6)})
+  report = {'ret': ret, 'seconds': seconds, 'functions': functions, 'outbound_calls': outbound}
+  if profile_memory:
+    growth = _object_counts() - objects_before
+    report['memory'] = {
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+        'object_growth': [{'type': type_name, 'count': count}
+                          for type_name, count in growth.most_common(profile_top)]}
+  return report
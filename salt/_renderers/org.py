@@ -0,0 +1,132 @@
+'''
+Renderer that builds salt-org states straight from pillar.
+
+Generating hundreds of states with Jinja loops means rendering a large YAML document and then
+parsing it again. This renderer builds the same state data directly from pillar instead. An sls
+file using it maps each provider to the pillar key holding its definitions:
+
+.. code-block:: yaml
+
+    #!org
+    github: github
+    heroku: heroku
+    aws: aws
+
+An sls file with nothing but ``#!org`` uses whichever of the github, heroku and aws pillar keys
+exist. The pillar data looks like:
+
+.. code-block:: yaml
+
+    github:
+      token: xxxxx
+      org: Clever
+      teams:
+        - name: Engineers         # becomes state github-Engineers
+          permission: push
+          members: [rgarcia]
+          repos: [Clever/clever-js]
+          strict: True
+    heroku:
+      token: xxxxx
+      apps:
+        - name: clever-api        # becomes state heroku-clever-api
+          members: [rgarcia@clever.com]
+    aws:
+      role: arn:aws:iam::111111111111:role/salt-org   # optional; or a list of roles
+      groups:
+        - name: Engineers         # becomes state aws-group-Engineers
+          members: [rgarcia]
+      users:                      # becomes a single aws_iam_user.users_present state, aws-users
+        - rgarcia: {keys: True}
+
+Every other key of a team, app or group is passed to its state as an argument, and a token (or
+org) given on a team or app, or a role given on a group, overrides the provider-wide one.
+
+When the org is sharded between minions (see salt_org.in_shard), only the teams, apps and groups
+in this minion's shard get states.
+'''
+
+import yaml
+import salt.utils
+from salt.exceptions import SaltRenderError
+
+
+def _state(function, **kwargs):
+  '''
+  Build the state data for one state function call. The name comes first, then the other
+  arguments in sorted order.
+  '''
+  args = [{'name': kwargs.pop('name')}] if 'name' in kwargs else []
+  return {function: args + [{key: kwargs[key]} for key in sorted(kwargs)]}
+
+
+def github_states(github):
+  '''
+  Build a gh_team.present state for each team.
+  '''
+  high = {}
+  for team in github.get('teams', []):
+    if not __salt__['salt_org.in_shard'](team['name']):
+      continue
+    args = {'token': github.get('token'), 'org': github.get('org')}
+    args.update(team)
+    high['github-{0}'.format(team['name'])] = _state('gh_team.present', **args)
+  return high
+
+
+def heroku_states(heroku):
+  '''
+  Build a hk_collaborators.present state for each app.
+  '''
+  high = {}
+  for app in heroku.get('apps', []):
+    if not __salt__['salt_org.in_shard'](app['name']):
+      continue
+    args = {'token': heroku.get('token')}
+    args.update(app)
+    high['heroku-{0}'.format(app['name'])] = _state('hk_collaborators.present', **args)
+  return high
+
+
+def aws_states(aws):
+  '''
+  Build an aws_iam_group.present state for each group, and one aws_iam_user.users_present
+  state for all users.
+  '''
+  high = {}
+  account = {'role': aws['role']} if 'role' in aws else {}
+  for group in aws.get('groups', []):
+    if not __salt__['salt_org.in_shard'](group['name']):
+      continue
+    args = dict(account)
+    args.update(group)
+    high['aws-group-{0}'.format(group['name'])] = _state('aws_iam_group.present', **args)
+  if aws.get('users'):
+    high['aws-users'] = _state('aws_iam_user.users_present', name='aws-users',
+                               users=aws['users'], **account)
+  return high
+
+BUILDERS = {'github': github_states, 'heroku': heroku_states, 'aws': aws_states}
+
+
+def render(data, env='', sls='', **kws):
+  '''
+  Build the states for each provider mapped in data from its pillar key.
+  '''
+  if not isinstance(data, basestring):
+    data = data.read()
+  try:
+    keys = yaml.safe_load(data)
+  except yaml.YAMLError as exc:
+    raise SaltRenderError('Invalid org renderer mapping: {0}'.format(exc))
+  if keys is None:
+    keys = dict((provider, provider) for provider in BUILDERS if provider in __pillar__)
+  high = {}
+  for provider, pillar_key in keys.iteritems():
+    if provider not in BUILDERS:
+      raise SaltRenderError('Unknown org renderer provider {0}'.format(provider))
+    definitions = salt.utils.traverse_dict(__pillar__, pillar_key, None)
+    if definitions is None:
+      raise SaltRenderError('Pillar key {0} for {1} is missing'.format(pillar_key, provider))
+    high.update(BUILDERS[provider](definitions))
+  return high
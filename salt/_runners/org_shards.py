@@ -0,0 +1,88 @@
+'''
+Runner to reconcile an org sharded between several minions.
+
+Each minion is given its own shard index in its config or pillar (see salt_org.in_shard), so the
+same sls reconciles a disjoint share of the org on each. This runner applies the sls on every
+minion at once and merges their results into one report:
+
+.. code-block:: bash
+
+    sudo salt-run org_shards.sls github tgt='org-*'
+'''
+
+import salt.client
+import salt.output
+
+
+def merge(returns):
+  '''
+  Merge the state returns of several minions, by minion id, into one report:
+
+  result
+      False if any state failed or any minion couldn't run the sls.
+
+  minions
+      Number of states run, changed and failed on each minion.
+
+  changes
+      Changes by state, then by the minion that made them.
+
+  failed
+      Comments of failed states, by state then by minion.
+
+  errors
+      Errors of minions that couldn't run the sls, such as render errors.
+
+  overlap
+      States changed by more than one minion, which means shards were misconfigured.
+  '''
+  report = {'result': True, 'minions': {}, 'changes': {}, 'failed': {}, 'errors': {}}
+  for minion, states in sorted(returns.iteritems()):
+    if not isinstance(states, dict):
+      report['errors'][minion] = states if isinstance(states, list) else [states]
+      continue
+    summary = {'states': len(states), 'changed': 0, 'failed': 0}
+    for key, ret in states.iteritems():
+      if ret.get('changes'):
+        summary['changed'] += 1
+        report['changes'].setdefault(key, {})[minion] = ret['changes']
+      if ret.get('result') is False:
+        summary['failed'] += 1
+        report['failed'].setdefault(key, {})[minion] = ret.get('comment', '')
+    report['minions'][minion] = summary
+  report['overlap'] = sorted(key for key, minions in report['changes'].iteritems()
+                             if len(minions) > 1)
+  report['result'] = not (report['failed'] or report['errors'])
+  return report
+
+
+def sls(mods, tgt='*', expr_form='glob', timeout=None, output=True):
+  '''
+  Apply an sls on every targeted minion at once, each reconciling its own shard, and merge their
+  results into one report.
+
+  mods
+      The sls to apply, e.g. github.
+
+  tgt
+      The minions to apply it on. All minions by default.
+
+  expr_form
+      How tgt matches minions: glob, pcre, list, grain, etc. glob by default.
+
+  timeout
+      Seconds to wait for the minions to return. The master's timeout by default.
+
+  CLI Example:
+
+  .. code-block:: bash
+
+      sudo salt-run org_shards.sls github tgt='org-*'
+  '''
+  client = salt.client.LocalClient(__opts__['conf_file'])
+  returns = client.cmd(tgt, 'state.sls', [mods], timeout=timeout or __opts__['timeout'],
+                       expr_form=expr_form)
+  report = merge(returns)
+  if output:
+    salt.output.display_output(report, '', __opts__)
+  return report
@@ -9,16 +9,57 @@ Management of groups in AWS
         - name: Engineers
         - members:
           - rgarcia
+        - policies:
+            ReadOnly:
+              Version: "2012-10-17"
+              Statement:
+                Effect: Allow
+                Action: s3:Get*
+                Resource: "*"
         - strict: False
+        - concurrency: 8
+        - role:
+          - arn:aws:iam::111111111111:role/salt-org
+          - arn:aws:iam::222222222222:role/salt-org
 
       aws_iam_group.absent:
         - name: RemoveThisTeam
 '''
 
 import sys
+from salt.exceptions import CommandExecutionError
 
 
-def present(name, members=None, strict=False, dry_run=False):
+def _fetch_policies(name, page_size=None, role=None):
+  '''
+  Get a {policy name: document} dict of the inline policies of a group, or None on error.
+  '''
+  policy_names = __salt__['aws_iam.list_group_policies'](name, page_size, role)
+  if policy_names is None:
+    return None
+  policies = {}
+  for policy_name in policy_names:
+    document = __salt__['aws_iam.get_group_policy'](name, policy_name, role)
+    if document is None:
+      return None
+    policies[policy_name] = document
+  return policies
+
+
+def _matching_policies(policies_currently, policies):
+  '''
+  Get the names of current policies that either aren't desired or whose canonical hash already
+  matches the desired document, i.e. those that need no write.
+  '''
+  policy_hash = __salt__['aws_iam.policy_hash']
+  return [policy_name for policy_name, document in policies_currently.iteritems()
+          if policy_name not in policies or
+          policy_hash(document) == policy_hash(policies[policy_name])]
+
+
+def present(name, members=None, policies=None, strict=False, use_snapshot=True,
+            page_size=None, concurrency=4, retries=None, role=None, account_concurrency=4,
+            dry_run=False):
   '''
   Ensure that a group is present and has the correct members.
 
@@ -29,8 +70,36 @@ def present(name, members=None, strict=False, dry_run=False):
       List of users that should be part of the group.
       Pass None to accept the existing state of membership in this team.
 
+  policies
+      Mapping of inline policy names to policy documents (as YAML or JSON strings).
+      Documents are compared in canonical form, so only policies whose content changed are
+      written. Pass None to accept the existing inline policies of this group.
+
   strict
-      Remove from the group any unlisted users. False by default.
+      Remove from the group any unlisted users, and any unlisted inline policies if policies
+      is given. False by default.
+
+  use_snapshot
+      Read the group and its members from the account snapshot shared by all IAM states in this
+      run. Set to False to page through just this group's members instead, which is cheaper when
+      only a few groups are managed. True by default.
+
+  page_size
+      Number of items to request per page when paging through IAM listings.
+
+  concurrency
+      Number of users to add to or remove from the group at once, in each account. 4 by default.
+
+  retries
+      Number of times to retry a membership change that IAM throttles, backing off between
+      attempts. Defaults to the aws_iam module's THROTTLE_RETRIES.
+
+  role
+      ARN of an IAM role to assume to manage another account, or a list of them to manage
+      several accounts at once. The minion's own account by default.
+
+  account_concurrency
+      Number of accounts to manage at once when role is a list. 4 by default.
 
   dry_run
       Don't actually make any changes in AWS. False by default.
@@ -40,58 +109,121 @@ def present(name, members=None, strict=False, dry_run=False):
          'changes': {},
          'result': True,
          'comment': ''}
-  group = __salt__['aws_iam.get_group'](name)
-  if group is None:
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  if isinstance(role, list):
+    return __salt__['salt_org.fan_out'](
+        ret, role, lambda role: present(name, members, policies, strict, use_snapshot, page_size,
+                                        concurrency, retries, role, account_concurrency, dry_run),
+        account_concurrency)
+  if use_snapshot:
+    snapshot = __salt__['aws_iam.snapshot'](page_size=page_size, role=role)
+    if snapshot is None:
+      ret['result'] = False
+      ret['comment'] = 'Error reading IAM account state'
+      return ret
+    exists = name in snapshot['groups']
+  else:
+    try:
+      exists = any(g['GroupName'] == name
+                   for g in __salt__['aws_iam.iter_groups'](page_size, role))
+    except CommandExecutionError as exc:
+      ret['result'] = False
+      ret['comment'] = 'Error listing IAM groups: {0}'.format(exc)
+      return ret
+  if not exists:
     # Group doesn't exist
     if dry_run:
       ret['changes']['create_group'] = {'name': name, 'members': members}
-      return
-    __salt__['aws_iam.create_group'](name)
-    for member in members:
-      __salt__['aws_iam.add_user_to_group'](member, name)
+      if policies:
+        ret['changes']['put_group_policy'] = sorted(policies)
+      return ret
+    if __salt__['aws_iam.create_group'](name, role) is None:
+      ret['result'] = False
+      ret['comment'] = 'Error creating group'
+      return ret
     ret['changes']['create_group'] = {'name': name, 'members': members}
-    return ret
 
   # ensure group membership is correct
   if members is not None:
-    members_currently = set([u["UserName"] for u in group["Users"]])
-    members_desired = set(members)
-    members_to_add = members_desired - members_currently
-    members_to_remove = (members_currently - members_desired) if strict else set()
-    if len(members_to_add):
-      ret['changes']['add_user_to_group'] = []
-      for member_to_add in members_to_add:
-        ret['changes']['add_user_to_group'].append((member_to_add, name))
-        if not dry_run:
-          __salt__['aws_iam.add_user_to_group'](member_to_add, name)
-    if len(members_to_remove):
-      ret['changes']['remove_user_from_group'] = []
-      for member_to_remove in members_to_remove:
-        ret['changes']['remove_user_from_group'].append((member_to_remove, name))
-        if not dry_run:
-          __salt__['aws_iam.remove_user_from_group'](member_to_remove, name)
+    if not exists:
+      members_currently = []
+    elif use_snapshot:
+      members_currently = snapshot['members'].get(name, [])
+    else:
+      members_currently = (u['UserName'] for u in
+                           __salt__['aws_iam.iter_group_members'](name, page_size, role))
+    try:
+      result = __salt__['salt_org.reconcile'](
+          members_currently, members,
+          lambda user: __salt__['aws_iam.add_user_to_group'](user, name, retries, role),
+          lambda user: __salt__['aws_iam.remove_user_from_group'](user, name, retries, role),
+          strict=strict, concurrency=concurrency, dry_run=dry_run)
+    except CommandExecutionError as exc:
+      ret['result'] = False
+      ret['comment'] = 'Error listing members of {0}: {1}'.format(name, exc)
+      return ret
+    __salt__['salt_org.update_ret'](ret, result, 'add_user_to_group', 'remove_user_from_group')
+
+  # ensure inline policies are correct
+  if policies is not None:
+    if not exists:
+      policies_currently = {}
+    elif use_snapshot:
+      policies_currently = dict((p['PolicyName'], p['PolicyDocument'])
+                                for p in snapshot['groups'][name].get('GroupPolicyList', []))
+    else:
+      policies_currently = _fetch_policies(name, page_size, role)
+      if policies_currently is None:
+        ret['result'] = False
+        ret['comment'] = 'Error fetching policies of {0}'.format(name)
+        return ret
+    result = __salt__['salt_org.reconcile'](
+        _matching_policies(policies_currently, policies), policies,
+        lambda policy_name: __salt__['aws_iam.put_group_policy'](name, policy_name,
+                                                                 policies[policy_name], role),
+        lambda policy_name: __salt__['aws_iam.delete_group_policy'](name, policy_name, role),
+        strict=strict, concurrency=concurrency, dry_run=dry_run)
+    __salt__['salt_org.update_ret'](ret, result, 'put_group_policy', 'delete_group_policy')
 
   return ret
 
 
-def absent(name, dry_run=False):
+def absent(name, role=None, account_concurrency=4, dry_run=False):
   '''
   Ensure that a team does not exist.
 
   name
       The name of the team to delete, if present.
 
+  role
+      ARN of an IAM role to assume to manage another account, or a list of them to manage
+      several accounts at once. The minion's own account by default.
+
+  account_concurrency
+      Number of accounts to manage at once when role is a list. 4 by default.
+
   dry_run
-      Don't actually make any changes in GitHub.
+      Don't actually make any changes in AWS.
   '''
   ret = {'name': name,
          'changes': {},
          'result': True,
          'comment': ''}
-  group = __salt__['aws_iam.get_group'](name)
-  if group is None:
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  if isinstance(role, list):
+    return __salt__['salt_org.fan_out'](
+        ret, role, lambda role: absent(name, role, account_concurrency, dry_run),
+        account_concurrency)
+  snapshot = __salt__['aws_iam.snapshot'](role=role)
+  if snapshot is None:
+    ret['result'] = False
+    ret['comment'] = 'Error reading IAM account state'
+    return ret
+  if name not in snapshot['groups']:
     # Team doesn't exist, success!
-    return
+    return ret
   if not dry_run:
-    __salt__['aws_iam.delete_group'](name)
+    __salt__['aws_iam.delete_group'](name, role)
   return ret
@@ -12,12 +12,44 @@ Management of users in AWS
 
       aws_iam_group.absent:
         - name: RemoveThisUser
+
+    employees:
+      aws_iam_user.users_present:
+        - users:
+          - rgarcia:
+              keys: True
+          - someone.else
+        - concurrency: 8
+        - role:
+          - arn:aws:iam::111111111111:role/salt-org
+          - arn:aws:iam::222222222222:role/salt-org
 '''
 
 import sys
+from salt.exceptions import CommandExecutionError
+
 
+def _has_access_key(user, report=None, role=None):
+  '''
+  Find if a user has any access keys. Returns True/False, or None on error.
 
-def present(name, keys=False, dry_run=False):
+  A credential report showing a key is trusted. A report showing none is trusted too while AWS
+  generated it recently; otherwise, or for users the report doesn't list, list_access_keys
+  confirms it, since a missed key would mean creating a duplicate.
+  '''
+  if report is not None and user in report:
+    if report[user]['access_key_count']:
+      return True
+    if __salt__['aws_iam.credential_report_fresh'](role=role):
+      return False
+  keys = __salt__['aws_iam.list_access_keys'](user, role)
+  if keys is None:
+    return None
+  return len(keys) > 0
+
+
+def present(name, keys=False, credential_report=False, role=None, account_concurrency=4,
+            dry_run=False):
   '''
   Ensure that a user is present in AWS.
 
@@ -27,6 +59,17 @@ def present(name, keys=False, dry_run=False):
   keys
       If true, ensure the user has access keys.
 
+  credential_report
+      Check for access keys using the account credential report, which is fetched once and
+      cached, instead of listing this user's keys. False by default.
+
+  role
+      ARN of an IAM role to assume to manage another account, or a list of them to manage
+      several accounts at once. The minion's own account by default.
+
+  account_concurrency
+      Number of accounts to manage at once when role is a list. 4 by default.
+
   dry_run
       Don't actually make any changes in AWS. False by default.
 
@@ -35,35 +78,192 @@ def present(name, keys=False, dry_run=False):
          'changes': {},
          'result': True,
          'comment': ''}
-  user = __salt__['aws_iam.get_user'](name)
-  if user is None:
-    if dry_run or __salt__['aws_iam.create_user'](name) is not None:
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  if isinstance(role, list):
+    return __salt__['salt_org.fan_out'](
+        ret, role, lambda role: present(name, keys, credential_report, role, account_concurrency,
+                                        dry_run), account_concurrency)
+  snapshot = __salt__['aws_iam.snapshot'](role=role)
+  if snapshot is None:
+    ret['result'] = False
+    ret['comment'] = 'Error reading IAM account state'
+    return ret
+  exists = name in snapshot['users']
+  if not exists:
+    if dry_run or __salt__['aws_iam.create_user'](name, role) is not None:
       ret['changes']['create_user'] = {'name': name}
       if dry_run:
-        return
+        return ret
     else:
       ret["result"] = False
       ret["comment"] = "Error creating user"
       return ret
 
   if keys is True:
-    keys = __salt__['aws_iam.list_access_keys'](name)
-    if len(keys) == 0:
+    report = None
+    if credential_report:
+      report = __salt__['aws_iam.credential_report'](role=role)
+      if report is None:
+        ret['result'] = False
+        ret['comment'] = 'Error fetching credential report'
+        return ret
+    # a user created just now has no keys yet
+    has_key = exists and _has_access_key(name, report, role)
+    if has_key is None:
+      ret['result'] = False
+      ret['comment'] = 'Error listing access keys'
+      return ret
+    if not has_key:
       if dry_run:
         ret['changes']['create_access_key'] = {'name': name}
       else:
-        ret['changes']['create_access_key'] = __salt__['aws_iam.create_access_key'](name)
+        ret['changes']['create_access_key'] = __salt__['aws_iam.create_access_key'](name, role)
+
+  return ret
+
+
+def _normalize_users(users):
+  '''
+  Turn a roster of user names and {name: {keys: bool}} entries into a {name: keys} dict.
+  '''
+  roster = {}
+  for user in users:
+    if isinstance(user, dict):
+      for user_name, settings in user.iteritems():
+        roster[user_name] = bool((settings or {}).get('keys', False))
+    else:
+      roster[user] = False
+  return roster
+
+
+def users_present(name, users, concurrency=4, credential_report=False, role=None,
+                  account_concurrency=4, dry_run=False):
+  '''
+  Ensure that a whole roster of users is present in AWS.
+
+  The roster is diffed against a single read of the account, and missing users and access keys
+  are created concurrently through salt_org.reconcile, with one report for the whole roster. If
+  some users fail, the next run retries just those from the journal reconcile keeps.
+
+  name
+      An identifier for this roster.
 
+  users
+      List of users. Each entry is either a user name, or a mapping of a user name to its
+      settings, e.g. `{rgarcia: {keys: True}}` to ensure that the user has access keys.
+
+  concurrency
+      Number of users to create or check at once, in each account. 4 by default.
+
+  credential_report
+      Check for access keys using the account credential report instead of listing each user's
+      keys. False by default.
+
+  role
+      ARN of an IAM role to assume to manage another account, or a list of them to manage
+      several accounts at once. The minion's own account by default.
+
+  account_concurrency
+      Number of accounts to manage at once when role is a list. 4 by default.
+
+  dry_run
+      Don't actually make any changes in AWS. False by default.
+
+  '''
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+  if isinstance(role, list):
+    return __salt__['salt_org.fan_out'](
+        ret, role, lambda role: users_present(name, users, concurrency, credential_report, role,
+                                              account_concurrency, dry_run),
+        account_concurrency)
+  snapshot = __salt__['aws_iam.snapshot'](role=role)
+  if snapshot is None:
+    ret['result'] = False
+    ret['comment'] = 'Error reading IAM account state'
+    return ret
+  # users in other minions' shards are left to them
+  roster = dict((user, keys) for user, keys in _normalize_users(users).iteritems()
+                if __salt__['salt_org.in_shard'](user))
+  report = None
+  if credential_report and any(roster.itervalues()):
+    report = __salt__['aws_iam.credential_report'](role=role)
+    if report is None:
+      ret['result'] = False
+      ret['comment'] = 'Error fetching credential report'
+      return ret
+  # users that exist and don't need keys are already converged
+  converged = [user for user, keys in roster.iteritems() if not keys and user in snapshot['users']]
+  changes = {}
+
+  def converge(user):
+    changes[user] = {}
+    exists = user in snapshot['users']
+    if not exists:
+      if not dry_run and __salt__['aws_iam.create_user'](user, role) is None:
+        raise CommandExecutionError('Error creating user {0}'.format(user))
+      changes[user]['create_user'] = {'name': user}
+    if roster[user]:
+      has_key = exists and _has_access_key(user, report, role)
+      if has_key is None:
+        raise CommandExecutionError('Error listing access keys for {0}'.format(user))
+      if not has_key:
+        if dry_run:
+          changes[user]['create_access_key'] = {'name': user}
+        else:
+          key = __salt__['aws_iam.create_access_key'](user, role)
+          if key is None:
+            raise CommandExecutionError('Error creating access key for {0}'.format(user))
+          changes[user]['create_access_key'] = key
+    return True
+
+  desired = sorted(roster)
+  if dry_run:
+    # converge makes no writes on a dry run, so let it report what it would change
+    result = __salt__['salt_org.reconcile'](converged, desired, converge, None,
+                                            concurrency=concurrency)
+  else:
+    journal = 'aws_iam_user/{0}/{1}'.format(role or 'default', name)
+    result = __salt__['salt_org.resume'](journal, desired, converge, None,
+                                         concurrency=concurrency)
+    if result is None:
+      result = __salt__['salt_org.reconcile'](converged, desired, converge, None,
+                                              concurrency=concurrency, journal=journal)
+
+  ret['changes'] = dict((user, user_changes) for user, user_changes in changes.iteritems()
+                        if len(user_changes))
+  errors = [error for user, error in sorted(result['failed']['add'].iteritems())]
+  if len(errors):
+    ret['result'] = False
+    ret['comment'] = '; '.join(errors)
   return ret
 
 
-def absent(name, dry_run=False):
+def absent(name, role=None, account_concurrency=4, concurrency=4, dry_run=False):
   '''
   Ensure that a user does not exist.
 
+  Everything IAM won't delete a user with is removed first: its group memberships, access keys,
+  signing certificates, MFA devices, inline and managed policies, and console login profile (see
+  aws_iam.detach_user). If any of them can't be removed, the user is kept and the next run
+  retries just those.
+
   name
       The name of the user to delete, if present.
 
+  role
+      ARN of an IAM role to assume to manage another account, or a list of them to manage
+      several accounts at once. The minion's own account by default.
+
+  account_concurrency
+      Number of accounts to manage at once when role is a list. 4 by default.
+
+  concurrency
+      Number of things attached to the user to remove at once. 4 by default.
+
   dry_run
       Don't actually make any changes in AWS.
   '''
@@ -71,19 +271,32 @@ def absent(name, dry_run=False):
          'changes': {},
          'result': True,
          'comment': ''}
-  user = __salt__['aws_iam.get_user'](name)
-  if user is None:
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  if isinstance(role, list):
+    return __salt__['salt_org.fan_out'](
+        ret, role, lambda role: absent(name, role, account_concurrency, concurrency, dry_run),
+        account_concurrency)
+  snapshot = __salt__['aws_iam.snapshot'](role=role)
+  if snapshot is None:
+    ret['result'] = False
+    ret['comment'] = 'Error reading IAM account state'
+    return ret
+  if name not in snapshot['users']:
     return ret
 
-  # need to delete all access keys first
-  for key in __salt__['aws_iam.list_access_keys'](name):
-    if 'delete_access_key' not in ret['changes']:
-      ret['changes']['delete_access_key'] = []
-    ret['changes']['delete_access_key'].append(key['AccessKeyId'])
-    if not dry_run:
-      __salt__['aws_iam.delete_access_key'](name, key['AccessKeyId'])
+  results, errors = __salt__['aws_iam.detach_user'](name, concurrency, dry_run, role)
+  for action, result in results:
+    __salt__['salt_org.update_ret'](ret, result, action, action)
+  if len(errors):
+    ret['result'] = False
+    ret['comment'] = '; '.join([c for c in [ret['comment']] if c] + errors)
+  if not ret['result']:
+    return ret
 
   ret['changes']['delete_user'] = name
-  if not dry_run:
-    __salt__['aws_iam.delete_user'](name)
+  if not dry_run and __salt__['aws_iam.delete_user'](name, role) is None:
+    del ret['changes']['delete_user']
+    ret['result'] = False
+    ret['comment'] = 'Error deleting user'
   return ret
@@ -51,32 +51,24 @@ class DictDiffer(object):
     return set(o for o in self.intersect if self.past_dict[o] == self.current_dict[o])
 
 
-def present(name, token, hooks, strict=False, dry_run=False):
+def _config_changed(repo, existing_hook, config):
   '''
-  Ensure that a repo has certain hooks present
-
-  name
-      The name of the repo to manage hooks for.
-
-  token
-      OAuth token created by an admin for the organization.
-
-  hooks
-      List of hooks. Must contain required hook fields: `name`, `config` object, and `events` array.
-      Config varies depending on the hook you're setting up.
-      See http://developer.github.com/v3/repos/hooks/ for more information.
+  Find if a hook's config differs from the desired one. Fields GitHub masks can't be compared
+  directly, so when there are any the desired config is compared with the fingerprint of the
+  config last applied to the hook instead.
+  '''
+  config_diff = DictDiffer(existing_hook['config'], config)
+  masked = __salt__['gh_hooks.masked_fields'](existing_hook['config'])
+  if len(config_diff.added()) or len(config_diff.removed()) or len(config_diff.changed() - masked):
+    return True
+  return len(masked) > 0 and __salt__['gh_hooks.fingerprint'](config) != \
+      __salt__['gh_hooks.applied_fingerprint'](repo, existing_hook['id'])
 
-  strict
-      Remove from the repo any hooks not enumerated in the state.
-
-  dry_run
-      Don't actually make any changes in GitHub. False by default.
 
+def _present(ret, name, token, hooks, strict, dry_run):
+  '''
+  Reconcile the hooks of a repo for present, filling in its state return ret.
   '''
-  ret = {'name': name,
-         'changes': {},
-         'result': True,
-         'comment': ''}
   existing_hooks = __salt__['gh_hooks.list'](token, name)
 
   # If strict, remove existing hooks not enumerated in the state
@@ -111,9 +103,7 @@ def present(name, token, hooks, strict=False, dry_run=False):
         return ret
     else:  # hook already exists, potentially patch
       patch = {}
-      config_diff = DictDiffer(existing_hook['config'], specified_hook['config'])
-      if (len(config_diff.added()) > 0 or len(config_diff.removed()) > 0 or
-              len(config_diff.changed())):
+      if _config_changed(name, existing_hook, specified_hook['config']):
         patch['config'] = specified_hook['config']
       if existing_hook["active"] != specified_hook["active"]:
         patch["active"] = specified_hook["active"]
@@ -127,3 +117,35 @@ def present(name, token, hooks, strict=False, dry_run=False):
         ret['changes']['patch'].append((name, patch))
 
   return ret
+
+
+def present(name, token, hooks, strict=False, dry_run=False):
+  '''
+  Ensure that a repo has certain hooks present
+
+  name
+      The name of the repo to manage hooks for.
+
+  token
+      OAuth token created by an admin for the organization.
+
+  hooks
+      List of hooks. Must contain required hook fields: `name`, `config` object, and `events` array.
+      Config varies depending on the hook you're setting up.
+      See http://developer.github.com/v3/repos/hooks/ for more information.
+
+  strict
+      Remove from the repo any hooks not enumerated in the state.
+
+  dry_run
+      Don't actually make any changes in GitHub. False by default.
+
+  '''
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  return __salt__['salt_org.run_state'](
+      ret, 'github', lambda: _present(ret, name, token, hooks, strict, dry_run))
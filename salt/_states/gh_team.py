@@ -26,11 +26,172 @@ can be either present or absent:
         - name: RemoveThisTeam
 '''
 
+import logging
+log = logging.getLogger(__name__)
 import sys
+import time
+from salt.exceptions import CommandExecutionError
+
+# Members or repos GitHub returns per page of a team listing, as requested by the gh_team module.
+PAGE_SIZE = 100
+
+# Default seconds after which a converged team is checked in full again even though none of its
+# ETags changed.
+RECHECK_AFTER = 3600
+
+
+def _lists(wanted, count, strict):
+  '''
+  Find if _current lists all count members or repos of a team rather than checking each wanted
+  one individually.
+  '''
+  pages = max(1, -(-(count or 0) // PAGE_SIZE))
+  return strict or count is None or len(wanted) >= pages
+
+
+def _current(wanted, count, strict, concurrency, list_func, key, check_func):
+  '''
+  Find which of the wanted members or repos a team currently has, using whichever costs fewer
+  requests: listing all count of them a page at a time, or checking each wanted one
+  individually. A strict run has to list, since it also needs the unwanted ones. Returns None
+  if the listing or any check fails.
+  '''
+  if _lists(wanted, count, strict):
+    objs = list_func()
+    if objs is None:
+      return None
+    return [obj[key] for obj in objs]
+  log.debug('Checking {0} items individually instead of listing {1} pages'.format(
+      len(wanted), -(-count // PAGE_SIZE)))
+  try:
+    found = __salt__['salt_org.map_concurrent'](check_func, wanted, concurrency)
+  except CommandExecutionError as exc:
+    log.error('Error checking items individually: {0}'.format(exc))
+    return None
+  return [item for item, present in zip(wanted, found) if present]
+
+
+def _present(ret, name, token, org, members, permission, repos, strict, concurrency,
+             recheck_after, dry_run):
+  '''
+  Reconcile a team for present, filling in its state return ret.
+  '''
+  spec = __salt__['gh_team.fingerprint'](
+      {'members': members, 'permission': permission, 'repos': repos, 'strict': strict})
+  wanted = {'members': members, 'repos': repos}
+  listings = [listing for listing in ('members', 'repos') if wanted[listing] is not None]
+  record = __salt__['gh_team.converged'](org, name)
+  detail = None
+  if record is not None and record['spec'] == spec and 'listings' in record and \
+     time.time() - record['at'] < recheck_after:
+    detail = __salt__['gh_team.get_if_modified'](token, record['id'], record['etag'])
+    if detail is not None and not detail['modified']:
+      # the team's own ETag doesn't change when its members or repos do
+      if all(__salt__['gh_team.listing_modified'](token, record['id'], listing,
+                                                  record['listings'].get(listing)) is False
+             for listing in listings):
+        ret['comment'] = 'Team unchanged since it last converged'
+        return ret
+      detail = None
+  if detail is None or detail['team']['name'] != name:
+    teams = __salt__['gh_team.list'](token, org)
+    if teams is False:
+      ret["result"] = False
+      ret["comment"] = "Error listing GitHub teams"
+      return ret
+    team = next((t for t in teams if t["name"] == name), None)
+    if team is None:
+      # Team doesn't exist
+      if dry_run:
+        ret['changes']['add'] = {'org': org, 'name': name, 'permission': permission,
+                                 'repos': repos}
+        return ret
+      team = __salt__['gh_team.add'](token, org, name, permission, repos)
+      if team is not None:
+        ret['changes']['add'] = {'org': org, 'name': name, 'permission': permission,
+                                 'repos': repos}
+      else:
+        ret["result"] = False
+        ret["comment"] = "Error adding GitHub team"
+        return ret
+    detail = __salt__['gh_team.get_if_modified'](token, team["id"])  # get more detail
+    if detail is None:
+      ret["result"] = False
+      ret["comment"] = "Error fetching GitHub team"
+      return ret
+  team = detail['team']
+  resumed = False
+
+  # ensure permission is correct
+  if permission is not None and team["permission"] != permission:
+    if dry_run or __salt__['gh_team.edit'](token, team["id"], name, permission) is not None:
+      ret['changes']['edit'] = {'team': team["id"], 'name': name, 'permission': permission}
+    else:
+      ret["result"] = False
+      ret["comment"] = "Error editing permission"
+      return ret
+
+  # ensure team membership is correct
+  if members is not None:
+    journal = 'gh_team/{0}/{1}/members'.format(org, name)
+    add = lambda member: __salt__['gh_team.add_membership'](token, team["id"], member)
+    remove = lambda member: __salt__['gh_team.remove_membership'](token, team["id"], member)
+    result = __salt__['salt_org.resume'](journal, members, add, remove, strict=strict,
+                                         concurrency=concurrency, dry_run=dry_run)
+    resumed = resumed or result is not None
+    if result is None:
+      current = _current(
+          members, team.get("members_count"), strict, concurrency,
+          lambda: __salt__['gh_team.list_members'](token, team["id"]), "login",
+          lambda member: __salt__['gh_team.get_membership'](token, team["id"], member) is not None)
+      if current is None:
+        ret["result"] = False
+        ret["comment"] = "Error fetching team members"
+        return ret
+      result = __salt__['salt_org.reconcile'](current, members, add, remove, strict=strict,
+                                              concurrency=concurrency, dry_run=dry_run,
+                                              journal=journal)
+    __salt__['salt_org.update_ret'](ret, result, 'add_member', 'remove_member')
+
+  # ensure repo access is correct
+  if repos is not None:
+    journal = 'gh_team/{0}/{1}/repos'.format(org, name)
+    add = lambda repo: __salt__['gh_team.add_repo'](token, team["id"], repo)
+    remove = lambda repo: __salt__['gh_team.remove_repo'](token, team["id"], repo)
+    result = __salt__['salt_org.resume'](journal, repos, add, remove, strict=strict,
+                                         concurrency=concurrency, dry_run=dry_run)
+    resumed = resumed or result is not None
+    if result is None:
+      current = _current(
+          repos, team.get("repos_count"), strict, concurrency,
+          lambda: __salt__['gh_team.list_repos'](token, team["id"]), "full_name",  # "Org/repo"
+          lambda repo: __salt__['gh_team.get_repo'](token, team["id"], repo))
+      if current is None:
+        ret["result"] = False
+        ret["comment"] = "Error fetching repos"
+        return ret
+      result = __salt__['salt_org.reconcile'](current, repos, add, remove, strict=strict,
+                                              concurrency=concurrency, dry_run=dry_run,
+                                              journal=journal)
+    __salt__['salt_org.update_ret'](ret, result, 'add_repo', 'remove_repo')
+
+  if ret['result'] and not dry_run and not resumed:
+    if len(ret['changes']):
+      # the changes gave the team a new ETag
+      detail = __salt__['gh_team.get_if_modified'](token, team["id"])
+    # only worth recording when the listings were read anyway; checking individually is cheaper
+    # than listing every run's ETags
+    if all(_lists(wanted[listing], team.get(listing + '_count'), strict)
+           for listing in listings):
+      etags = dict((listing, __salt__['gh_team.listing_etags'](token, team["id"], listing))
+                   for listing in listings)
+      if detail is not None and detail['etag'] and None not in etags.values():
+        __salt__['gh_team.record_converged'](org, name, team["id"], spec, detail['etag'], etags)
+  return ret
 
 
 def present(name, token, org, members=None, permission=None,
-            repos=None, strict=False, dry_run=False):
+            repos=None, strict=False, concurrency=4, recheck_after=RECHECK_AFTER, dry_run=False):
   '''
   Ensure that a team is present
 
@@ -57,99 +218,56 @@ def present(name, token, org, members=None, permission=None,
   strict
       Remove from the team any unlisted members or repos. False by default.
 
+  concurrency
+      Number of members or repos to check, add or remove at once. 4 by default.
+
+  recheck_after
+      Seconds for which a converged team whose ETags haven't changed is skipped. RECHECK_AFTER,
+      an hour, by default; 0 checks the team in full on every run.
+
   dry_run
       Don't actually make any changes in GitHub. False by default.
 
+  When strict is False and only a few members or repos are listed for a large team, each is
+  checked individually rather than listing the whole team, whichever takes fewer requests.
+
+  Once a team has converged, a later run with the same arguments only makes conditional
+  requests, for the team and for each page of its members and repos listings, and skips the team
+  if GitHub says none has changed since. GitHub answers those without counting them against the
+  rate limit. A member or repo added or removed outside Salt changes a listing, so the team is
+  then checked in full, and a strict run removes what is unlisted. Teams whose members or repos
+  are checked individually, because listing them would take more requests, are checked that way
+  every run.
+
+  If some members or repos fail to be added or removed, the next run retries just those from
+  the journal salt_org.reconcile keeps, without listing the team's members or repos again. A
+  run that only retried isn't recorded as converged, so the next one checks the team in full.
   '''
   ret = {'name': name,
          'changes': {},
          'result': True,
          'comment': ''}
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  return __salt__['salt_org.run_state'](
+      ret, 'github', lambda: _present(ret, name, token, org, members, permission, repos,
+                                      strict, concurrency, recheck_after, dry_run))
+
+
+def _absent(ret, name, token, org, dry_run):
+  '''
+  Delete a team for absent, filling in its state return ret.
+  '''
   teams = __salt__['gh_team.list'](token, org)
+  if teams is False:
+    ret["result"] = False
+    ret["comment"] = "Error listing GitHub teams"
+    return ret
   team = next((t for t in teams if t["name"] == name), None)
   if team is None:
-    # Team doesn't exist
-    if dry_run:
-      ret['changes']['add'] = {'org': org, 'name': name, 'permission': permission, 'repos': repos}
-      return ret
-    team = __salt__['gh_team.add'](token, org, name, permission, repos)
-    if team is not None:
-      ret['changes']['add'] = {'org': org, 'name': name, 'permission': permission, 'repos': repos}
-    else:
-      ret["result"] = False
-      ret["comment"] = "Error adding GitHub team"
-      return ret
-  team = __salt__['gh_team.get'](token, team["id"])  # get more detail
-
-  # ensure permission is correct
-  if permission is not None and team["permission"] != permission:
-    if dry_run or __salt__['gh_team.edit'](token, team["id"], name, permission) is not None:
-      ret['changes']['edit'] = {'team': team["id"], 'name': name, 'permission': permission}
-    else:
-      ret["result"] = False
-      ret["comment"] = "Error editing permission"
-      return ret
-
-  # ensure team membership is correct
-  if members is not None:
-    member_objs = __salt__['gh_team.list_members'](token, team["id"])
-    if member_objs is None:
-      ret["result"] = False
-      ret["comment"] = "Error fetching team members"
-      return ret
-    members_currently = set([m["login"] for m in member_objs])  # set of usernames
-    members_desired = set(members)
-    members_to_add = members_desired - members_currently
-    members_to_remove = (members_currently - members_desired) if strict else set()
-    if len(members_to_add):
-      ret['changes']['add_member'] = []
-      for member_to_add in members_to_add:
-        if dry_run or __salt__['gh_team.add_membership'](token, team["id"], member_to_add):
-          ret['changes']['add_member'].append(member_to_add)
-        else:
-          ret["result"] = False
-          ret["comment"] = "Error adding {} to team".format(member_to_add)
-          return ret
-    if len(members_to_remove):
-      ret['changes']['remove_member'] = []
-      for member_to_remove in members_to_remove:
-        if dry_run or __salt__['gh_team.remove_membership'](token, team["id"], member_to_remove):
-          ret['changes']['remove_member'].append(member_to_remove)
-        else:
-          ret["result"] = False
-          ret["comment"] = "Error removing {} from team".format(member_to_remove)
-          return ret
-
-  # ensure repo access is correct
-  if repos is not None:
-    repo_objs = __salt__['gh_team.list_repos'](token, team["id"])
-    if repo_objs is None:
-      ret["result"] = False
-      ret["comment"] = "Error fetching repos"
-      return ret
-    repos_currently = set([m["full_name"] for m in repo_objs])  # set of full "Org/repo" strings
-    repos_desired = set(repos)
-    repos_to_add = repos_desired - repos_currently
-    repos_to_remove = repos_currently - repos_desired if strict else set()
-    if len(repos_to_add):
-      ret['changes']['add_repo'] = []
-      for repo_to_add in repos_to_add:
-        if dry_run or __salt__['gh_team.add_repo'](token, team["id"], repo_to_add):
-          ret['changes']['add_repo'].append(repo_to_add)
-        else:
-          ret["result"] = False
-          ret["comment"] = "Error adding repo {} to team".format(repo_to_add)
-          return ret
-    if len(repos_to_remove):
-      ret['changes']['remove_repo'] = []
-      for repo_to_remove in repos_to_remove:
-        if dry_run or __salt__['gh_team.remove_repo'](token, team["id"], repo_to_remove):
-          ret['changes']['remove_repo'].append(repo_to_remove)
-        else:
-          ret["result"] = False
-          ret["comment"] = "Error removing repo {} from team".format(repo_to_remove)
-          return ret
-
+    # Team doesn't exist, success!
+    return ret
+  ret['result'] = dry_run or __salt__['gh_team.remove'](token, team["id"])
   return ret
 
 
@@ -173,10 +291,7 @@ def absent(name, token, org, dry_run=False):
          'changes': {},
          'result': True,
          'comment': ''}
-  teams = __salt__['gh_team.list'](token, org)
-  team = next((t for t in teams if t["name"] == name), None)
-  if team is None:
-    # Team doesn't exist, success!
-    return
-  ret['result'] = dry_run or __salt__['gh_team.remove'](token, team["id"])
-  return ret
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  return __salt__['salt_org.run_state'](
+      ret, 'github', lambda: _absent(ret, name, token, org, dry_run))
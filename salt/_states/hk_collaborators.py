@@ -13,12 +13,48 @@ Collaborators can either be present or absent:
         - members:
           - rafael.garcia@clever.com
         - strict: False
+
+    all-apps:
+      hk_collaborators.present_many:
+        - token: xxxxx
+        - apps:
+          - clever-website
+        - pattern: clever-*
+        - members:
+          - rafael.garcia@clever.com
+        - concurrency: 8
 '''
 
 import sys
+import fnmatch
+from salt.exceptions import CommandExecutionError
 
 
-def present(name, token, members, strict=False, dry_run=False):
+def _present(ret, name, token, members, strict, concurrency, dry_run):
+  '''
+  Reconcile the collaborators of an app for present, filling in its state return ret.
+  '''
+  journal = 'hk_collaborators/{0}'.format(name)
+  add = lambda member: __salt__['hk_collaborator.create'](token, name, member)
+  remove = lambda member: __salt__['hk_collaborator.delete'](token, name, member)
+  result = __salt__['salt_org.resume'](journal, members, add, remove, strict=strict,
+                                       concurrency=concurrency, dry_run=dry_run)
+  if result is None:
+    try:
+      members_currently_full = __salt__['hk_collaborator.list'](token, name)
+    except CommandExecutionError as exc:
+      ret["result"] = False
+      ret["comment"] = "Error fetching collaborators: {0}".format(exc)
+      return ret
+
+    # ensure membership is correct
+    result = __salt__['salt_org.reconcile'](
+        [m["user"]["email"] for m in members_currently_full], members, add, remove,
+        strict=strict, concurrency=concurrency, dry_run=dry_run, journal=journal)
+  return __salt__['salt_org.update_ret'](ret, result, 'add_member', 'remove_member')
+
+
+def present(name, token, members, strict=False, concurrency=4, dry_run=False):
   '''
   Ensure that an app is configured to have certain collaborators.
 
@@ -34,6 +70,79 @@ def present(name, token, members, strict=False, dry_run=False):
   strict
       Remove from the list of collaborators any unlisted members. False by default.
 
+  concurrency
+      Number of collaborators to add or remove at once. 4 by default.
+
+  dry_run
+      Don't actually make any changes in Heroku. False by default.
+
+  If some collaborators fail to be added or removed, the next run retries just those from the
+  journal salt_org.reconcile keeps, without listing the app's collaborators again.
+  '''
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  return __salt__['salt_org.run_state'](
+      ret, 'heroku', lambda: _present(ret, name, token, members, strict, concurrency, dry_run))
+
+
+def _present_many(ret, name, token, members, apps, pattern, strict, concurrency, dry_run):
+  '''
+  Reconcile the collaborators of many apps for present_many, filling in its state return ret.
+  '''
+  app_names = set(apps or [])
+  if pattern is not None:
+    try:
+      app_names.update(fnmatch.filter([a['name'] for a in
+                                       __salt__['hk_collaborator.list_apps'](token)], pattern))
+    except CommandExecutionError as exc:
+      ret['result'] = False
+      ret['comment'] = 'Error listing apps: {0}'.format(exc)
+      return ret
+  # apps in other minions' shards are left to them
+  app_names = sorted(app for app in app_names if __salt__['salt_org.in_shard'](app))
+
+  def reconcile(app):
+    sub = {'name': app, 'changes': {}, 'result': True, 'comment': ''}
+    return _present(sub, app, token, members, strict, 1, dry_run)
+
+  return __salt__['salt_org.fan_out'](ret, app_names, reconcile, concurrency)
+
+
+def present_many(name, token, members, apps=None, pattern=None, strict=False, concurrency=8,
+                 dry_run=False):
+  '''
+  Ensure that many apps are configured to have the same collaborators.
+
+  Apps are reconciled concurrently, up to concurrency at a time, with one report for all apps.
+  Each app keeps the same journal as present, so an app whose changes partly failed is finished
+  on the next run without listing its collaborators again.
+
+  name
+      An identifier for this group of apps.
+
+  token
+      Heroku OAuth token to use (can be found on account settings page under "API Key").
+
+  members
+      List of users that should be collaborators on every app.
+
+  apps
+      List of Heroku app names to manage.
+
+  pattern
+      Shell-style pattern (e.g. `clever-*`) matched against the names of all apps the token can
+      access. Matching apps are managed in addition to those listed in apps.
+
+  strict
+      Remove from each app any unlisted collaborators. False by default.
+
+  concurrency
+      Number of Heroku requests to make at once. 8 by default.
+
   dry_run
       Don't actually make any changes in Heroku. False by default.
   '''
@@ -41,30 +150,6 @@ def present(name, token, members, strict=False, dry_run=False):
          'changes': {},
          'result': True,
          'comment': ''}
-  members_currently_full = __salt__['hk_collaborator.list'](token, name)
-
-  # ensure membership is correct
-  members_currently = set([m["user"]["email"] for m in members_currently_full])
-  members_desired = set(members)
-  members_to_add = members_desired - members_currently
-  members_to_remove = (members_currently - members_desired) if strict else set()
-  if len(members_to_add):
-    ret['changes']['add_member'] = []
-    for member_to_add in members_to_add:
-      if dry_run or __salt__['hk_collaborator.create'](token, name, member_to_add):
-        ret['changes']['add_member'].append(member_to_add)
-      else:
-        ret["result"] = False
-        ret["comment"] = "Error adding {} to team".format(member_to_add)
-        return ret
-  if len(members_to_remove):
-    ret['changes']['remove_member'] = []
-    for member_to_remove in members_to_remove:
-      if dry_run or __salt__['hk_collaborator.delete'](token, name, member_to_remove):
-        ret['changes']['remove_member'].append(member_to_remove)
-      else:
-        ret["result"] = False
-        ret["comment"] = "Error removing {} from team".format(member_to_remove)
-        return ret
-
-  return ret
+  return __salt__['salt_org.run_state'](
+      ret, 'heroku', lambda: _present_many(ret, name, token, members, apps, pattern, strict,
+                                           concurrency, dry_run))
@@ -0,0 +1,237 @@
+'''
+Offboarding of people across GitHub, Heroku and AWS
+===================================================
+
+Removes a person from everything they hold in each provider: the GitHub teams of an org, the
+Heroku apps they collaborate on, and their IAM user with its group memberships, access keys,
+signing certificates, MFA devices, policies and console login.
+
+.. code-block:: yaml
+
+    rgarcia:
+      org_member.absent:
+        - github:
+            token: xxxxx
+            org: Clever
+            login: rgarcia
+        - heroku:
+            token: xxxxx
+            email: rgarcia@clever.com
+        - aws:
+            user: rgarcia
+        - concurrency: 16
+'''
+
+import sys
+from salt.exceptions import CommandExecutionError
+
+PROVIDERS = ('github', 'heroku', 'aws')
+
+
+def _succeeded(func):
+  '''
+  Wrap a module function so it returns True when it succeeds: when it returns something other
+  than None or False without raising.
+  '''
+  def call(*args):
+    result = func(*args)
+    return result is not None and result is not False
+  return call
+
+
+def _github(github, concurrency):
+  '''
+  Get the removals to make in GitHub as (action, find, remove) parts. find returns the teams in
+  the org that the login belongs to and a list of errors for teams whose membership couldn't be
+  checked. remove takes a team name.
+  '''
+  token, login = github['token'], github['login']
+  teams = {}
+
+  def list_teams():
+    listed = __salt__['gh_team.list'](token, github['org'])
+    if listed is None or listed is False:
+      raise CommandExecutionError('Error listing teams of {0}'.format(github['org']))
+    teams.update((team['name'], team) for team in listed)
+    return listed
+
+  def check(team):
+    try:
+      return __salt__['gh_team.get_membership'](token, team['id'], login) is not None, None
+    except CommandExecutionError as exc:
+      return False, 'Error checking team {0}: {1}'.format(team['name'], exc)
+
+  def find():
+    listed = list_teams()
+    found = __salt__['salt_org.map_concurrent'](check, listed, concurrency)
+    return ([team['name'] for team, (member, error) in zip(listed, found) if member],
+            [error for member, error in found if error is not None])
+
+  def remove(team):
+    # a resumed run removes teams without having listed them
+    if team not in teams:
+      list_teams()
+    return _succeeded(__salt__['gh_team.remove_membership'])(token, teams[team]['id'], login)
+
+  key = '{0}/{1}'.format(github['org'], login)
+  return [('remove_member', key, find, remove)]
+
+
+def _heroku(heroku, concurrency):
+  '''
+  Get the removals to make in Heroku as (action, find, remove) parts. find returns the apps the
+  email is a collaborator on and a list of errors. remove takes an app name.
+  '''
+  token, email = heroku['token'], heroku['email'].lower()
+
+  def find():
+    apps = sorted(app['name'] for app in __salt__['hk_collaborator.list_apps'](token))
+    found = __salt__['salt_org.map_concurrent'](
+        lambda app: any(c['user']['email'].lower() == email
+                        for c in __salt__['hk_collaborator.iter_list'](token, app)),
+        apps, concurrency)
+    return [app for app, collaborator in zip(apps, found) if collaborator], []
+
+  remove = lambda app: _succeeded(__salt__['hk_collaborator.delete'])(token, app, heroku['email'])
+  return [('remove_collaborator', email, find, remove)]
+
+
+def _accounts(ret, github, heroku, aws, concurrency, account_concurrency, dry_run):
+  '''
+  Offboard from GitHub and Heroku, and from each AWS account in aws['role'] as a run of its own,
+  all at once. The changes and failures of each account are reported under its role.
+  '''
+  def account(role):
+    sub = absent(ret['name'], aws=dict(aws, role=role), concurrency=concurrency,
+                 dry_run=dry_run)
+    failed = sub['changes'].get('failed', {}).get('aws')
+    sub['changes'] = dict(sub['changes'].get('aws', {}), **({'failed': failed} if failed else {}))
+    return sub
+
+  accounts = {'name': ret['name'], 'changes': {}, 'result': True, 'comment': ''}
+  runs = [lambda: absent(ret['name'], github, heroku, None, concurrency, dry_run=dry_run),
+          lambda: __salt__['salt_org.fan_out'](accounts, aws['role'], account,
+                                               account_concurrency)]
+  others, accounts = __salt__['salt_org.map_concurrent'](lambda run: run(), runs, len(runs))
+  ret.update(others)
+  if len(accounts['changes']):
+    ret['changes']['aws'] = accounts['changes']
+  if not accounts['result']:
+    ret['result'] = False
+    ret['comment'] = '; '.join([c for c in [ret['comment']] if c] + [accounts['comment']])
+  return ret
+
+
+def absent(name, github=None, heroku=None, aws=None, concurrency=8, account_concurrency=4,
+           dry_run=False):
+  '''
+  Ensure that a person holds nothing in GitHub, Heroku or AWS.
+
+  Every provider is offboarded at once, with one report for all providers. What the person holds
+  in each is discovered and removed through salt_org.reconcile, concurrency requests at a time,
+  with a journal per provider and kind of removal, so removals that failed are retried on the
+  next run without discovering again. The IAM user is deleted last, once everything attached to
+  it is gone.
+
+  name
+      An identifier for the person, used in the report.
+
+  github
+      Mapping with the `token` of an org admin, the `org` and the person's `login`. The login is
+      removed from every team of the org.
+
+  heroku
+      Mapping with a Heroku `token` and the person's `email`. The email is removed as a
+      collaborator from every app the token can access.
+
+  aws
+      Mapping with the person's IAM `user`. The user is removed from its groups, its access keys,
+      signing certificates, MFA devices, policies and console login are removed (see
+      aws_iam.detach_user), and then the user is deleted unless `delete_user` is False. Add the
+      `role` to assume to offboard them from another account, or a list of roles to offboard
+      them from several accounts at once, with the changes reported by role.
+
+  concurrency
+      Number of requests to make at once, in each account. 8 by default.
+
+  account_concurrency
+      Number of AWS accounts to offboard from at once when the aws `role` is a list. 4 by
+      default.
+
+  dry_run
+      Don't actually make any changes. False by default.
+  '''
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+  if __salt__['salt_org.skip_shard'](ret):
+    return ret
+  if aws and isinstance(aws.get('role'), list):
+    return _accounts(ret, github, heroku, aws, concurrency, account_concurrency, dry_run)
+  identities = {'github': github, 'heroku': heroku, 'aws': aws}
+  providers = [provider for provider in PROVIDERS if identities[provider]]
+  discover = {'github': _github, 'heroku': _heroku}
+  errors = []
+  failed = set()
+
+  def offboard(provider):
+    # each part resumes its journal, if any, or else finds what the person holds and reconciles
+    # it with nothing
+    circuit = __salt__['salt_org.circuit_open'](provider) if provider != 'aws' else None
+    if circuit is not None:
+      return [], [circuit]
+    if provider == 'aws':
+      # the IAM user's attachments are journaled per user by aws_iam, which aws_iam_user shares
+      results, errors = __salt__['aws_iam.detach_user'](aws['user'], concurrency, dry_run,
+                                                        aws.get('role'))
+      return results, ['Error finding what {0} holds in aws: {1}'.format(name, error)
+                       for error in errors]
+    results = []
+    errors = []
+    for action, key, find, remove in discover[provider](identities[provider], concurrency):
+      journal = 'org_member/{0}/{1}/{2}'.format(provider, key, action)
+      result = None
+      if not dry_run:
+        result = __salt__['salt_org.resume'](journal, [], None, remove, strict=True,
+                                             concurrency=concurrency)
+      if result is None:
+        try:
+          found, found_errors = find()
+        except CommandExecutionError as exc:
+          return results, errors + ['Error finding what {0} holds in {1}: {2}'.format(
+              name, provider, exc)]
+        errors.extend('Error finding what {0} holds in {1}: {2}'.format(name, provider, error)
+                      for error in found_errors)
+        result = __salt__['salt_org.reconcile'](
+            found, [], None, remove, strict=True, concurrency=concurrency, dry_run=dry_run,
+            journal=None if dry_run else journal)
+      results.append((action, result))
+    return results, errors
+
+  offboarded = __salt__['salt_org.map_concurrent'](offboard, providers, len(providers))
+  for provider, (results, found_errors) in zip(providers, offboarded):
+    if len(found_errors):
+      errors.extend(found_errors)
+      failed.add(provider)
+    for action, result in results:
+      if len(result['remove']):
+        ret['changes'].setdefault(provider, {})[action] = result['remove']
+      for target, error in sorted(result['failed']['remove'].iteritems()):
+        errors.append('Error running {0} {1} in {2}: {3}'.format(action, target, provider, error))
+        failed.add(provider)
+        ret['changes'].setdefault('failed', {}).setdefault(provider, {}) \
+            .setdefault(action, {})[target] = error
+
+  # the user can only be deleted once nothing is attached to it
+  if aws and aws.get('delete_user', True) and 'aws' not in failed and \
+          aws['user'] in __salt__['aws_iam.snapshot'](role=aws.get('role'))['users']:
+    if dry_run or __salt__['aws_iam.delete_user'](aws['user'], aws.get('role')) is not None:
+      ret['changes'].setdefault('aws', {})['delete_user'] = aws['user']
+    else:
+      errors.append('Error deleting IAM user {0}'.format(aws['user']))
+
+  if len(errors):
+    ret['result'] = False
+    ret['comment'] = '; '.join(errors)
+  return ret
@@ -0,0 +1,65 @@
+'''
+Time how long salt takes to load its execution modules with and without the salt-org modules,
+and how long each salt-org module takes to import on its own.
+
+    python test/bench_loader.py [rounds]
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULES = os.path.join(ROOT, 'salt', '_modules')
+
+
+def _median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def loader_time(module_dirs, rounds):
+  import salt.config
+  import salt.loader
+  opts = salt.config.minion_config(None)
+  opts['file_client'] = 'local'
+  opts['module_dirs'] = module_dirs
+  opts['grains'] = salt.loader.grains(opts)
+  times = []
+  functions = 0
+  for _ in range(rounds):
+    opts['extension_modules'] = tempfile.mkdtemp()
+    try:
+      started = time.time()
+      functions = len(salt.loader.minion_mods(opts))
+      times.append(time.time() - started)
+    finally:
+      shutil.rmtree(opts['extension_modules'])
+  return _median(times), functions
+
+
+def import_time(module, rounds):
+  # each import runs in a fresh interpreter so nothing is already in sys.modules
+  code = ('import sys, time; sys.path.insert(0, {0!r}); import salt.exceptions; '
+          'started = time.time(); import {1}; print(time.time() - started)').format(MODULES, module)
+  return _median([float(subprocess.check_output([sys.executable, '-c', code]))
+                  for _ in range(rounds)])
+
+
+def main(rounds=5):
+  loader_time([], 1)  # warm up the interpreter's own imports
+  without, base = loader_time([], rounds)
+  with_org, total = loader_time([os.path.join(ROOT, 'salt')], rounds)
+  print('loader without salt-org: {0:.3f}s, {1} functions'.format(without, base))
+  print('loader with salt-org:    {0:.3f}s, {1} functions (+{2:.3f}s)'.format(
+      with_org, total, with_org - without))
+  for name in sorted(os.listdir(MODULES)):
+    if name.endswith('.py'):
+      print('import {0:<20} {1:.4f}s'.format(name[:-3], import_time(name[:-3], rounds)))
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:]])
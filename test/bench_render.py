@@ -0,0 +1,51 @@
+'''
+Compare rendering a large org's states with Jinja loops and Salt's YAML renderer against the org
+renderer: wall time and peak memory of each, in a process of its own.
+
+    python test/bench_render.py [teams] [repos per team] [rounds]
+'''
+
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from test_org_renderer import pillar, render_jinja, render_org, normalize
+
+RENDERERS = {'jinja|yaml': render_jinja, 'org': render_org}
+
+
+def _median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def measure(renderer, teams, repos, rounds):
+  data = pillar(teams=teams, repos=repos, apps=teams // 2, groups=teams // 5, users=300)
+  times = []
+  for _ in range(rounds):
+    started = time.time()
+    high = RENDERERS[renderer](data)
+    times.append(time.time() - started)
+  return {'seconds': _median(times), 'states': len(high),
+          'memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def main(teams=150, repos=200, rounds=3):
+  small = pillar()
+  assert normalize(render_org(small)) == normalize(render_jinja(small))
+  print('{0:<12} {1:>8} {2:>10} {3:>11}'.format('renderer', 'states', 'seconds', 'peak KB'))
+  for renderer in sorted(RENDERERS):
+    # each renderer runs in a process of its own so its peak memory can be measured
+    result = json.loads(subprocess.check_output(
+        [sys.executable, __file__, renderer, str(teams), str(repos), str(rounds)]))
+    print('{0:<12} {1:>8} {2:>10.3f} {3:>11}'.format(
+        renderer, result['states'], result['seconds'], result['memory_kb']))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] in RENDERERS:
+    print(json.dumps(measure(sys.argv[1], *[int(arg) for arg in sys.argv[2:]])))
+  else:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,491 @@
+import unittest
+import sys
+import os
+import base64
+import json
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import aws_iam
+import salt_org
+from test_aws_iam_bench import FakeIAM, FakeSTS, use, aws_iam_user, aws_iam_group
+
+
+class ProbeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.aws = os.path.join(self.dir, 'aws')
+    with open(self.aws, 'w') as f:
+      f.write('#!/bin/sh\n')
+    os.chmod(self.aws, 0755)
+    self.path = os.environ.get('PATH', '')
+    os.environ['PATH'] = self.dir
+    aws_iam.__opts__ = {'cachedir': self.dir}
+    aws_iam._aws_probe.clear()
+
+  def tearDown(self):
+    os.environ['PATH'] = self.path
+    shutil.rmtree(self.dir)
+
+  def test_probe_cached_across_loads(self):
+    self.assertTrue(aws_iam.__virtual__())
+    with open(os.path.join(self.dir, aws_iam.AWS_PROBE_CACHE)) as f:
+      self.assertEqual(json.load(f), {self.dir: self.aws})
+    aws_iam._aws_probe.clear()
+    which = aws_iam.salt.utils.which
+    aws_iam.salt.utils.which = lambda name: self.fail('PATH was scanned again')
+    try:
+      self.assertTrue(aws_iam.__virtual__())
+    finally:
+      aws_iam.salt.utils.which = which
+
+  def test_probe_written_atomically(self):
+    self.assertTrue(aws_iam.__virtual__())
+    self.assertEqual(sorted(os.listdir(self.dir)), sorted(['aws', aws_iam.AWS_PROBE_CACHE]))
+
+  def test_probe_rechecks_missing_binary(self):
+    self.assertTrue(aws_iam.__virtual__())
+    os.remove(self.aws)
+    self.assertFalse(aws_iam.__virtual__())
+    self.assertEqual(aws_iam._aws_probe, {})
+
+
+class ThrottleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice')
+    use(self.fake)
+    self.throttled = 0
+    run_all = self.fake.run_all
+
+    def throttle(cmd):
+      if self.throttled:
+        self.throttled -= 1
+        self.fake.calls['throttled'] += 1
+        return {'retcode': 255, 'stdout': '', 'pid': 1,
+                'stderr': 'An error occurred (Throttling): Rate exceeded'}
+      return run_all(cmd)
+    aws_iam.__salt__['cmd.run_all'] = throttle
+    self.delays = []
+    self.sleep = aws_iam.time.sleep
+    aws_iam.time.sleep = self.delays.append
+
+  def tearDown(self):
+    aws_iam.time.sleep = self.sleep
+
+  def test_retries_when_throttled(self):
+    self.throttled = 3
+    self.assertEqual(len(aws_iam.create_access_key('alice')['AccessKeyId']), 20)
+    self.assertEqual(self.fake.calls['throttled'], 3)
+    self.assertEqual(len(self.delays), 3)
+    for attempt, delay in enumerate(self.delays):
+      backoff = aws_iam.THROTTLE_BACKOFF * 2 ** attempt
+      self.assertTrue(backoff <= delay <= backoff + aws_iam.THROTTLE_BACKOFF)
+
+  def test_gives_up_after_retries(self):
+    self.throttled = 10
+    self.assertEqual(aws_iam.create_access_key('alice'), None)
+    self.assertEqual(self.fake.calls['throttled'], aws_iam.THROTTLE_RETRIES + 1)
+    self.assertEqual(len(self.delays), aws_iam.THROTTLE_RETRIES)
+    self.assertEqual(self.fake.users['alice']['keys'], [])
+
+  def test_other_errors_not_retried(self):
+    self.throttled = 1
+    self.assertEqual(aws_iam._run_aws('iam create-access-key', retries=0,
+                                      **{'user-name': 'alice'}), None)
+    self.assertEqual(aws_iam.create_access_key('nobody'), None)
+    self.assertEqual(self.delays, [])
+
+
+class CanonicalizePolicyTest(unittest.TestCase):
+
+  document = {'Version': '2012-10-17',
+              'Statement': [{'Effect': 'Allow',
+                             'Action': ['s3:PutObject', 's3:GetObject'],
+                             'Resource': 'arn:aws:s3:::bucket/*',
+                             'Principal': {'AWS': 'arn:aws:iam::111111111111:root'}},
+                            {'Effect': 'Deny', 'NotAction': 'iam:*', 'Resource': '*'}]}
+
+  def test_url_encoded(self):
+    encoded = urllib.quote(json.dumps(self.document))
+    self.assertEqual(aws_iam.canonicalize_policy(encoded),
+                     aws_iam.canonicalize_policy(self.document))
+    self.assertEqual(aws_iam.canonicalize_policy(' ' + json.dumps(self.document) + '\n'),
+                     aws_iam.canonicalize_policy(self.document))
+
+  def test_single_values_listed(self):
+    canonical = json.loads(aws_iam.canonicalize_policy(
+        {'Statement': {'Effect': 'Allow', 'Action': 's3:*', 'NotResource': 'arn:aws:s3:::x',
+                       'Principal': {'AWS': 'arn:aws:iam::1:root', 'Service': ['a', 'b']},
+                       'Sid': 'one'}}))
+    self.assertEqual(canonical['Statement'],
+                     [{'Effect': 'Allow', 'Action': ['s3:*'], 'NotResource': ['arn:aws:s3:::x'],
+                       'Principal': {'AWS': ['arn:aws:iam::1:root'], 'Service': ['a', 'b']},
+                       'Sid': 'one'}])
+
+  def test_order_insensitive(self):
+    reordered = {'Statement': [{'Resource': '*', 'NotAction': ['iam:*'], 'Effect': 'Deny'},
+                               {'Principal': {'AWS': ['arn:aws:iam::111111111111:root']},
+                                'Resource': ['arn:aws:s3:::bucket/*'],
+                                'Action': ['s3:GetObject', 's3:PutObject'],
+                                'Effect': 'Allow'}],
+                 'Version': '2012-10-17'}
+    canonical = aws_iam.canonicalize_policy(self.document)
+    self.assertEqual(aws_iam.canonicalize_policy(reordered), canonical)
+    self.assertEqual(aws_iam.policy_hash(reordered), aws_iam.policy_hash(self.document))
+    self.assertFalse(' ' in canonical)
+
+  def test_differences_kept(self):
+    changed = json.loads(json.dumps(self.document))
+    changed['Statement'][0]['Action'].append('s3:DeleteObject')
+    self.assertNotEqual(aws_iam.policy_hash(changed), aws_iam.policy_hash(self.document))
+
+
+class RoleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.accounts = dict(('arn:aws:iam::{0:012d}:role/salt-org'.format(i), FakeIAM())
+                         for i in range(3))
+    for i, (role, fake) in enumerate(sorted(self.accounts.iteritems())):
+      fake.add_user('user{0}'.format(i), keys=1)
+    self.roles = sorted(self.accounts)
+    self.sts = FakeSTS(FakeIAM(), self.accounts)
+    use(self.sts)
+
+  def test_role_assumed_once(self):
+    role = self.roles[1]
+    self.assertEqual([u['UserName'] for u in aws_iam.list_users(role=role)], ['user1'])
+    self.assertEqual(len(aws_iam.list_access_keys('user1', role)), 1)
+    self.assertEqual(aws_iam.list_users(), [])
+    self.assertEqual(self.sts.assumed, {role: 1})
+
+  def test_role_refreshed_before_expiry(self):
+    role = self.roles[0]
+    aws_iam.list_users(role=role)
+    aws_iam._role_sessions[role]['expires'] = time.time() + aws_iam.ROLE_REFRESH - 1
+    aws_iam.list_access_keys('user0', role)
+    self.assertEqual(self.sts.assumed, {role: 2})
+
+  def test_role_not_assumable(self):
+    self.assertEqual(aws_iam.list_access_keys('user0', 'arn:aws:iam::999:role/nope'), None)
+
+  def test_writes_clear_own_account_cache(self):
+    salt_org.__opts__ = {'cachedir': tempfile.mkdtemp()}
+    self.addCleanup(shutil.rmtree, salt_org.__opts__['cachedir'])
+    self.addCleanup(delattr, salt_org, '__opts__')
+    calls = [fake.calls for role, fake in sorted(self.accounts.iteritems())]
+    for role in self.roles[:2]:
+      aws_iam.list_users(role=role)
+    aws_iam.create_access_key('user0', self.roles[0])
+    for role in self.roles[:2]:
+      aws_iam.list_users(role=role)
+    self.assertEqual([c['list-users'] for c in calls[:2]], [2, 1])
+    self.assertTrue(os.path.isdir(os.path.join(salt_org.__opts__['cachedir'], salt_org.CACHE_DIR,
+                                               aws_iam._cache_namespace(self.roles[1]))))
+
+  def test_snapshot_per_role(self):
+    self.assertEqual(sorted(aws_iam.snapshot(role=self.roles[0])['users']), ['user0'])
+    self.assertEqual(sorted(aws_iam.snapshot(role=self.roles[2])['users']), ['user2'])
+
+  def test_users_present_across_accounts(self):
+    ret = aws_iam_user.users_present('roster', [{'rgarcia': {'keys': True}}, 'user0'],
+                                     role=self.roles)
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(sorted(ret['changes']), self.roles)
+    self.assertEqual(sorted(ret['changes'][self.roles[0]]), ['rgarcia'])
+    self.assertEqual(sorted(ret['changes'][self.roles[1]]), ['rgarcia', 'user0'])
+    for fake in self.accounts.values():
+      self.assertEqual(len(fake.users['rgarcia']['keys']), 1)
+    self.assertEqual(self.sts.assumed, dict((role, 1) for role in self.roles))
+
+  def test_fan_out_failure(self):
+    roles = self.roles[:1] + ['arn:aws:iam::999:role/nope']
+    ret = aws_iam_group.absent('group', role=roles)
+    self.assertFalse(ret['result'])
+    self.assertTrue(ret['comment'].startswith('arn:aws:iam::999:role/nope: '))
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice')
+    self.fake.add_user('bob')
+    self.fake.add_group('admins', members=['alice', 'bob'], policies={'read': {'a': 1}})
+    use(self.fake)
+    self.snap = aws_iam.snapshot()
+
+  def test_update_without_snapshot(self):
+    aws_iam._snapshot_update('user', 'carol', {'UserName': 'carol'}, role='other')
+    aws_iam._snapshot_update_policy('admins', 'write', {'b': 2}, role='other')
+    self.assertFalse(aws_iam._snapshot_key('other') in aws_iam.__context__)
+
+  def test_user_added_and_deleted(self):
+    aws_iam._snapshot_update('user', 'carol', {'UserName': 'carol'})
+    self.assertEqual(sorted(self.snap['users']), ['alice', 'bob', 'carol'])
+    aws_iam._snapshot_update('user', 'alice')
+    self.assertEqual(sorted(self.snap['users']), ['bob', 'carol'])
+    self.assertEqual(self.snap['members']['admins'], ['bob'])
+
+  def test_group_added_and_deleted(self):
+    aws_iam._snapshot_update('group', 'ops', {'GroupName': 'ops'})
+    self.assertEqual(self.snap['members']['ops'], [])
+    aws_iam._snapshot_update('group', 'admins')
+    self.assertEqual(sorted(self.snap['groups']), ['ops'])
+    self.assertFalse('admins' in self.snap['members'])
+
+  def test_member_added_and_removed(self):
+    aws_iam._snapshot_update('member', ('bob', 'admins'))
+    self.assertEqual(self.snap['members']['admins'], ['alice'])
+    aws_iam._snapshot_update('member', ('bob', 'admins'), True)
+    aws_iam._snapshot_update('member', ('bob', 'admins'), True)
+    self.assertEqual(sorted(self.snap['members']['admins']), ['alice', 'bob'])
+    aws_iam._snapshot_update('member', ('alice', 'ops'), True)
+    self.assertEqual(self.snap['members']['ops'], ['alice'])
+
+  def test_policy_put_and_deleted(self):
+    aws_iam._snapshot_update_policy('admins', 'read', {'a': 2})
+    aws_iam._snapshot_update_policy('admins', 'write', {'b': 2})
+    policies = dict((p['PolicyName'], p['PolicyDocument'])
+                    for p in self.snap['groups']['admins']['GroupPolicyList'])
+    self.assertEqual(policies, {'read': {'a': 2}, 'write': {'b': 2}})
+    aws_iam._snapshot_update_policy('admins', 'read')
+    self.assertEqual([p['PolicyName'] for p in self.snap['groups']['admins']['GroupPolicyList']],
+                     ['write'])
+    aws_iam._snapshot_update_policy('nobody', 'read', {'a': 1})
+    self.assertFalse('nobody' in self.snap['groups'])
+
+
+class PaginateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.members = ['user{0}'.format(i) for i in range(7)]
+    for name in self.members:
+      self.fake.add_user(name)
+    self.fake.add_group('admins', members=self.members)
+    use(self.fake)
+
+  def test_get_group_follows_next_token(self):
+    group = aws_iam.get_group('admins', page_size=3)
+    self.assertEqual(group['Group']['GroupName'], 'admins')
+    self.assertEqual([u['UserName'] for u in group['Users']], self.members)
+    self.assertEqual(self.fake.calls['get-group'], 3)
+
+  def test_iter_group_members_fetches_lazily(self):
+    members = aws_iam.iter_group_members('admins', page_size=3)
+    self.assertEqual([next(members)['UserName'] for _ in range(4)], self.members[:4])
+    self.assertEqual(self.fake.calls['get-group'], 2)
+    self.assertEqual([u['UserName'] for u in members], self.members[4:])
+    self.assertEqual(self.fake.calls['get-group'], 3)
+
+  def test_get_group_missing(self):
+    self.assertEqual(aws_iam.get_group('nobody', page_size=3), None)
+    self.assertRaises(aws_iam.CommandExecutionError, list,
+                      aws_iam.iter_group_members('nobody', page_size=3))
+
+
+class UpdateUserTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice')
+    use(self.fake)
+
+  def test_options_passed_through(self):
+    self.assertEqual(aws_iam.update_user('alice', **{'new-user-name': 'alicia'}), {})
+    self.assertEqual(sorted(self.fake.users), ['alicia'])
+
+  def test_missing_user(self):
+    self.assertEqual(aws_iam.update_user('nobody', **{'new-user-name': 'alicia'}), None)
+
+
+class UsersPresentTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice', keys=1)
+    self.fake.add_user('bob')
+    use(self.fake)
+
+  def test_normalize_users(self):
+    self.assertEqual(aws_iam_user._normalize_users(
+        ['alice', {'bob': {'keys': True}}, {'carol': None, 'dave': {'keys': False}}]),
+        {'alice': False, 'bob': True, 'carol': False, 'dave': False})
+
+  def test_converged_roster_makes_no_writes(self):
+    ret = aws_iam_user.users_present('roster', [{'alice': {'keys': True}}, 'bob'])
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual(self.fake.calls['list-access-keys'], 1)
+    self.assertEqual(self.fake.calls['create-user'] + self.fake.calls['create-access-key'], 0)
+
+  def test_creates_users_and_keys(self):
+    ret = aws_iam_user.users_present('roster', [{'bob': {'keys': True}}, 'carol',
+                                                {'dave': {'keys': True}}])
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(sorted(ret['changes']), ['bob', 'carol', 'dave'])
+    self.assertEqual(ret['changes']['carol'], {'create_user': {'name': 'carol'}})
+    self.assertEqual(len(self.fake.users['bob']['keys']), 1)
+    self.assertEqual(self.fake.users['carol']['keys'], [])
+    self.assertEqual(len(self.fake.users['dave']['keys']), 1)
+
+  def test_dry_run(self):
+    ret = aws_iam_user.users_present('roster', [{'bob': {'keys': True}}, 'carol'],
+                                     dry_run=True)
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(ret['changes'], {'bob': {'create_access_key': {'name': 'bob'}},
+                                      'carol': {'create_user': {'name': 'carol'}}})
+    self.assertEqual(sorted(self.fake.users), ['alice', 'bob'])
+    self.assertEqual(self.fake.users['bob']['keys'], [])
+
+  def test_errors_reported_per_user(self):
+    self.fake.create_access_key = lambda args: 'LimitExceeded'
+    ret = aws_iam_user.users_present('roster', [{'bob': {'keys': True}}, 'carol'])
+    self.assertFalse(ret['result'])
+    self.assertEqual(ret['comment'], 'Error creating access key for bob')
+    self.assertEqual(ret['changes'], {'carol': {'create_user': {'name': 'carol'}}})
+
+  def test_failed_users_resumed(self):
+    salt_org.__opts__ = {'cachedir': tempfile.mkdtemp()}
+    self.addCleanup(shutil.rmtree, salt_org.__opts__['cachedir'])
+    self.addCleanup(delattr, salt_org, '__opts__')
+    users = [{'bob': {'keys': True}}, 'carol', {'dave': {'keys': True}}]
+    create_access_key = self.fake.create_access_key
+    self.fake.create_access_key = lambda args: 'LimitExceeded'
+    self.assertFalse(aws_iam_user.users_present('roster', users)['result'])
+    self.fake.create_access_key = create_access_key
+    self.fake.calls.clear()
+    ret = aws_iam_user.users_present('roster', users)
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(sorted(ret['changes']), ['bob', 'dave'])
+    self.assertEqual(self.fake.calls['create-access-key'], 2)
+    # carol, created by the first run, isn't looked at again
+    self.assertEqual(self.fake.calls['create-user'], 0)
+    self.assertEqual(self.fake.calls['list-access-keys'], 2)
+
+
+class AbsentTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice', keys=2, certificates=['CERT1'], mfa_devices=['MFA1'],
+                       policies=['inline'], attached=['arn:aws:iam::aws:policy/Admin'],
+                       login=True)
+    self.fake.add_group('admins', members=['alice'])
+    use(self.fake)
+
+  def test_everything_removed_first(self):
+    ret = aws_iam_user.absent('alice')
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(ret['changes'], {
+        'remove_user_from_group': ['admins'],
+        'delete_access_key': ['AKIA0000000000000001', 'AKIA0000000000000002'],
+        'delete_signing_certificate': ['CERT1'],
+        'deactivate_mfa_device': ['MFA1'],
+        'delete_user_policy': ['inline'],
+        'detach_user_policy': ['arn:aws:iam::aws:policy/Admin'],
+        'delete_login_profile': ['alice'],
+        'delete_user': 'alice'})
+    self.assertEqual(self.fake.users, {})
+    self.assertEqual(self.fake.groups['admins']['members'], set())
+    self.assertEqual(aws_iam_user.absent('alice')['changes'], {})
+
+  def test_user_kept_when_removal_fails(self):
+    self.fake.detach_user_policy = lambda args: 'AccessDenied'
+    ret = aws_iam_user.absent('alice')
+    self.assertFalse(ret['result'])
+    self.assertEqual(ret['changes']['failed'], {'detach_user_policy': {
+        'arn:aws:iam::aws:policy/Admin': 'call failed'}})
+    self.assertFalse('delete_user' in ret['changes'])
+    self.assertEqual(self.fake.calls['delete-user'], 0)
+
+  def test_dry_run(self):
+    ret = aws_iam_user.absent('alice', dry_run=True)
+    self.assertEqual(ret['changes']['delete_login_profile'], ['alice'])
+    self.assertEqual(ret['changes']['delete_user'], 'alice')
+    self.assertTrue(self.fake.users['alice']['login'])
+
+
+class CredentialReportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeIAM()
+    self.fake.add_user('alice', keys=2)
+    self.fake.add_user('bob', keys=1)
+    self.fake.add_user('carol')
+    use(self.fake)
+
+  def test_parse_counts_rotated_keys(self):
+    content = base64.b64encode('user,access_key_1_last_rotated,access_key_2_last_rotated\n'
+                               'alice,2015-01-01T00:00:00+00:00,2015-02-01T00:00:00+00:00\n'
+                               'bob,N/A,2015-02-01T00:00:00+00:00\n'
+                               'carol,N/A,N/A\n'
+                               'dave\n')
+    report = aws_iam._parse_credential_report(content)
+    self.assertEqual(dict((user, row['access_key_count']) for user, row in report.iteritems()),
+                     {'alice': 2, 'bob': 1, 'carol': 0, 'dave': 0})
+    self.assertEqual(report['bob']['access_key_1_last_rotated'], 'N/A')
+
+  def test_report_cached(self):
+    report = aws_iam.credential_report()
+    self.assertEqual(report['alice']['access_key_count'], 2)
+    self.assertTrue(aws_iam.credential_report() is report)
+    self.assertEqual(self.fake.calls['get-credential-report'], 1)
+    aws_iam.credential_report(refresh=True)
+    self.assertEqual(self.fake.calls['get-credential-report'], 2)
+
+  def test_concurrent_callers_share_one_fetch(self):
+    generating = threading.Event()
+    release = threading.Event()
+    generate = self.fake.generate_credential_report
+
+    def slow_generate(args):
+      generating.set()
+      release.wait()
+      return generate(args)
+    self.fake.generate_credential_report = slow_generate
+    reports = []
+    threads = [threading.Thread(target=lambda: reports.append(aws_iam.credential_report()))
+               for _ in range(3)]
+    threads[0].start()
+    generating.wait()
+    # the lock is held only to read and write the cache, not while the report generates
+    self.assertTrue(aws_iam._credential_report_lock.acquire(False))
+    aws_iam._credential_report_lock.release()
+    for thread in threads[1:]:
+      thread.start()
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(reports), 3)
+    self.assertTrue(reports[0] is reports[1] is reports[2])
+    self.assertEqual(self.fake.calls['generate-credential-report'], 1)
+
+  def test_fresh_report_trusted_both_ways(self):
+    report = aws_iam.credential_report()
+    self.assertTrue(aws_iam.credential_report_fresh())
+    self.assertTrue(aws_iam_user._has_access_key('bob', report))
+    self.assertFalse(aws_iam_user._has_access_key('carol', report))
+    self.assertEqual(self.fake.calls['list-access-keys'], 0)
+
+  def test_stale_report_confirms_missing_keys(self):
+    report = aws_iam.credential_report()
+    aws_iam._credential_report_cache[None]['generated'] -= aws_iam.CREDENTIAL_REPORT_MAX_AGE
+    self.assertFalse(aws_iam.credential_report_fresh())
+    self.fake.users['carol']['keys'].append(self.fake.new_key_id())
+    self.assertTrue(aws_iam_user._has_access_key('bob', report))
+    self.assertTrue(aws_iam_user._has_access_key('carol', report))
+    self.assertEqual(self.fake.calls['list-access-keys'], 1)
+
+  def test_users_missing_from_report_are_listed(self):
+    report = aws_iam.credential_report()
+    self.fake.add_user('dave', keys=1)
+    self.assertTrue(aws_iam_user._has_access_key('dave', report))
+    self.assertEqual(self.fake.calls['list-access-keys'], 1)
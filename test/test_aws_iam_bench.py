@@ -0,0 +1,406 @@
+'''
+Benchmarks for the AWS IAM states against a local stand-in for the aws CLI.
+
+Each scenario builds a synthetic account, runs a batch of states against it and measures wall
+time, aws calls and peak memory. Run as part of the test suite, it fails when a scenario
+makes more aws calls than its budget allows. Run directly to print the measurements:
+
+    python test/test_aws_iam_bench.py [scenario ...]
+'''
+
+import unittest
+import sys
+import os
+import base64
+import collections
+import imp
+import json
+import resource
+import shlex
+import subprocess
+import threading
+import time
+import urllib
+
+ROOT = os.path.join(os.path.dirname(__file__), '../salt')
+sys.path.insert(0, os.path.join(ROOT, '_modules'))
+import aws_iam
+import salt_org
+aws_iam_user = imp.load_source('aws_iam_user_state', os.path.join(ROOT, '_states/aws_iam_user.py'))
+aws_iam_group = imp.load_source('aws_iam_group_state',
+                                os.path.join(ROOT, '_states/aws_iam_group.py'))
+
+USERS = 300
+GROUPS = 30
+MEMBERS_PER_GROUP = 20
+KEYS_PER_USER = 2
+
+# Most aws calls each scenario may make, by IAM operation. Lower these when a change saves calls.
+BUDGETS = {
+    'group_present': {'get-account-authorization-details': 4,
+                      'add-user-to-group': 60,
+                      'remove-user-from-group': 60,
+                      'put-group-policy': 30},
+    'user_present': {'get-account-authorization-details': 4,
+                     'generate-credential-report': 1,
+                     'get-credential-report': 1,
+                     'create-user': 50,
+                     'create-access-key': 50},
+    'users_present': {'get-account-authorization-details': 4,
+                      'generate-credential-report': 1,
+                      'get-credential-report': 1,
+                      'create-user': 50,
+                      'create-access-key': 50},
+    'user_absent': {'get-account-authorization-details': 4,
+                    'remove-user-from-group': 100,
+                    'list-access-keys': 50,
+                    'delete-access-key': 100,
+                    'list-signing-certificates': 50,
+                    'list-mfa-devices': 50,
+                    'get-login-profile': 50,
+                    'delete-user': 50},
+}
+
+
+def policy(action):
+  return {'Version': '2012-10-17',
+          'Statement': [{'Effect': 'Allow', 'Action': action, 'Resource': '*'}]}
+
+
+class FakeIAM(object):
+
+  '''
+  Stand-in for the aws CLI, answering the IAM commands aws_iam runs through cmd.run_all from an
+  in-memory account, and counting them by operation.
+  '''
+
+  def __init__(self):
+    self.users = {}
+    self.groups = {}
+    self.calls = collections.Counter()
+    self.lock = threading.Lock()
+    self.key_ids = 0
+
+  def add_user(self, name, keys=0, certificates=(), mfa_devices=(), policies=(), attached=(),
+               login=False):
+    self.users[name] = {'keys': [self.new_key_id() for _ in range(keys)], 'groups': set(),
+                        'certificates': list(certificates), 'mfa_devices': list(mfa_devices),
+                        'policies': list(policies), 'attached': list(attached), 'login': login}
+
+  def add_group(self, name, members=(), policies=None):
+    self.groups[name] = {'members': set(members), 'policies': dict(policies or {})}
+    for member in members:
+      self.users[member]['groups'].add(name)
+
+  def new_key_id(self):
+    self.key_ids += 1
+    return 'AKIA{0:016d}'.format(self.key_ids)
+
+  def run_all(self, cmd):
+    words = shlex.split(cmd)
+    operation = words[2]
+    args = {}
+    for word in words[3:]:
+      if word.startswith('--'):
+        key = word[2:]
+        args[key] = []
+      else:
+        args[key].append(word)
+    args = dict((k, v[0] if len(v) == 1 else v) for k, v in args.iteritems())
+    with self.lock:
+      self.calls[operation] += 1
+      handler = getattr(self, operation.replace('-', '_'), None)
+      if handler is None:
+        return {'retcode': 255, 'stdout': '', 'stderr': 'unsupported: ' + operation, 'pid': 1}
+      try:
+        out = handler(args)
+      except KeyError as exc:
+        return {'retcode': 255, 'stdout': '', 'stderr': 'NoSuchEntity: {0}'.format(exc), 'pid': 1}
+    if isinstance(out, basestring):
+      return {'retcode': 255, 'stdout': '', 'stderr': out, 'pid': 1}
+    return {'retcode': 0, 'stdout': '' if out is None else json.dumps(out), 'stderr': '',
+            'pid': 1}
+
+  def get_account_authorization_details(self, args):
+    items = [('user', name) for name in sorted(self.users)] + \
+        [('group', name) for name in sorted(self.groups)]
+    start = int(args.get('starting-token', 0))
+    end = start + int(args['max-items'])
+    page = {'UserDetailList': [], 'GroupDetailList': []}
+    for kind, name in items[start:end]:
+      if kind == 'user':
+        user = self.users[name]
+        page['UserDetailList'].append(
+            {'UserName': name,
+             'GroupList': sorted(user['groups']),
+             'UserPolicyList': [{'PolicyName': policy_name} for policy_name in user['policies']],
+             'AttachedManagedPolicies': [{'PolicyArn': arn} for arn in user['attached']]})
+      else:
+        page['GroupDetailList'].append(
+            {'GroupName': name,
+             'GroupPolicyList': [{'PolicyName': policy_name,
+                                  'PolicyDocument': urllib.quote(json.dumps(document))}
+                                 for policy_name, document in
+                                 self.groups[name]['policies'].iteritems()]})
+    if end < len(items):
+      page['NextToken'] = str(end)
+    return page
+
+  def get_group(self, args):
+    members = sorted(self.groups[args['group-name']]['members'])
+    start = int(args.get('starting-token', 0))
+    end = start + int(args['max-items'])
+    page = {'Group': {'GroupName': args['group-name']},
+            'Users': [{'UserName': name} for name in members[start:end]]}
+    if end < len(members):
+      page['NextToken'] = str(end)
+    return page
+
+  def list_users(self, args):
+    return {'Users': [{'UserName': name} for name in sorted(self.users)]}
+
+  def create_user(self, args):
+    if args['user-name'] in self.users:
+      return 'EntityAlreadyExists'
+    self.add_user(args['user-name'])
+    return {'User': {'UserName': args['user-name']}}
+
+  def delete_user(self, args):
+    user = self.users[args['user-name']]
+    for attachment in ('groups', 'keys', 'certificates', 'mfa_devices', 'policies', 'attached',
+                       'login'):
+      if user[attachment]:
+        return 'DeleteConflict: user has {0}'.format(attachment)
+    del self.users[args['user-name']]
+
+  def update_user(self, args):
+    user = self.users.pop(args['user-name'])
+    self.users[args.get('new-user-name', args['user-name'])] = user
+
+  def list_access_keys(self, args):
+    return {'AccessKeyMetadata': [{'UserName': args['user-name'], 'AccessKeyId': key_id}
+                                  for key_id in self.users[args['user-name']]['keys']]}
+
+  def create_access_key(self, args):
+    key_id = self.new_key_id()
+    self.users[args['user-name']]['keys'].append(key_id)
+    return {'AccessKey': {'UserName': args['user-name'], 'AccessKeyId': key_id}}
+
+  def delete_access_key(self, args):
+    self.users[args['user-name']]['keys'].remove(args['access-key-id'])
+
+  def list_signing_certificates(self, args):
+    return {'Certificates': [{'UserName': args['user-name'], 'CertificateId': certificate_id}
+                             for certificate_id in self.users[args['user-name']]['certificates']]}
+
+  def delete_signing_certificate(self, args):
+    self.users[args['user-name']]['certificates'].remove(args['certificate-id'])
+
+  def list_mfa_devices(self, args):
+    return {'MFADevices': [{'UserName': args['user-name'], 'SerialNumber': serial_number}
+                           for serial_number in self.users[args['user-name']]['mfa_devices']]}
+
+  def deactivate_mfa_device(self, args):
+    self.users[args['user-name']]['mfa_devices'].remove(args['serial-number'])
+
+  def delete_user_policy(self, args):
+    self.users[args['user-name']]['policies'].remove(args['policy-name'])
+
+  def detach_user_policy(self, args):
+    self.users[args['user-name']]['attached'].remove(args['policy-arn'])
+
+  def get_login_profile(self, args):
+    if not self.users[args['user-name']]['login']:
+      return 'NoSuchEntity: no login profile'
+    return {'LoginProfile': {'UserName': args['user-name']}}
+
+  def delete_login_profile(self, args):
+    if not self.users[args['user-name']]['login']:
+      return 'NoSuchEntity: no login profile'
+    self.users[args['user-name']]['login'] = False
+
+  def add_user_to_group(self, args):
+    self.users[args['user-name']]['groups'].add(args['group-name'])
+    self.groups[args['group-name']]['members'].add(args['user-name'])
+
+  def remove_user_from_group(self, args):
+    self.users[args['user-name']]['groups'].discard(args['group-name'])
+    self.groups[args['group-name']]['members'].discard(args['user-name'])
+
+  def put_group_policy(self, args):
+    self.groups[args['group-name']]['policies'][args['policy-name']] = \
+        json.loads(args['policy-document'])
+
+  def delete_group_policy(self, args):
+    del self.groups[args['group-name']]['policies'][args['policy-name']]
+
+  def generate_credential_report(self, args):
+    return {'State': 'COMPLETE'}
+
+  def get_credential_report(self, args):
+    rows = ['user,access_key_1_last_rotated,access_key_2_last_rotated']
+    for name, user in sorted(self.users.iteritems()):
+      rotated = ['2015-01-01T00:00:00+00:00'] * len(user['keys'][:2])
+      rows.append(','.join([name] + rotated + ['N/A'] * (2 - len(rotated))))
+    return {'Content': base64.b64encode('\n'.join(rows) + '\n'),
+            'GeneratedTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+
+class FakeSTS(object):
+
+  '''
+  Stand-in for the aws CLI across several accounts. Answers sts assume-role with temporary
+  credentials for a role, and sends IAM commands to the account of the role whose credentials
+  are in the environment, or to the default account without any.
+  '''
+
+  def __init__(self, default, accounts, duration=3600):
+    self.default = default
+    self.accounts = accounts
+    self.duration = duration
+    self.sessions = {}
+    self.assumed = collections.Counter()
+    self.lock = threading.Lock()
+
+  def run_all(self, cmd, env=None):
+    words = shlex.split(cmd)
+    if words[1] != 'sts':
+      if not env:
+        return self.default.run_all(cmd)
+      return self.accounts[self.sessions[env['AWS_ACCESS_KEY_ID']]].run_all(cmd)
+    role = words[words.index('--role-arn') + 1]
+    if role not in self.accounts:
+      return {'retcode': 255, 'stdout': '', 'stderr': 'AccessDenied: ' + role, 'pid': 1}
+    with self.lock:
+      self.assumed[role] += 1
+      key_id = 'ASIA{0:016d}'.format(sum(self.assumed.values()))
+      self.sessions[key_id] = role
+    expiration = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + self.duration))
+    return {'retcode': 0, 'stderr': '', 'pid': 1,
+            'stdout': json.dumps({'Credentials': {'AccessKeyId': key_id,
+                                                  'SecretAccessKey': 'secret',
+                                                  'SessionToken': 'token',
+                                                  'Expiration': expiration}})}
+
+
+def account():
+  '''
+  Build a synthetic account: USERS users with KEYS_PER_USER access keys each, and GROUPS groups
+  of MEMBERS_PER_GROUP users with two inline policies each.
+  '''
+  fake = FakeIAM()
+  for i in range(USERS):
+    fake.add_user('user{0:04d}'.format(i), KEYS_PER_USER)
+  for i in range(GROUPS):
+    members = ['user{0:04d}'.format((i * MEMBERS_PER_GROUP + j) % USERS)
+               for j in range(MEMBERS_PER_GROUP)]
+    fake.add_group('group{0:03d}'.format(i), members,
+                   {'read': policy('s3:Get*'), 'write': policy('s3:Put*')})
+  return fake
+
+
+def use(fake):
+  '''
+  Point the aws_iam module and the IAM states at a fake account for one run.
+  '''
+  aws_iam.__salt__ = {'cmd.run_all': fake.run_all,
+                      'salt_org.cached': salt_org.cached,
+                      'salt_org.cache_clear': salt_org.cache_clear,
+                      'salt_org.count_call': salt_org.count_call,
+                      'salt_org.reconcile': salt_org.reconcile,
+                      'salt_org.resume': salt_org.resume}
+  aws_iam.__context__ = {}
+  aws_iam._credential_report_cache.clear()
+  aws_iam._role_sessions.clear()
+  funcs = dict(('aws_iam.' + name, getattr(aws_iam, name)) for name in dir(aws_iam)
+               if not name.startswith('_') and callable(getattr(aws_iam, name)))
+  funcs.update(('salt_org.' + name, getattr(salt_org, name))
+               for name in ('map_concurrent', 'reconcile', 'resume', 'update_ret', 'in_shard',
+                            'skip_shard', 'fan_out'))
+  aws_iam_user.__salt__ = aws_iam_group.__salt__ = funcs
+
+
+def group_present(fake):
+  # swap two members of every group for two others and change one policy
+  for i, name in enumerate(sorted(fake.groups)):
+    members = sorted(fake.groups[name]['members'])[2:] + \
+        ['user{0:04d}'.format((i * MEMBERS_PER_GROUP + MEMBERS_PER_GROUP + j) % USERS)
+         for j in range(2)]
+    yield aws_iam_group.present(name, members=members, strict=True,
+                                policies={'read': policy('s3:Get*'), 'write': policy('s3:*')})
+
+
+def user_present(fake):
+  # every user needs keys; the last 50 don't exist yet
+  for i in range(USERS - 50, USERS + 50):
+    yield aws_iam_user.present('user{0:04d}'.format(i), keys=True, credential_report=True)
+
+
+def users_present(fake):
+  users = [{'user{0:04d}'.format(i): {'keys': True}} for i in range(USERS - 50, USERS + 50)]
+  yield aws_iam_user.users_present('roster', users, credential_report=True)
+
+
+def user_absent(fake):
+  for i in range(50):
+    yield aws_iam_user.absent('user{0:04d}'.format(i))
+
+SCENARIOS = collections.OrderedDict((scenario.__name__, scenario) for scenario in
+                                    (group_present, user_present, users_present, user_absent))
+
+
+def measure(name):
+  '''
+  Run a scenario against a fresh account. Returns its state returns, aws calls by operation,
+  wall time in seconds and the process's peak memory in KB.
+  '''
+  fake = account()
+  use(fake)
+  started = time.time()
+  rets = [ret for ret in SCENARIOS[name](fake)]
+  return {'rets': rets,
+          'calls': fake.calls,
+          'seconds': time.time() - started,
+          'memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+class AWSIAMBenchTest(unittest.TestCase):
+
+  def check(self, name):
+    result = measure(name)
+    for ret in result['rets']:
+      self.assertTrue(ret['result'], ret['comment'])
+    over = dict((operation, count) for operation, count in result['calls'].iteritems()
+                if count > BUDGETS[name].get(operation, 0))
+    self.assertEqual(over, {}, '{0} made more aws calls than budgeted: {1}'.format(name, over))
+    return result
+
+  def test_group_present(self):
+    self.check('group_present')
+
+  def test_user_present(self):
+    self.check('user_present')
+
+  def test_users_present(self):
+    self.check('users_present')
+
+  def test_user_absent(self):
+    self.check('user_absent')
+
+
+def main(names):
+  if len(names) == 1:
+    # a single scenario, in a process of its own so its peak memory can be measured
+    result = measure(names[0])
+    print(json.dumps({'calls': sum(result['calls'].values()), 'seconds': result['seconds'],
+                      'memory_kb': result['memory_kb']}))
+    return
+  print('{0:<16} {1:>8} {2:>10} {3:>11}'.format('scenario', 'calls', 'seconds', 'peak KB'))
+  for name in names or SCENARIOS:
+    result = json.loads(subprocess.check_output([sys.executable, __file__, name]))
+    print('{0:<16} {1:>8} {2:>10.3f} {3:>11}'.format(
+        name, result['calls'], result['seconds'], result['memory_kb']))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,98 @@
+import unittest
+import sys
+import os
+import json
+import threading
+import time
+import mock
+import responses
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+import gh_api
+gh_api.__salt__ = {'salt_org.guard': salt_org.guard,
+                   'salt_org.cached_response': salt_org.cached_response,
+                   'salt_org.cache_clear': salt_org.cache_clear}
+
+POOL = {'admin': 'admin-token', 'read': ['read-token']}
+
+
+def rate_limited(remaining):
+  return {'X-RateLimit-Remaining': str(remaining),
+          'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+
+
+class GHAPITest(unittest.TestCase):
+
+  def setUp(self):
+    gh_api._pools.clear()
+
+  @responses.activate
+  def test_single_token(self):
+    responses.add(responses.GET, 'https://api.github.com/orgs/:org/teams', body='[]',
+                  status=200, content_type='application/json')
+    r = gh_api.request('GET', 'token', '/orgs/:org/teams')
+    self.assertEqual(r.status_code, 200)
+    self.assertEqual(responses.calls[0].request.headers['Authorization'], 'token token')
+
+  @responses.activate
+  def test_reads_go_to_largest_budget(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/1', body='{}', status=200,
+                  adding_headers=rate_limited(10), content_type='application/json')
+    gh_api.request('GET', POOL, '/teams/1')
+    gh_api._get_pool(POOL).readers[0].update(rate_limited(5))
+    gh_api.request('GET', POOL, '/teams/1')
+    gh_api.request('GET', POOL, '/teams/1')
+    tokens = [c.request.headers['Authorization'] for c in responses.calls]
+    self.assertEqual(tokens, ['token read-token', 'token read-token', 'token read-token'])
+    self.assertEqual(gh_api.budget(POOL), [5, 10])
+
+  @responses.activate
+  def test_concurrent_cold_reads_spread(self):
+    def slow_team(request):
+      time.sleep(0.05)
+      return (200, {}, '{}')
+    for i in range(3):
+      responses.add_callback(responses.GET, 'https://api.github.com/teams/{0}'.format(i),
+                             callback=slow_team)
+    pool = {'admin': 'admin-token', 'read': ['read-1', 'read-2', 'read-3']}
+    threads = [threading.Thread(target=gh_api.request, args=('GET', pool, '/teams/{0}'.format(i)))
+               for i in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    tokens = sorted(c.request.headers['Authorization'] for c in responses.calls)
+    self.assertEqual(tokens, ['token read-1', 'token read-2', 'token read-3'])
+    self.assertEqual(gh_api.budget(pool), [gh_api.RATE_LIMIT] * 4)
+
+  @responses.activate
+  def test_writes_use_admin_token(self):
+    responses.add(responses.PUT, 'https://api.github.com/teams/1/memberships/someone',
+                  body='{}', status=200, adding_headers=rate_limited(1),
+                  content_type='application/json')
+    for _ in range(3):
+      gh_api.request('PUT', POOL, '/teams/1/memberships/someone')
+    tokens = set(c.request.headers['Authorization'] for c in responses.calls)
+    self.assertEqual(tokens, set(['token admin-token']))
+
+  @responses.activate
+  def test_app_installation_token_is_cached(self):
+    responses.add(responses.POST, 'https://api.github.com/app/installations/2/access_tokens',
+                  body=json.dumps({'token': 'installation-token',
+                                   'expires_at': '2100-01-01T00:00:00Z'}),
+                  status=201, content_type='application/json')
+    responses.add(responses.GET, 'https://api.github.com/teams/1', body='{}', status=200,
+                  content_type='application/json')
+    pool = {'admin': 'admin-token',
+            'apps': [{'app_id': 1, 'installation_id': 2, 'private_key': 'key'}]}
+    # make the admin token look spent so reads go to the app
+    gh_api._get_pool(pool).admin.update(rate_limited(0))
+    with mock.patch.object(gh_api, '_app_jwt', return_value='jwt'):
+      gh_api.request('GET', pool, '/teams/1')
+      gh_api.request('GET', pool, '/teams/1')
+    urls = [c.request.url for c in responses.calls]
+    self.assertEqual(urls.count('https://api.github.com/app/installations/2/access_tokens'), 1)
+    self.assertEqual(responses.calls[0].request.headers['Authorization'], 'Bearer jwt')
+    self.assertEqual(responses.calls[1].request.headers['Authorization'],
+                     'token installation-token')
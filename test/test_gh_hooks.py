@@ -0,0 +1,123 @@
+import unittest
+import sys
+import os
+import imp
+import json
+import shutil
+import tempfile
+import urlparse
+import responses
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+import gh_api
+import gh_hooks
+gh_api.__salt__ = {'salt_org.guard': salt_org.guard,
+                   'salt_org.cached_response': salt_org.cached_response,
+                   'salt_org.cache_clear': salt_org.cache_clear}
+gh_hooks.__salt__ = {'gh_api.request': gh_api.request}
+gh_hooks_state = imp.load_source('gh_hooks_state', os.path.join(os.path.dirname(__file__),
+                                                                '../salt/_states/gh_hooks.py'))
+gh_hooks_state.__salt__ = dict(
+    [('gh_hooks.' + name, getattr(gh_hooks, name)) for name in
+     ('list', 'add', 'edit', 'remove', 'fingerprint', 'masked_fields', 'applied_fingerprint')] +
+    [('salt_org.' + name, getattr(salt_org, name)) for name in ('skip_shard', 'run_state')])
+
+HOOKS_URL = 'https://api.github.com/repos/Clever/clever-js/hooks'
+CONFIG = {'auth_token': 'secret', 'room': 'Clever-Dev'}
+
+
+class GHHooksTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    gh_hooks.__opts__ = {'cachedir': self.dir}
+    gh_hooks._fingerprints = None
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  @responses.activate
+  def test_add_records_fingerprint(self):
+    responses.add(responses.POST, HOOKS_URL, body=json.dumps({'id': 1, 'name': 'hipchat'}),
+                  status=201, content_type='application/json')
+    gh_hooks.add('token', 'Clever/clever-js', 'hipchat', CONFIG, ['push'])
+    gh_hooks._fingerprints = None  # as if in a later run
+    self.assertEqual(gh_hooks.applied_fingerprint('Clever/clever-js', 1),
+                     gh_hooks.fingerprint(dict(CONFIG)))
+    self.assertEqual(oct(os.stat(os.path.join(self.dir, gh_hooks.FINGERPRINT_FILE)).st_mode & 0777),
+                     '0600')
+
+  @responses.activate
+  def test_edit_and_remove_update_fingerprint(self):
+    responses.add(responses.PATCH, HOOKS_URL + '/1', body=json.dumps({'id': 1}),
+                  status=200, content_type='application/json')
+    responses.add(responses.DELETE, HOOKS_URL + '/1', status=204)
+    gh_hooks.edit('token', 'Clever/clever-js', 1, {'active': False})
+    self.assertEqual(gh_hooks.applied_fingerprint('Clever/clever-js', 1), None)
+    gh_hooks.edit('token', 'Clever/clever-js', 1, {'config': CONFIG})
+    self.assertEqual(gh_hooks.applied_fingerprint('Clever/clever-js', 1),
+                     gh_hooks.fingerprint(CONFIG))
+    gh_hooks.remove('token', 'Clever/clever-js', 1)
+    self.assertEqual(gh_hooks.applied_fingerprint('Clever/clever-js', 1), None)
+
+  def test_masked_fields(self):
+    self.assertEqual(gh_hooks.masked_fields({'auth_token': '********', 'room': 'Clever-Dev'}),
+                     set(['auth_token']))
+
+
+class GHHooksStateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    gh_hooks.__opts__ = {'cachedir': self.dir}
+    gh_hooks._fingerprints = None
+    self.hooks = {}
+    responses.start()
+    responses.add_callback(responses.GET, HOOKS_URL, callback=self.list_hooks)
+    responses.add_callback(responses.POST, HOOKS_URL, callback=self.add_hook)
+    responses.add_callback(responses.PATCH, HOOKS_URL + '/1', callback=self.edit_hook)
+
+  def tearDown(self):
+    responses.stop()
+    responses.reset()
+    shutil.rmtree(self.dir)
+
+  def list_hooks(self, request):
+    page = int(urlparse.parse_qs(urlparse.urlparse(request.url).query)['page'][0])
+    # GitHub masks secrets in the configs it returns
+    hooks = [dict(hook, config=dict(hook['config'], auth_token=gh_hooks.MASK))
+             for hook in self.hooks.values()]
+    return (200, {}, json.dumps(hooks if page == 1 else []))
+
+  def add_hook(self, request):
+    self.hooks[1] = dict(json.loads(request.body), id=1)
+    return (201, {}, json.dumps(self.hooks[1]))
+
+  def edit_hook(self, request):
+    self.hooks[1].update(json.loads(request.body))
+    return (200, {}, json.dumps(self.hooks[1]))
+
+  def present(self, config):
+    return gh_hooks_state.present('Clever/clever-js', 'token', [
+        {'name': 'hipchat', 'config': config, 'events': ['push'], 'active': True}])
+
+  def patches(self):
+    return [c for c in responses.calls if c.request.method == 'PATCH']
+
+  def test_unchanged_hook_not_patched(self):
+    ret = self.present(dict(CONFIG))
+    self.assertEqual(ret['changes'].keys(), ['add'])
+    gh_hooks._fingerprints = None  # as if in a later run
+    ret = self.present(dict(CONFIG))
+    self.assertEqual((ret['result'], ret['changes']), (True, {}))
+    self.assertEqual(self.patches(), [])
+
+  def test_changed_secret_patched_once(self):
+    self.present(dict(CONFIG))
+    config = dict(CONFIG, auth_token='rotated')
+    ret = self.present(config)
+    self.assertEqual(ret['changes'], {'patch': [('Clever/clever-js', {'config': config})]})
+    ret = self.present(config)
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual(len(self.patches()), 1)
@@ -1,10 +1,33 @@
 import unittest
 import sys
 import os
+import imp
+import json
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
 import responses
+from salt.exceptions import CommandExecutionError
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+import gh_api
 import gh_team
+gh_api.__salt__ = {'salt_org.guard': salt_org.guard,
+                   'salt_org.cached_response': salt_org.cached_response,
+                   'salt_org.cache_clear': salt_org.cache_clear}
+gh_team.__salt__ = {'gh_api.request': gh_api.request}
+gh_team_state = imp.load_source('gh_team_state', os.path.join(os.path.dirname(__file__),
+                                                              '../salt/_states/gh_team.py'))
+gh_team_state.__salt__ = dict(
+    [('gh_team.' + name, getattr(gh_team, name)) for name in
+     ('list', 'add', 'get_if_modified', 'list_members', 'get_membership', 'add_membership',
+      'remove_membership', 'list_repos', 'get_repo', 'add_repo', 'remove_repo', 'fingerprint',
+      'converged', 'record_converged', 'listing_etags', 'listing_modified')] +
+    [('salt_org.' + name, getattr(salt_org, name)) for name in
+     ('skip_shard', 'run_state', 'map_concurrent', 'reconcile', 'resume', 'update_ret')])
 
 # fake responses taken straight from github docs https://developer.github.com/v3/orgs/teams
 FAKE_TEAMS = """[
@@ -124,6 +147,42 @@ class GHTeamTest(unittest.TestCase):
     resp = gh_team.list("token", ":org")
     self.assertEqual(resp[0]["name"], "Owners")
 
+  @responses.activate
+  def test_list_coalesced(self):
+    def slow_teams(request):
+      time.sleep(0.1)
+      return (200, {}, FAKE_TEAMS)
+    responses.add_callback(responses.GET, 'https://api.github.com/orgs/:org/teams',
+                           callback=slow_teams)
+    started = threading.Event()
+    results = []
+
+    def list_teams():
+      started.wait()
+      results.append(gh_team.list("token", ":org"))
+    threads = [threading.Thread(target=list_teams) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    started.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(results), 8)
+    self.assertTrue(all(resp[0]["name"] == "Owners" for resp in results))
+    self.assertEqual(len(responses.calls), 1)
+
+  @responses.activate
+  def test_list_pages(self):
+    def teams_page(request):
+      query = urlparse.parse_qs(urlparse.urlparse(request.url).query)
+      page, per_page = int(query['page'][0]), int(query['per_page'][0])
+      return (200, {}, json.dumps([{'id': i, 'name': 'team{0}'.format(i)}
+                                   for i in range(250)[(page - 1) * per_page:page * per_page]]))
+    responses.add_callback(responses.GET, 'https://api.github.com/orgs/:org/teams',
+                           callback=teams_page)
+    resp = gh_team.list("token", ":org")
+    self.assertEqual([team['id'] for team in resp], range(250))
+    self.assertEqual(len(responses.calls), 3)
+
   @responses.activate
   def test_list_false(self):
     responses.add(responses.GET, 'https://api.github.com/orgs/:org/teams', status=400)
@@ -156,6 +215,33 @@ class GHTeamTest(unittest.TestCase):
     resp = gh_team.get("token", "1")
     self.assertEqual(resp, None)
 
+  @responses.activate
+  def test_get_if_modified(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/1', body=FAKE_TEAM, status=200,
+                  adding_headers={'ETag': 'W/"abc"'}, content_type='application/json')
+    resp = gh_team.get_if_modified("token", "1")
+    self.assertEqual((resp["modified"], resp["team"]["name"], resp["etag"]),
+                     (True, "Owners", 'W/"abc"'))
+
+  @responses.activate
+  def test_get_if_modified_unchanged(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/1', status=304)
+    resp = gh_team.get_if_modified("token", "1", 'W/"abc"')
+    self.assertEqual(resp, {"modified": False})
+    self.assertEqual(responses.calls[0].request.headers["If-None-Match"], 'W/"abc"')
+
+  @responses.activate
+  def test_get_if_modified_none(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/1', status=404)
+    resp = gh_team.get_if_modified("token", "1", 'W/"abc"')
+    self.assertEqual(resp, None)
+
+  def test_fingerprint(self):
+    self.assertEqual(gh_team.fingerprint({'members': ['b', 'a'], 'repos': None}),
+                     gh_team.fingerprint({'repos': None, 'members': ['a', 'b']}))
+    self.assertNotEqual(gh_team.fingerprint({'members': ['a']}),
+                        gh_team.fingerprint({'members': ['a', 'b']}))
+
   @responses.activate
   def test_remove_true(self):
     responses.add(responses.DELETE, 'https://api.github.com/teams/1', status=204)
@@ -188,6 +274,21 @@ class GHTeamTest(unittest.TestCase):
     resp = gh_team.list_members("token", "1")
     self.assertEqual(resp[0]["login"], "octocat")
 
+  @responses.activate
+  def test_list_members_pages(self):
+    logins = ['user{}'.format(i) for i in range(gh_team.PAGE_SIZE + 5)]
+
+    def members_page(request):
+      query = urlparse.parse_qs(urlparse.urlparse(request.url).query)
+      page, per_page = int(query['page'][0]), int(query['per_page'][0])
+      return (200, {}, json.dumps([{'login': login}
+                                   for login in logins[(page - 1) * per_page:page * per_page]]))
+    responses.add_callback(responses.GET, 'https://api.github.com/teams/1/members',
+                           callback=members_page)
+    resp = gh_team.list_members("token", "1")
+    self.assertEqual([m["login"] for m in resp], logins)
+    self.assertEqual(len(responses.calls), 2)
+
   @responses.activate
   def test_list_members_none(self):
     responses.add(responses.GET, 'https://api.github.com/teams/1/members', status=400)
@@ -204,10 +305,16 @@ class GHTeamTest(unittest.TestCase):
   @responses.activate
   def test_get_membership_none(self):
     responses.add(responses.GET, 'https://api.github.com/teams/:id/memberships/:username',
-                  status=400)
+                  status=404)
     resp = gh_team.get_membership("token", ":id", ":username")
     self.assertEqual(resp, None)
 
+  @responses.activate
+  def test_get_membership_error(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/:id/memberships/:username',
+                  status=400)
+    self.assertRaises(CommandExecutionError, gh_team.get_membership, "token", ":id", ":username")
+
   @responses.activate
   def test_add_membership(self):
     responses.add(responses.PUT, 'https://api.github.com/teams/:id/memberships/:username',
@@ -256,6 +363,12 @@ class GHTeamTest(unittest.TestCase):
     resp = gh_team.get_repo("token", "1", ":owner/:repo")
     self.assertEqual(resp, False)
 
+  @responses.activate
+  def test_get_repo_error(self):
+    responses.add(responses.GET, 'https://api.github.com/teams/1/repos/:owner/:repo',
+                  status=500, content_type='application/json')
+    self.assertRaises(CommandExecutionError, gh_team.get_repo, "token", "1", ":owner/:repo")
+
   @responses.activate
   def test_add_repo_true(self):
     responses.add(responses.PUT, 'https://api.github.com/teams/1/repos/:owner/:repo',
@@ -283,3 +396,188 @@ class GHTeamTest(unittest.TestCase):
                   status=400, content_type='application/json')
     resp = gh_team.remove_repo("token", "1", ":owner/:repo")
     self.assertEqual(resp, False)
+
+
+class GHTeamStateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    gh_team.__opts__ = {'cachedir': self.dir}
+    gh_team._converged = None
+    salt_org.__opts__ = {'cachedir': self.dir}
+    salt_org.__salt__ = {'config.get': lambda key, default: 0 if key == 'salt_org:cache:ttl'
+                         else default}
+    self.members = set(['octocat'])
+    # members_count GitHub reports for the team, if not the number of members
+    self.members_count = None
+    self.repos_count = 10
+    self.failing = False
+    responses.start()
+    responses.add(responses.GET, 'https://api.github.com/orgs/Clever/teams', body=FAKE_TEAMS,
+                  status=200, content_type='application/json')
+    responses.add_callback(responses.GET, 'https://api.github.com/teams/1', callback=self.team)
+    responses.add_callback(responses.GET, 'https://api.github.com/teams/1/members',
+                           callback=self.list_members)
+    responses.add_callback(responses.PUT, 'https://api.github.com/teams/1/memberships/rgarcia',
+                           callback=self.add_member)
+    for login in ('octocat', 'rgarcia'):
+      responses.add_callback(responses.GET,
+                             'https://api.github.com/teams/1/memberships/' + login,
+                             callback=self.get_membership)
+
+  def tearDown(self):
+    responses.stop()
+    responses.reset()
+    del salt_org.__opts__
+    del salt_org.__salt__
+    shutil.rmtree(self.dir)
+
+  def team(self, request):
+    team = dict(json.loads(FAKE_TEAM), members_count=self.members_count or len(self.members),
+                repos_count=self.repos_count)
+    etag = 'W/"{0}"'.format(team['members_count'])
+    if request.headers.get('If-None-Match') == etag:
+      return (304, {}, '')
+    return (200, {'ETag': etag}, json.dumps(team))
+
+  def list_members(self, request):
+    etag = 'W/"{0}"'.format(','.join(sorted(self.members)))
+    if request.headers.get('If-None-Match') == etag:
+      return (304, {}, '')
+    return (200, {'ETag': etag}, json.dumps([{'login': login} for login in sorted(self.members)]))
+
+  def get_membership(self, request):
+    if request.url.rsplit('/', 1)[1] not in self.members:
+      return (404, {}, '{"message": "Not Found"}')
+    return (200, {}, json.dumps({'state': 'active'}))
+
+  def add_member(self, request):
+    if self.failing:
+      return (502, {}, '{"message": "Server Error"}')
+    self.members.add('rgarcia')
+    return (200, {}, json.dumps({'state': 'active'}))
+
+  def present(self, members):
+    return gh_team_state.present('Owners', 'token', 'Clever', members=members)
+
+  def requests(self):
+    calls = [(call.request.method, call.request.url.split('?')[0]) for call in responses.calls]
+    responses.calls.reset()
+    return calls
+
+  def test_unchanged_team_skipped(self):
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual(ret['changes'], {'add_member': ['rgarcia']})
+    self.requests()
+    gh_team._converged = None  # as if in a later run
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual((ret['result'], ret['changes']), (True, {}))
+    self.assertEqual(ret['comment'], 'Team unchanged since it last converged')
+    self.assertEqual(self.requests(), [('GET', 'https://api.github.com/teams/1'),
+                                       ('GET', 'https://api.github.com/teams/1/members')])
+
+  def test_strict_team_skipped_while_unchanged(self):
+    gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], strict=True)
+    self.requests()
+    ret = gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], strict=True)
+    self.assertEqual(ret['comment'], 'Team unchanged since it last converged')
+
+  def test_strict_removes_member_added_out_of_band(self):
+    responses.add(responses.DELETE, 'https://api.github.com/teams/1/memberships/mallory',
+                  status=204)
+    gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], strict=True)
+    # added outside Salt, well within recheck_after; the team's own ETag stays the same
+    self.members.add('mallory')
+    self.members_count = 1
+    ret = gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], strict=True)
+    self.assertEqual((ret['result'], ret['changes']), (True, {'remove_member': ['mallory']}))
+    self.assertTrue(('DELETE', 'https://api.github.com/teams/1/memberships/mallory') in
+                    self.requests())
+
+  def test_recheck_after(self):
+    self.present(['octocat'])
+    self.requests()
+    gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], recheck_after=0)
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/members') in self.requests())
+
+  def test_error_mid_run(self):
+    def fail(token, org):
+      raise CommandExecutionError('github circuit open')
+    list_teams = gh_team_state.__salt__['gh_team.list']
+    gh_team_state.__salt__['gh_team.list'] = fail
+    try:
+      ret = self.present(['octocat'])
+    finally:
+      gh_team_state.__salt__['gh_team.list'] = list_teams
+    self.assertEqual((ret['result'], ret['comment']), (False, 'github circuit open'))
+
+  def test_large_team_checked_individually(self):
+    self.members_count = 5000
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual(ret['changes'], {'add_member': ['rgarcia']})
+    requests = self.requests()
+    self.assertFalse(('GET', 'https://api.github.com/teams/1/members') in requests)
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/memberships/octocat') in requests)
+
+  def test_small_team_listed(self):
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual(ret['changes'], {'add_member': ['rgarcia']})
+    requests = self.requests()
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/members') in requests)
+    self.assertFalse(('GET', 'https://api.github.com/teams/1/memberships/octocat') in requests)
+
+  def test_strict_large_team_listed(self):
+    self.members_count = 5000
+    gh_team_state.present('Owners', 'token', 'Clever', members=['octocat'], strict=True)
+    requests = self.requests()
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/members') in requests)
+    self.assertFalse(('GET', 'https://api.github.com/teams/1/memberships/octocat') in requests)
+
+  def test_failed_repo_check(self):
+    self.repos_count = 5000
+    url = 'https://api.github.com/teams/1/repos/Clever/api'
+    responses.add(responses.GET, url, status=500, body='{"message": "Server Error"}')
+    responses.add(responses.PUT, url, status=204)
+    ret = gh_team_state.present('Owners', 'token', 'Clever', repos=['Clever/api'])
+    self.assertEqual((ret['result'], ret['comment']), (False, 'Error fetching repos'))
+    requests = self.requests()
+    self.assertTrue(('GET', url) in requests)
+    self.assertFalse(('PUT', url) in requests)
+
+  def test_changed_spec_rechecked(self):
+    self.present(['octocat'])
+    self.requests()
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual(ret['changes'], {'add_member': ['rgarcia']})
+
+  def test_changed_team_rechecked(self):
+    self.present(['octocat'])
+    self.members.add('someone')
+    self.requests()
+    ret = self.present(['octocat'])
+    self.assertEqual(ret['changes'], {})
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/members') in self.requests())
+
+  def test_failed_changes_resumed(self):
+    self.failing = True
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual(ret['result'], False)
+    self.requests()
+    self.failing = False
+    ret = self.present(['octocat', 'rgarcia'])
+    self.assertEqual((ret['result'], ret['changes']), (True, {'add_member': ['rgarcia']}))
+    requests = self.requests()
+    self.assertTrue(('PUT', 'https://api.github.com/teams/1/memberships/rgarcia') in requests)
+    self.assertFalse(('GET', 'https://api.github.com/teams/1/members') in requests)
+    self.assertEqual(gh_team.converged('Clever', 'Owners'), None)
+    self.present(['octocat', 'rgarcia'])
+    self.assertTrue(('GET', 'https://api.github.com/teams/1/members') in self.requests())
+
+  def test_failing_change_rediffed(self):
+    self.failing = True
+    listed = []
+    for _ in range(salt_org.JOURNAL_MAX_REPLAYS + 2):
+      ret = self.present(['octocat', 'rgarcia'])
+      self.assertEqual(ret['result'], False)
+      listed.append(('GET', 'https://api.github.com/teams/1/members') in self.requests())
+    self.assertEqual(listed, [True] + [False] * salt_org.JOURNAL_MAX_REPLAYS + [True])
@@ -0,0 +1,230 @@
+import unittest
+import sys
+import os
+import imp
+import json
+import shutil
+import tempfile
+import mock
+import responses
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+import hk_collaborator
+hk_collaborator.__salt__ = {'salt_org.guard': salt_org.guard,
+                            'salt_org.cached_response': salt_org.cached_response,
+                            'salt_org.cache_clear': salt_org.cache_clear}
+hk_collaborators = imp.load_source('hk_collaborators_state',
+                                   os.path.join(os.path.dirname(__file__),
+                                                '../salt/_states/hk_collaborators.py'))
+from salt.exceptions import CommandExecutionError
+
+COLLABORATORS_URL = 'https://api.heroku.com/apps/myapp/collaborators'
+
+
+def fake_collaborator(email):
+  return {"created_at": "2012-01-01T12:00:00Z",
+          "id": email,
+          "silenced": False,
+          "updated_at": "2012-01-01T12:00:00Z",
+          "user": {"email": email, "id": email}}
+
+
+class FakeHeroku(object):
+
+  '''
+  Stand-in for the Heroku collaborator list, which returns collaborators sorted by id in pages
+  of at most `max` items and a Next-Range header while more remain.
+  '''
+
+  def __init__(self, emails):
+    self.collaborators = [fake_collaborator(email) for email in sorted(emails)]
+    self.ranges = []
+
+  def __call__(self, request):
+    range_header = request.headers['Range']
+    self.ranges.append(range_header)
+    start, options = range_header[len('id '):].split('..')
+    start = start.strip().lstrip(']')
+    page_size = int(options.split('max=')[1])
+    remaining = [c for c in self.collaborators if c['id'] > start]
+    page = remaining[:page_size]
+    if len(remaining) <= page_size:
+      return (200, {}, json.dumps(page))
+    return (206, {'Next-Range': 'id ]{}..; max={}'.format(page[-1]['id'], page_size)},
+            json.dumps(page))
+
+
+class HKCollaboratorTest(unittest.TestCase):
+
+  def setUp(self):
+    hk_collaborator._rate_limits.clear()
+
+  @responses.activate
+  def test_list(self):
+    responses.add(responses.GET, COLLABORATORS_URL,
+                  body=json.dumps([fake_collaborator('a@example.com')]), status=200,
+                  content_type='application/json')
+    resp = hk_collaborator.list("token", "myapp")
+    self.assertEqual(resp[0]["user"]["email"], "a@example.com")
+    self.assertEqual(responses.calls[0].request.headers['Authorization'], 'Bearer token')
+    self.assertEqual(responses.calls[0].request.headers['Range'], 'id ..; max=1000')
+
+  @responses.activate
+  def test_list_follows_next_range(self):
+    fake = FakeHeroku(['{}@example.com'.format(i) for i in range(5)])
+    responses.add_callback(responses.GET, COLLABORATORS_URL, callback=fake)
+    resp = [c["user"]["email"] for c in hk_collaborator.iter_list("token", "myapp", 2)]
+    self.assertEqual(resp, ['{}@example.com'.format(i) for i in range(5)])
+    self.assertEqual(len(fake.ranges), 3)
+    self.assertEqual(fake.ranges[1], 'id ]1@example.com..; max=2')
+
+  @responses.activate
+  def test_list_partial_content_without_next_range(self):
+    responses.add(responses.GET, COLLABORATORS_URL,
+                  body=json.dumps([fake_collaborator('a@example.com')]), status=206,
+                  content_type='application/json')
+    resp = hk_collaborator.list("token", "myapp")
+    self.assertEqual(len(resp), 1)
+
+  @responses.activate
+  def test_list_error(self):
+    responses.add(responses.GET, COLLABORATORS_URL, status=404)
+    self.assertRaises(CommandExecutionError, hk_collaborator.list, "token", "myapp")
+
+  @responses.activate
+  def test_shared_session(self):
+    responses.add(responses.GET, COLLABORATORS_URL, body='[]', status=200,
+                  content_type='application/json')
+    hk_collaborator.list("token", "myapp")
+    session = hk_collaborator._get_session()
+    hk_collaborator.list("other-token", "myapp")
+    self.assertIs(hk_collaborator._get_session(), session)
+    self.assertEqual(responses.calls[1].request.headers['Authorization'], 'Bearer other-token')
+    self.assertEqual(responses.calls[1].request.headers['Accept'],
+                     'application/vnd.heroku+json; version=3')
+
+  @responses.activate
+  def test_create(self):
+    responses.add(responses.POST, COLLABORATORS_URL,
+                  body=json.dumps(fake_collaborator('a@example.com')), status=201,
+                  content_type='application/json')
+    resp = hk_collaborator.create("token", "myapp", "a@example.com")
+    self.assertEqual(resp["user"]["email"], "a@example.com")
+    self.assertEqual(json.loads(responses.calls[0].request.body), {"user": "a@example.com"})
+
+  @responses.activate
+  def test_create_error(self):
+    responses.add(responses.POST, COLLABORATORS_URL, status=422)
+    self.assertRaises(CommandExecutionError, hk_collaborator.create, "token", "myapp",
+                      "a@example.com")
+
+  @responses.activate
+  def test_delete(self):
+    responses.add(responses.DELETE, COLLABORATORS_URL + '/a%40example.com',
+                  body=json.dumps(fake_collaborator('a@example.com')), status=200,
+                  content_type='application/json')
+    resp = hk_collaborator.delete("token", "myapp", "a@example.com")
+    self.assertEqual(resp["user"]["email"], "a@example.com")
+
+  @responses.activate
+  def test_list_apps(self):
+    responses.add(responses.GET, 'https://api.heroku.com/apps',
+                  body=json.dumps([{"id": "1", "name": "myapp"}]), status=200,
+                  content_type='application/json')
+    resp = hk_collaborator.list_apps("token")
+    self.assertEqual(resp[0]["name"], "myapp")
+
+  @responses.activate
+  def test_retry_after_429(self):
+    statuses = [429, 200]
+    responses.add_callback(responses.GET, COLLABORATORS_URL,
+                           callback=lambda request: (statuses.pop(0), {}, '[]'))
+    with mock.patch.object(hk_collaborator.time, 'sleep') as sleep:
+      resp = hk_collaborator.list("token", "myapp")
+    self.assertEqual(resp, [])
+    self.assertEqual(len(responses.calls), 2)
+    self.assertEqual(sleep.call_count, 1)
+    self.assertAlmostEqual(sleep.call_args[0][0], 1 / hk_collaborator.RATE_LIMIT_REFILL, 1)
+
+  @responses.activate
+  def test_gives_up_after_retries(self):
+    responses.add(responses.GET, COLLABORATORS_URL, status=429)
+    with mock.patch.object(hk_collaborator.time, 'sleep'):
+      self.assertRaises(CommandExecutionError, hk_collaborator.list, "token", "myapp")
+    self.assertEqual(len(responses.calls), hk_collaborator.RATE_LIMIT_RETRIES + 1)
+
+  @responses.activate
+  def test_paces_when_budget_spent(self):
+    responses.add(responses.GET, COLLABORATORS_URL, body='[]', status=200,
+                  adding_headers={'RateLimit-Remaining': '1'})
+    with mock.patch.object(hk_collaborator.time, 'sleep') as sleep:
+      hk_collaborator.list("token", "myapp")
+      hk_collaborator.list("token", "myapp")
+      self.assertEqual(sleep.call_count, 0)
+      hk_collaborator._rate_limits["token"].update(0)
+      hk_collaborator.list("token", "myapp")
+      self.assertEqual(sleep.call_count, 1)
+      hk_collaborator.list("other-token", "myapp")
+      self.assertEqual(sleep.call_count, 1)
+
+
+class HKCollaboratorsStateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    salt_org.__opts__ = {'cachedir': self.dir}
+    self.apps = {'app-a': set(['a@example.com']), 'app-b': set(['a@example.com', 'x@example.com'])}
+    self.failing = set()
+    self.listed = []
+    hk_collaborators.__salt__ = dict(
+        [('salt_org.' + name, getattr(salt_org, name)) for name in
+         ('skip_shard', 'in_shard', 'run_state', 'fan_out', 'reconcile', 'resume', 'update_ret')] +
+        [('hk_collaborator.list', self.list), ('hk_collaborator.create', self.create),
+         ('hk_collaborator.delete', self.delete),
+         ('hk_collaborator.list_apps', lambda token: [{'name': app} for app in self.apps])])
+
+  def tearDown(self):
+    del salt_org.__opts__
+    shutil.rmtree(self.dir)
+
+  def list(self, token, app):
+    self.listed.append(app)
+    return [fake_collaborator(email) for email in sorted(self.apps[app])]
+
+  def create(self, token, app, email):
+    if (app, email) in self.failing:
+      raise CommandExecutionError('Error adding {0}'.format(email))
+    self.apps[app].add(email)
+    return fake_collaborator(email)
+
+  def delete(self, token, app, email):
+    self.apps[app].discard(email)
+    return fake_collaborator(email)
+
+  def test_present_many(self):
+    ret = hk_collaborators.present_many('all', 'token', ['a@example.com', 'b@example.com'],
+                                        pattern='app-*', strict=True)
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(ret['changes'], {'app-a': {'add_member': ['b@example.com']},
+                                      'app-b': {'add_member': ['b@example.com'],
+                                                'remove_member': ['x@example.com']}})
+    for app in self.apps:
+      self.assertEqual(self.apps[app], set(['a@example.com', 'b@example.com']))
+
+  def test_present_many_resumes_failed_app(self):
+    members = ['a@example.com', 'b@example.com', 'c@example.com']
+    self.failing.add(('app-b', 'c@example.com'))
+    ret = hk_collaborators.present_many('all', 'token', members, apps=['app-a', 'app-b'])
+    self.assertFalse(ret['result'])
+    self.assertTrue(ret['comment'].startswith('app-b: '), ret['comment'])
+    self.assertEqual(ret['changes']['app-b']['failed'], {'add_member': {
+        'c@example.com': 'Error adding c@example.com'}})
+    self.failing.clear()
+    self.listed = []
+    ret = hk_collaborators.present_many('all', 'token', members, apps=['app-a', 'app-b'])
+    self.assertTrue(ret['result'], ret['comment'])
+    self.assertEqual(ret['changes'], {'app-b': {'add_member': ['c@example.com']}})
+    # app-b finished from its journal; app-a, already converged, is listed again
+    self.assertEqual(self.listed, ['app-a'])
+    self.assertEqual(self.apps['app-b'], set(members + ['x@example.com']))
@@ -0,0 +1,190 @@
+import unittest
+import sys
+import os
+import imp
+import json
+import shutil
+import tempfile
+import urlparse
+import responses
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import aws_iam
+import gh_api
+import gh_team
+import hk_collaborator
+import salt_org
+from test_aws_iam_bench import FakeIAM, FakeSTS
+org_member = imp.load_source('org_member_state', os.path.join(os.path.dirname(__file__),
+                                                              '../salt/_states/org_member.py'))
+
+GH = 'https://api.github.com'
+HK = 'https://api.heroku.com'
+
+
+def collaborators(*emails):
+  return json.dumps([{'id': email, 'user': {'email': email}} for email in emails])
+
+
+class OrgMemberTest(unittest.TestCase):
+
+  def setUp(self):
+    self.iam = FakeIAM()
+    self.iam.add_user('rgarcia', keys=2)
+    self.iam.add_user('other')
+    self.iam.add_group('Engineers', ['rgarcia', 'other'])
+    self.iam.add_group('Admins', ['other'])
+    funcs = {'cmd.run_all': self.iam.run_all}
+    for module in (aws_iam, gh_api, gh_team, hk_collaborator, salt_org):
+      module.__salt__ = funcs
+      funcs.update((module.__name__ + '.' + name, getattr(module, name)) for name in dir(module)
+                   if not name.startswith('_') and callable(getattr(module, name)))
+    aws_iam.__context__ = {}
+    org_member.__salt__ = funcs
+    self.teams = [{'id': 1, 'name': 'Owners'}, {'id': 2, 'name': 'Interns'}]
+    # status of the membership check of rgarcia by team id; 404, not a member, for the others
+    self.memberships = {1: 200}
+    responses.add(responses.GET, HK + '/apps', content_type='application/json',
+                  body=json.dumps([{'name': 'api'}, {'name': 'www'}]))
+    responses.add(responses.GET, HK + '/apps/api/collaborators', content_type='application/json',
+                  body=collaborators('rgarcia@clever.com', 'other@clever.com'))
+    responses.add(responses.GET, HK + '/apps/www/collaborators', content_type='application/json',
+                  body=collaborators('other@clever.com'))
+    responses.add(responses.DELETE, HK + '/apps/api/collaborators/rgarcia%40clever.com',
+                  body='{}', content_type='application/json')
+
+  def teams_page(self, request):
+    query = urlparse.parse_qs(urlparse.urlparse(request.url).query)
+    page, per_page = int(query['page'][0]), int(query['per_page'][0])
+    return (200, {}, json.dumps(self.teams[(page - 1) * per_page:page * per_page]))
+
+  def absent(self, **kwargs):
+    kwargs.setdefault('aws', {'user': 'rgarcia'})
+    responses.add_callback(responses.GET, GH + '/orgs/Clever/teams', callback=self.teams_page)
+    for team in self.teams:
+      url = GH + '/teams/{0}/memberships/rgarcia'.format(team['id'])
+      responses.add(responses.GET, url, status=self.memberships.get(team['id'], 404),
+                    body='{"state": "active"}', content_type='application/json')
+      responses.add(responses.DELETE, url, status=204)
+    return org_member.absent('rgarcia',
+                             github={'token': 'token', 'org': 'Clever', 'login': 'rgarcia'},
+                             heroku={'token': 'token', 'email': 'rgarcia@clever.com'},
+                             **kwargs)
+
+  @responses.activate
+  def test_absent(self):
+    ret = self.absent()
+    self.assertEqual(ret['comment'], '')
+    self.assertEqual(ret['changes'], {
+        'github': {'remove_member': ['Owners']},
+        'heroku': {'remove_collaborator': ['api']},
+        'aws': {'remove_user_from_group': ['Engineers'],
+                'delete_access_key': ['AKIA0000000000000001', 'AKIA0000000000000002'],
+                'delete_user': 'rgarcia'}})
+    self.assertNotIn('rgarcia', self.iam.users)
+    self.assertEqual(self.iam.groups['Engineers']['members'], set(['other']))
+    self.assertEqual(len([c for c in responses.calls if c.request.method == 'DELETE']), 2)
+
+  @responses.activate
+  def test_absent_removes_everything_attached(self):
+    self.iam.add_user('jdoe', certificates=['CERT1'], mfa_devices=['arn:aws:iam::1:mfa/jdoe'],
+                      policies=['inline'], attached=['arn:aws:iam::aws:policy/ReadOnlyAccess'],
+                      login=True)
+    ret = self.absent(aws={'user': 'jdoe'})
+    self.assertEqual(ret['comment'], '')
+    self.assertEqual(ret['changes']['aws'], {
+        'delete_signing_certificate': ['CERT1'],
+        'deactivate_mfa_device': ['arn:aws:iam::1:mfa/jdoe'],
+        'delete_user_policy': ['inline'],
+        'detach_user_policy': ['arn:aws:iam::aws:policy/ReadOnlyAccess'],
+        'delete_login_profile': ['jdoe'],
+        'delete_user': 'jdoe'})
+    self.assertNotIn('jdoe', self.iam.users)
+
+  @responses.activate
+  def test_absent_dry_run(self):
+    ret = self.absent(dry_run=True)
+    self.assertEqual(ret['changes']['aws']['delete_user'], 'rgarcia')
+    self.assertIn('rgarcia', self.iam.users)
+    self.assertEqual([c for c in responses.calls if c.request.method == 'DELETE'], [])
+
+  @responses.activate
+  def test_user_kept_when_key_removal_fails(self):
+    self.iam.delete_access_key = lambda args: 'AccessDenied'
+    ret = self.absent()
+    self.assertEqual(ret['result'], False)
+    self.assertIn('Error running delete_access_key', ret['comment'])
+    self.assertNotIn('delete_user', ret['changes']['aws'])
+    self.assertIn('rgarcia', self.iam.users)
+    self.assertEqual(ret['changes']['github'], {'remove_member': ['Owners']})
+
+  @responses.activate
+  def test_failed_removals_resumed(self):
+    salt_org.__opts__ = {'cachedir': tempfile.mkdtemp()}
+    self.addCleanup(shutil.rmtree, salt_org.__opts__['cachedir'])
+    self.addCleanup(delattr, salt_org, '__opts__')
+    delete_access_key = self.iam.delete_access_key
+    self.iam.delete_access_key = lambda args: 'Throttled'
+    ret = self.absent()
+    self.assertEqual(sorted(ret['changes']['failed']['aws']['delete_access_key']),
+                     ['AKIA0000000000000001', 'AKIA0000000000000002'])
+    self.iam.delete_access_key = delete_access_key
+    self.iam.calls.clear()
+    ret = self.absent()
+    self.assertEqual(ret['comment'], '')
+    self.assertEqual(ret['changes']['aws'], {
+        'delete_access_key': ['AKIA0000000000000001', 'AKIA0000000000000002'],
+        'delete_user': 'rgarcia'})
+    # the keys come from the journal rather than another listing
+    self.assertEqual(self.iam.calls['list-access-keys'], 0)
+    self.assertNotIn('rgarcia', self.iam.users)
+
+  @responses.activate
+  def test_several_accounts(self):
+    second = FakeIAM()
+    second.add_user('rgarcia', keys=1)
+    second.add_group('Admins', ['rgarcia'])
+    roles = ['arn:aws:iam::111111111111:role/salt-org', 'arn:aws:iam::222222222222:role/salt-org']
+    org_member.__salt__['cmd.run_all'] = FakeSTS(FakeIAM(), {roles[0]: self.iam,
+                                                             roles[1]: second}).run_all
+    aws_iam._role_sessions.clear()
+    ret = self.absent(aws={'user': 'rgarcia', 'role': roles + ['arn:aws:iam::999:role/nope']})
+    self.assertEqual(ret['result'], False)
+    self.assertTrue(ret['comment'].startswith('arn:aws:iam::999:role/nope: '))
+    self.assertEqual(ret['changes']['github'], {'remove_member': ['Owners']})
+    self.assertEqual(ret['changes']['aws'], {
+        roles[0]: {'remove_user_from_group': ['Engineers'],
+                   'delete_access_key': ['AKIA0000000000000001', 'AKIA0000000000000002'],
+                   'delete_user': 'rgarcia'},
+        roles[1]: {'remove_user_from_group': ['Admins'],
+                   'delete_access_key': ['AKIA0000000000000001'],
+                   'delete_user': 'rgarcia'}})
+    self.assertNotIn('rgarcia', self.iam.users)
+    self.assertNotIn('rgarcia', second.users)
+
+  @responses.activate
+  def test_absent_in_other_shard(self):
+    index = (salt_org.shard('rgarcia', 4) + 1) % 4
+    org_member.__salt__['config.get'] = lambda key, default: \
+        {'index': index, 'count': 4} if key == 'salt_org:shard' else default
+    ret = self.absent()
+    self.assertEqual((ret['result'], ret['changes']), (True, {}))
+    self.assertIn('not this minion\'s shard', ret['comment'])
+    self.assertIn('rgarcia', self.iam.users)
+    self.assertEqual(len(responses.calls), 0)
+
+  @responses.activate
+  def test_teams_after_first_page(self):
+    self.teams += [{'id': i, 'name': 'team{0}'.format(i)} for i in range(3, 151)]
+    self.memberships[150] = 200
+    ret = self.absent()
+    self.assertEqual(ret['comment'], '')
+    self.assertEqual(sorted(ret['changes']['github']['remove_member']), ['Owners', 'team150'])
+
+  @responses.activate
+  def test_failed_membership_check(self):
+    self.memberships[2] = 500
+    ret = self.absent()
+    self.assertEqual(ret['result'], False)
+    self.assertIn('Error checking team Interns', ret['comment'])
+    self.assertEqual(ret['changes']['github'], {'remove_member': ['Owners']})
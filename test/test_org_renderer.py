@@ -0,0 +1,148 @@
+import unittest
+import sys
+import os
+import imp
+import jinja2
+import salt.renderers.yaml
+from salt.exceptions import SaltRenderError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+org = imp.load_source('org_renderer', os.path.join(os.path.dirname(__file__),
+                                                   '../salt/_renderers/org.py'))
+org.__salt__ = {'salt_org.in_shard': salt_org.in_shard}
+
+# The Jinja loops the org renderer replaces, as in the README.
+TEMPLATE = '''
+{% for team in pillar.github.teams %}
+github-{{ team.name }}:
+  gh_team.present:
+    - token: {{ pillar.github.token }}
+    - org: {{ pillar.github.org }}
+    - name: {{ team.name }}
+    - members: {{ team.members }}
+    - permission: {{ team.permission }}
+    - repos: {{ team.repos }}
+    - strict: {{ team.strict }}
+{% endfor %}
+{% for app in pillar.heroku.apps %}
+heroku-{{ app.name }}:
+  hk_collaborators.present:
+    - token: {{ pillar.heroku.token }}
+    - name: {{ app.name }}
+    - members: {{ app.members }}
+    - strict: {{ app.strict }}
+{% endfor %}
+{% for group in pillar.aws.groups %}
+aws-group-{{ group.name }}:
+  aws_iam_group.present:
+    - name: {{ group.name }}
+    - members: {{ group.members }}
+    - strict: {{ group.strict }}
+{% endfor %}
+aws-users:
+  aws_iam_user.users_present:
+    - name: aws-users
+    - users: {{ pillar.aws.users }}
+'''
+
+
+def pillar(teams=3, repos=5, apps=2, groups=2, users=4):
+  '''
+  Build pillar data for every provider. Each team and app gets a few members and each team
+  repos repos.
+  '''
+  logins = ['user{0:04d}'.format(i) for i in range(users)]
+  return {
+      'github': {'token': 'gh-token', 'org': 'Clever',
+                 'teams': [{'name': 'team{0:03d}'.format(i),
+                            'members': logins[i % users:] + logins[:i % users][:2],
+                            'permission': 'push',
+                            'repos': ['Clever/repo{0:04d}'.format((i + j) % (repos * 2))
+                                      for j in range(repos)],
+                            'strict': i % 2 == 0} for i in range(teams)]},
+      'heroku': {'token': 'hk-token',
+                 'apps': [{'name': 'app{0:03d}'.format(i),
+                           'members': ['{0}@clever.com'.format(login) for login in logins],
+                           'strict': True} for i in range(apps)]},
+      'aws': {'groups': [{'name': 'group{0:03d}'.format(i), 'members': logins, 'strict': False}
+                         for i in range(groups)],
+              'users': [{login: {'keys': True}} for login in logins]},
+  }
+
+
+def render_jinja(pillar):
+  '''
+  Render the Jinja template then parse it with Salt's YAML renderer, as Salt would.
+  '''
+  return salt.renderers.yaml.render(jinja2.Template(TEMPLATE).render(pillar=pillar))
+
+
+def render_org(pillar, data='#!org\n'):
+  salt_org.__salt__ = {}
+  org.__pillar__ = pillar
+  return org.render(data)
+
+
+def normalize(high):
+  '''
+  Turn the argument list of each state into a dict, since argument order doesn't matter.
+  '''
+  normal = {}
+  for id, state in high.iteritems():
+    for function, args in state.iteritems():
+      normal[id] = {function: dict(arg.items()[0] for arg in args)}
+  return normal
+
+
+class OrgRendererTest(unittest.TestCase):
+
+  def test_matches_jinja(self):
+    data = pillar()
+    self.assertEqual(normalize(render_org(data)), normalize(render_jinja(data)))
+
+  def test_mapping(self):
+    data = {'teams': pillar()['github']}
+    high = render_org(data, '#!org\ngithub: teams\n')
+    self.assertEqual(sorted(high), ['github-team000', 'github-team001', 'github-team002'])
+
+  def test_nested_pillar_key(self):
+    data = {'org': {'heroku': pillar()['heroku']}}
+    high = render_org(data, '#!org\nheroku: org:heroku\n')
+    self.assertEqual(sorted(high), ['heroku-app000', 'heroku-app001'])
+
+  def test_only_present_providers(self):
+    high = render_org({'heroku': pillar()['heroku']})
+    self.assertEqual(sorted(high), ['heroku-app000', 'heroku-app001'])
+
+  def test_team_token_overrides(self):
+    data = pillar(teams=1)
+    data['github']['teams'][0]['token'] = 'team-token'
+    args = normalize(render_org(data))['github-team000']['gh_team.present']
+    self.assertEqual(args['token'], 'team-token')
+    self.assertEqual(args['org'], 'Clever')
+
+  def test_unknown_provider(self):
+    self.assertRaises(SaltRenderError, render_org, pillar(), '#!org\ngitlab: gitlab\n')
+
+  def test_missing_pillar_key(self):
+    self.assertRaises(SaltRenderError, render_org, {}, '#!org\ngithub: github\n')
+
+  def test_shards(self):
+    data = pillar(teams=20)
+    teams = set()
+    for index in range(3):
+      salt_org.__salt__ = {'config.get': lambda key, default: {'index': index, 'count': 3}}
+      org.__pillar__ = data
+      high = org.render('github: github\n')
+      self.assertTrue(len(high) and teams.isdisjoint(high))
+      teams.update(high)
+    self.assertEqual(teams, set(render_org(data, '#!org\ngithub: github\n')))
+
+  def test_aws_role(self):
+    data = pillar(teams=0, apps=0, groups=1)
+    data['aws']['role'] = ['arn:aws:iam::111111111111:role/salt-org']
+    high = normalize(render_org(data))
+    self.assertEqual(high['aws-group-group000']['aws_iam_group.present']['role'],
+                     data['aws']['role'])
+    self.assertEqual(high['aws-users']['aws_iam_user.users_present']['role'], data['aws']['role'])
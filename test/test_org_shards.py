@@ -0,0 +1,32 @@
+import unittest
+import os
+import imp
+
+org_shards = imp.load_source('org_shards', os.path.join(os.path.dirname(__file__),
+                                                        '../salt/_runners/org_shards.py'))
+
+UNCHANGED = {'name': 'Engineers', 'result': True, 'changes': {}, 'comment': ''}
+CHANGED = {'name': 'Ops', 'result': True, 'changes': {'add_member': ['rgarcia']}, 'comment': ''}
+FAILED = {'name': 'clever-api', 'result': False, 'changes': {}, 'comment': 'Error'}
+
+
+class OrgShardsTest(unittest.TestCase):
+
+  def test_merge(self):
+    report = org_shards.merge({
+        'org-0': {'github-Engineers': UNCHANGED, 'github-Ops': CHANGED},
+        'org-1': {'heroku-clever-api': FAILED},
+        'org-2': ['Rendering SLS github failed'],
+    })
+    self.assertFalse(report['result'])
+    self.assertEqual(report['minions'], {'org-0': {'states': 2, 'changed': 1, 'failed': 0},
+                                         'org-1': {'states': 1, 'changed': 0, 'failed': 1}})
+    self.assertEqual(report['changes'], {'github-Ops': {'org-0': CHANGED['changes']}})
+    self.assertEqual(report['failed'], {'heroku-clever-api': {'org-1': 'Error'}})
+    self.assertEqual(report['errors'], {'org-2': ['Rendering SLS github failed']})
+    self.assertEqual(report['overlap'], [])
+
+  def test_merge_overlap(self):
+    report = org_shards.merge({'org-0': {'github-Ops': CHANGED}, 'org-1': {'github-Ops': CHANGED}})
+    self.assertTrue(report['result'])
+    self.assertEqual(report['overlap'], ['github-Ops'])
@@ -0,0 +1,493 @@
+import unittest
+import sys
+import os
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../salt/_modules'))
+import salt_org
+
+
+class Recorder(object):
+
+  def __init__(self, fail=(), delay=0):
+    self.fail = set(fail)
+    self.delay = delay
+    self.calls = []
+    self.lock = threading.Lock()
+
+  def __call__(self, item):
+    time.sleep(self.delay)
+    with self.lock:
+      self.calls.append(item)
+    if item in self.fail:
+      raise Exception('{} failed'.format(item))
+    return True
+
+
+class ReconcileTest(unittest.TestCase):
+
+  def test_reconcile(self):
+    add, remove = Recorder(), Recorder()
+    result = salt_org.reconcile(iter(['a', 'b']), ['b', 'c'], add, remove, strict=True)
+    self.assertEqual(result['add'], ['c'])
+    self.assertEqual(result['remove'], ['a'])
+    self.assertEqual(result['errors'], [])
+    self.assertEqual(result['stats']['added'], 1)
+    self.assertEqual(add.calls, ['c'])
+    self.assertEqual(remove.calls, ['a'])
+
+  def test_reconcile_not_strict(self):
+    add, remove = Recorder(), Recorder()
+    result = salt_org.reconcile(['a', 'b'], ['b', 'c'], add, remove)
+    self.assertEqual(result['remove'], [])
+    self.assertEqual(remove.calls, [])
+
+  def test_reconcile_dry_run(self):
+    add, remove = Recorder(), Recorder()
+    result = salt_org.reconcile(['a'], ['b'], add, remove, strict=True, dry_run=True)
+    self.assertEqual(result['add'], ['b'])
+    self.assertEqual(result['remove'], ['a'])
+    self.assertEqual(add.calls + remove.calls, [])
+
+  def test_reconcile_continues_after_failure(self):
+    add = Recorder(fail=['b'])
+    result = salt_org.reconcile([], ['a', 'b', 'c'], add, Recorder(), batch_size=1)
+    self.assertEqual(result['add'], ['a', 'c'])
+    self.assertEqual(result['failed']['add'], {'b': 'b failed'})
+    self.assertEqual(len(result['errors']), 1)
+
+  def test_reconcile_stops_after_failed_batch(self):
+    add = Recorder(fail=['b'])
+    result = salt_org.reconcile([], ['a', 'b', 'c', 'd'], add, Recorder(), batch_size=2,
+                                continue_on_error=False)
+    self.assertEqual(result['add'], ['a'])
+    self.assertEqual(sorted(add.calls), ['a', 'b'])
+    self.assertEqual(result['stats']['skipped'], 2)
+
+  def test_reconcile_falsy_result_is_failure(self):
+    result = salt_org.reconcile([], ['a'], lambda item: None, Recorder())
+    self.assertEqual(result['add'], [])
+    self.assertIn('a', result['failed']['add'])
+
+  def test_reconcile_concurrency(self):
+    add = Recorder(delay=0.05)
+    started = time.time()
+    result = salt_org.reconcile([], range(8), add, Recorder(), concurrency=8)
+    self.assertEqual(result['add'], range(8))
+    self.assertLess(time.time() - started, 0.3)
+
+  def test_update_ret(self):
+    ret = {'name': 'x', 'changes': {}, 'result': True, 'comment': ''}
+    result = salt_org.reconcile(['a'], ['b', 'c'], Recorder(fail=['c']), Recorder(), strict=True)
+    salt_org.update_ret(ret, result, 'add_member', 'remove_member')
+    self.assertEqual(ret['changes']['add_member'], ['b'])
+    self.assertEqual(ret['changes']['remove_member'], ['a'])
+    self.assertEqual(ret['changes']['failed'], {'add_member': {'c': 'c failed'}})
+    self.assertEqual(ret['result'], False)
+    self.assertEqual(ret['comment'], 'Error running add for c: c failed')
+
+
+class JournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    salt_org.__opts__ = {'cachedir': self.dir}
+
+  def tearDown(self):
+    del salt_org.__opts__
+    shutil.rmtree(self.dir)
+
+  def journals(self):
+    path = os.path.join(self.dir, salt_org.CACHE_DIR, salt_org.JOURNAL_DIR)
+    return os.listdir(path) if os.path.isdir(path) else []
+
+  def test_resume_outstanding(self):
+    add, remove = Recorder(fail=['c']), Recorder(fail=['x'])
+    result = salt_org.reconcile(['x', 'y'], ['a', 'b', 'c'], add, remove, strict=True,
+                                journal='test')
+    self.assertEqual(sorted(result['add'] + result['remove']), ['a', 'b', 'y'])
+    self.assertEqual(len(self.journals()), 1)
+    add, remove = Recorder(), Recorder()
+    result = salt_org.resume('test', ['c', 'b', 'a'], add, remove, strict=True, concurrency=4)
+    self.assertEqual((result['add'], result['remove']), (['c'], ['x']))
+    self.assertEqual(result['stats']['resumed'], 3)
+    self.assertEqual((add.calls, remove.calls), (['c'], ['x']))
+    self.assertEqual(self.journals(), [])
+    self.assertEqual(salt_org.resume('test', ['a', 'b', 'c'], add, remove, strict=True), None)
+
+  def test_desired_generator(self):
+    salt_org.reconcile([], (item for item in ['a', 'b']), Recorder(fail=['b']), Recorder(),
+                       journal='test')
+    result = salt_org.resume('test', ['a', 'b'], Recorder(), Recorder())
+    self.assertEqual(result['add'], ['b'])
+
+  def test_resume_failing_again(self):
+    salt_org.reconcile([], ['a', 'b'], Recorder(fail=['a', 'b']), Recorder(), journal='test')
+    result = salt_org.resume('test', ['a', 'b'], Recorder(fail=['b']), Recorder())
+    self.assertEqual(result['add'], ['a'])
+    add = Recorder()
+    self.assertEqual(salt_org.resume('test', ['a', 'b'], add, Recorder())['add'], ['b'])
+    self.assertEqual(add.calls, ['b'])
+
+  def test_failing_again_rediffed(self):
+    salt_org.reconcile([], ['a', 'b'], Recorder(fail=['b']), Recorder(), journal='test')
+    for _ in range(salt_org.JOURNAL_MAX_REPLAYS):
+      add = Recorder(fail=['b'])
+      self.assertEqual(salt_org.resume('test', ['a', 'b'], add, Recorder())['failed']['add'],
+                       {'b': 'b failed'})
+      self.assertEqual(add.calls, ['b'])
+    self.assertEqual(salt_org.resume('test', ['a', 'b'], Recorder(), Recorder()), None)
+    self.assertEqual(self.journals(), [])
+
+  def test_completed_journal_removed(self):
+    salt_org.reconcile([], ['a'], Recorder(), Recorder(), journal='test')
+    self.assertEqual(self.journals(), [])
+    self.assertEqual(salt_org.resume('test', ['a'], Recorder(), Recorder()), None)
+
+  def test_changed_desired_discarded(self):
+    salt_org.reconcile([], ['a'], Recorder(fail=['a']), Recorder(), journal='test')
+    self.assertEqual(salt_org.resume('test', ['a', 'b'], Recorder(), Recorder()), None)
+    self.assertEqual(salt_org.resume('test', ['a'], Recorder(), Recorder(), strict=True), None)
+    self.assertEqual(self.journals(), [])
+
+  def test_old_journal_discarded(self):
+    salt_org.reconcile([], ['a'], Recorder(fail=['a']), Recorder(), journal='test')
+    max_age, salt_org.JOURNAL_MAX_AGE = salt_org.JOURNAL_MAX_AGE, 0
+    try:
+      self.assertEqual(salt_org.resume('test', ['a'], Recorder(), Recorder()), None)
+    finally:
+      salt_org.JOURNAL_MAX_AGE = max_age
+
+  def test_dry_run(self):
+    salt_org.reconcile([], ['a'], Recorder(), Recorder(), dry_run=True, journal='test')
+    self.assertEqual(self.journals(), [])
+    salt_org.reconcile([], ['a'], Recorder(fail=['a']), Recorder(), journal='test')
+    add = Recorder()
+    result = salt_org.resume('test', ['a'], add, Recorder(), dry_run=True)
+    self.assertEqual((result['add'], add.calls), (['a'], []))
+    self.assertEqual(len(self.journals()), 1)
+
+  def test_no_cachedir(self):
+    salt_org.__opts__ = {}
+    result = salt_org.reconcile([], ['a'], Recorder(fail=['a']), Recorder(), journal='test')
+    self.assertEqual(len(result['errors']), 1)
+    self.assertEqual(salt_org.resume('test', ['a'], Recorder(), Recorder()), None)
+
+
+class CircuitTest(unittest.TestCase):
+
+  def setUp(self):
+    salt_org._circuits.clear()
+    salt_org.__salt__ = {'config.get': lambda key, default: {'min_calls': 4, 'window': 4,
+                                                             'test': {'cooldown': 0.05}}}
+
+  def tearDown(self):
+    salt_org._circuits.clear()
+    del salt_org.__salt__
+
+  def refuse(self):
+    raise IOError('connection refused')
+
+  def call(self, func, is_failure=None):
+    try:
+      return salt_org.guard('test', func, is_failure)
+    except Exception as exc:
+      return exc
+
+  def test_opens_after_error_rate(self):
+    for result in [True, False, False, True]:
+      self.call(lambda: result, lambda r: not r)
+    self.assertEqual(salt_org.circuit_status('test')['state'], 'open')
+    calls = []
+    exc = self.call(lambda: calls.append(1))
+    self.assertIsInstance(exc, salt_org.CommandExecutionError)
+    self.assertIn('test circuit open after 2 of the last 4 requests failed', str(exc))
+    self.assertEqual(calls, [])
+    self.assertEqual(salt_org.circuit_open('test'), salt_org.circuit_status('test')['comment'])
+
+  def test_stays_closed_below_min_calls(self):
+    for _ in range(3):
+      self.call(self.refuse)
+    self.assertEqual(salt_org.circuit_status('test')['state'], 'closed')
+    self.assertEqual(salt_org.circuit_open('test'), None)
+
+  def test_half_open_probe(self):
+    for _ in range(4):
+      self.call(self.refuse)
+    time.sleep(0.06)
+    self.assertIsInstance(self.call(self.refuse), IOError)  # failed probe
+    self.assertEqual(salt_org.circuit_status('test')['state'], 'open')
+    time.sleep(0.06)
+    self.assertEqual(self.call(lambda: 'ok'), 'ok')  # successful probe
+    self.assertEqual(salt_org.circuit_status('test'),
+                     {'state': 'closed', 'failures': 0, 'calls': 0,
+                      'comment': 'test circuit closed'})
+
+  def test_one_probe_at_a_time(self):
+    for _ in range(4):
+      self.call(self.refuse)
+    time.sleep(0.06)
+    results = []
+    probe = threading.Thread(target=lambda: results.append(self.call(lambda: time.sleep(0.05))))
+    probe.start()
+    time.sleep(0.01)
+    self.assertIsInstance(self.call(lambda: 'ok'), salt_org.CommandExecutionError)
+    probe.join()
+    self.assertEqual(salt_org.circuit_status('test')['state'], 'closed')
+
+  def test_run_state_circuit_open(self):
+    for _ in range(4):
+      self.call(self.refuse)
+    calls = []
+    ret = salt_org.run_state({'result': True, 'comment': ''}, 'test', lambda: calls.append(1))
+    self.assertEqual(ret['result'], False)
+    self.assertIn('test circuit open', ret['comment'])
+    self.assertEqual(calls, [])
+
+  def test_run_state_opens_mid_run(self):
+    ret = {'result': True, 'comment': '', 'changes': {}}
+
+    def body():
+      ret['changes']['add'] = ['a']
+      for _ in range(5):
+        self.call(self.refuse)
+      salt_org.guard('test', lambda: True)
+    self.assertEqual(salt_org.run_state(ret, 'test', body), ret)
+    self.assertEqual(ret['result'], False)
+    self.assertIn('test circuit open', ret['comment'])
+    self.assertEqual(ret['changes'], {'add': ['a']})
+
+
+class CoalesceTest(unittest.TestCase):
+
+  def run_threads(self, func, count=8):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(func())) for _ in range(count)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
+
+  def test_concurrent_reads_coalesced(self):
+    fetch = Recorder(delay=0.1)
+    results = self.run_threads(lambda: salt_org.cached('test', 'key', lambda: [fetch('key')]))
+    self.assertEqual(fetch.calls, ['key'])
+    self.assertEqual(results, [[True]] * 8)
+    results[0].append('changed')
+    self.assertEqual(results[1], [True])
+
+  def test_errors_shared(self):
+    fetch = Recorder(fail=['key'], delay=0.1)
+
+    def call():
+      try:
+        return salt_org.cached('test', 'key', lambda: fetch('key'))
+      except Exception as exc:
+        return str(exc)
+    self.assertEqual(self.run_threads(call), ['key failed'] * 8)
+    self.assertEqual(fetch.calls, ['key'])
+
+  def test_later_reads_fetch_again(self):
+    fetch = Recorder()
+    salt_org.cached('test', 'key', lambda: fetch('key'))
+    salt_org.cached('test', 'key', lambda: fetch('key'))
+    self.assertEqual(fetch.calls, ['key', 'key'])
+
+
+class CacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.ttl = 30
+    salt_org.__opts__ = {'cachedir': self.dir}
+    salt_org.__salt__ = {'config.get': lambda key, default: self.ttl if key == 'salt_org:cache:ttl'
+                         else default}
+    self.fetches = os.path.join(self.dir, 'fetches')
+
+  def tearDown(self):
+    del salt_org.__opts__
+    del salt_org.__salt__
+    shutil.rmtree(self.dir)
+
+  def fetch(self, value='value', delay=0):
+    # record each fetch in a file so fetches from other processes are counted too
+    with open(self.fetches, 'a') as f:
+      f.write('.')
+    time.sleep(delay)
+    return value
+
+  def count(self):
+    with open(self.fetches) as f:
+      return len(f.read())
+
+  def test_cached(self):
+    self.assertEqual(salt_org.cached('test', 'key', self.fetch), 'value')
+    self.assertEqual(salt_org.cached('test', 'key', self.fetch), 'value')
+    self.assertEqual(salt_org.cached('test', 'other', self.fetch), 'value')
+    self.assertEqual(self.count(), 2)
+
+  def test_expires(self):
+    self.ttl = 0.05
+    salt_org.cached('test', 'key', self.fetch)
+    time.sleep(0.06)
+    salt_org.cached('test', 'key', self.fetch)
+    self.assertEqual(self.count(), 2)
+
+  def test_not_cacheable(self):
+    salt_org.cached('test', 'key', lambda: self.fetch(None), lambda value: value is not None)
+    self.assertEqual(salt_org.cached('test', 'key', self.fetch), 'value')
+    self.assertEqual(self.count(), 2)
+
+  def test_cache_clear(self):
+    salt_org.cached('test', 'key', self.fetch)
+    salt_org.cache_clear('test')
+    salt_org.cached('test', 'key', self.fetch)
+    self.assertEqual(self.count(), 2)
+
+  def test_clear_during_fetch(self):
+    def fetch():
+      value = self.fetch('old')
+      salt_org.cache_clear('test')  # a write made while the read was in flight
+      return value
+    salt_org.cached('test', 'key', fetch)
+    self.assertEqual(salt_org.cached('test', 'key', lambda: self.fetch('new')), 'new')
+
+  def test_stale_write_after_clear(self):
+    directory = os.path.join(self.dir, salt_org.CACHE_DIR, 'test')
+    salt_org.cached('test', 'key', self.fetch)
+    generation = salt_org._cache_generation(directory)
+    salt_org.cache_clear('test')
+    path = os.path.join(directory, salt_org.hashlib.sha256('key').hexdigest() + '.json')
+    salt_org._cache_write(path, 'old', generation)
+    self.assertEqual(salt_org.cached('test', 'key', lambda: self.fetch('new')), 'new')
+
+  def test_cache_clear_removes_locks(self):
+    salt_org.cached('test', 'key', self.fetch)
+    salt_org.cache_clear('test')
+    directory = os.path.join(self.dir, salt_org.CACHE_DIR, 'test')
+    self.assertEqual([name for name in os.listdir(directory)
+                      if name.endswith('.lock') or name.endswith('.json')], [])
+
+  def test_disabled_without_cachedir(self):
+    del salt_org.__opts__
+    salt_org.cached('test', 'key', self.fetch)
+    salt_org.cached('test', 'key', self.fetch)
+    salt_org.__opts__ = {}
+    self.assertEqual(self.count(), 2)
+
+  def test_one_fetch_across_processes(self):
+    processes = [multiprocessing.Process(
+        target=lambda: salt_org.cached('test', 'key', lambda: self.fetch(delay=0.1)))
+        for _ in range(4)]
+    for process in processes:
+      process.start()
+    threads = [threading.Thread(
+        target=lambda: salt_org.cached('test', 'key', lambda: self.fetch(delay=0.1)))
+        for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for worker in processes + threads:
+      worker.join()
+    self.assertEqual(self.count(), 1)
+
+
+class ShardTest(unittest.TestCase):
+
+  def tearDown(self):
+    salt_org.__salt__ = {}
+
+  def configure(self, index, count):
+    salt_org.__salt__ = {'config.get': lambda key, default: {'index': index, 'count': count}}
+
+  def test_unsharded(self):
+    salt_org.__salt__ = {}
+    self.assertTrue(salt_org.in_shard('Engineers'))
+    self.assertEqual(salt_org._not_in_shard('Engineers'), None)
+
+  def test_shards_disjoint_and_complete(self):
+    names = ['team{0}'.format(i) for i in range(100)]
+    shards = []
+    for index in range(4):
+      self.configure(index, 4)
+      shards.append(set(name for name in names if salt_org.in_shard(name)))
+    self.assertEqual(sum(len(shard) for shard in shards), len(names))
+    self.assertEqual(set.union(*shards), set(names))
+    self.assertTrue(all(len(shard) for shard in shards))
+
+  def test_stable(self):
+    self.assertEqual(salt_org.shard('Engineers', 4), 0)
+
+  def test_not_in_shard(self):
+    self.configure((salt_org.shard('Engineers', 4) + 1) % 4, 4)
+    self.assertFalse(salt_org.in_shard('Engineers'))
+    self.assertTrue('shard 0 of 4' in salt_org._not_in_shard('Engineers'))
+    self.assertTrue(salt_org.in_shard('Engineers', index=0))
+
+  def test_skip_shard(self):
+    self.configure((salt_org.shard('Engineers', 4) + 1) % 4, 4)
+    ret = {'name': 'Engineers', 'changes': {}, 'result': True, 'comment': ''}
+    self.assertTrue(salt_org.skip_shard(ret))
+    self.assertTrue('shard 0 of 4' in ret['comment'])
+    self.configure(salt_org.shard('Engineers', 4), 4)
+    self.assertFalse(salt_org.skip_shard({'name': 'Engineers', 'comment': ''}))
+
+  def test_bad_index(self):
+    self.configure(4, 4)
+    self.assertRaises(salt_org.CommandExecutionError, salt_org.in_shard, 'Engineers')
+
+
+def _fetch_item(item):
+  time.sleep(0.01)
+  return item
+
+
+class ProfileTest(unittest.TestCase):
+
+  def setUp(self):
+    salt_org._circuits.clear()
+    salt_org.__salt__ = {'state.single': self.single}
+
+  def tearDown(self):
+    salt_org._circuits.clear()
+    salt_org.__salt__ = {}
+
+  def single(self, fun, name, **kwargs):
+    self.kwargs = kwargs
+    # a state fetching its items on several threads, as the salt-org states do
+    items = salt_org.map_concurrent(
+        lambda item: salt_org.guard('profiled', lambda: _fetch_item(item)),
+        range(kwargs['count']), 4)
+    return {fun: {'name': name, 'result': True, 'changes': {'items': items}, 'comment': ''}}
+
+  def test_profile_state(self):
+    report = salt_org.profile_state('test.present', 'name', count=8, __pub_fun='ignored')
+    self.assertEqual(report['ret']['test.present']['changes'], {'items': range(8)})
+    self.assertEqual(report['outbound_calls'], {'profiled': 8})
+    # calls made on map_concurrent's threads are profiled too
+    fetch = [f for f in report['functions'] if f['function'].endswith('(_fetch_item)')]
+    self.assertEqual(fetch[0]['calls'], 8)
+    self.assertFalse('memory' in report)
+    self.assertEqual(salt_org._profiles, None)
+
+  def test_profile_state_memory(self):
+    report = salt_org.profile_state('test.present', 'name', profile_memory=True,
+                                    count=2)
+    self.assertTrue(report['memory']['peak_rss_kb'] > 0)
+    self.assertTrue(isinstance(report['memory']['object_growth'], list))
+
+  def test_state_arguments_passed_through(self):
+    report = salt_org.profile_state('test.present', 'name', profile_top=1, count=2, top=3,
+                                    memory=True, sort='name')
+    self.assertEqual(len(report['functions']), 1)
+    self.assertFalse('memory' in report)
+    self.assertEqual(self.kwargs, {'count': 2, 'top': 3, 'memory': True, 'sort': 'name'})
+
+  def test_one_profile_at_a_time(self):
+    salt_org.__salt__ = {'state.single': lambda fun, name: salt_org.profile_state(fun, name)}
+    self.assertRaises(salt_org.CommandExecutionError, salt_org.profile_state, 'test.present', 'x')
+    self.assertEqual(salt_org._profiles, None)